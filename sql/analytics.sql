@@ -5,54 +5,56 @@
 -- Query 1:
 -- Top 5 operadoras com maior crescimento percentual de despesas
 -- entre o primeiro e o último trimestre analisado.
+--
+-- Uma passada só sobre despesas_por_operadora_tri: as funções de janela pegam o
+-- primeiro e o último trimestre de cada operadora (sem juntar a CTE com ela mesma).
+-- Operadoras com um único trimestre ficam de fora (não há crescimento a medir).
 -------------------------------------------------------------
 
 WITH despesas_por_operadora_tri AS (
     SELECT
-        d.registro_ans,
-        o.razao_social,
-        o.uf,
-        d.ano,
-        d.trimestre,
-        d.valor_despesas
-    FROM despesas_consolidadas d
-    LEFT JOIN operadoras o
-        ON d.registro_ans = o.registro_ans
+        registro_ans,
+        ano,
+        trimestre,
+        SUM(valor_despesas) AS valor_despesas
+    FROM despesas_consolidadas
+    GROUP BY registro_ans, ano, trimestre
 ),
 primeiro_ultimo_tri AS (
     SELECT
         registro_ans,
-        MIN(ano * 10 + trimestre) AS inicio_ref,   -- "chave" do primeiro período
-        MAX(ano * 10 + trimestre) AS fim_ref       -- "chave" do último período
+        ROW_NUMBER() OVER periodos AS ordem,
+        COUNT(*) OVER periodos AS qtd_trimestres,
+        FIRST_VALUE(valor_despesas) OVER periodos AS valor_inicial,
+        LAST_VALUE(valor_despesas) OVER periodos AS valor_final
     FROM despesas_por_operadora_tri
-    GROUP BY registro_ans
+    WINDOW periodos AS (
+        PARTITION BY registro_ans ORDER BY ano, trimestre
+        ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING
+    )
 ),
 valores AS (
     SELECT
-        p.registro_ans,
-        d_ini.razao_social,
-        d_ini.uf,
-        d_ini.valor_despesas AS valor_inicial,
-        d_fim.valor_despesas AS valor_final
-    FROM primeiro_ultimo_tri p
-    JOIN despesas_por_operadora_tri d_ini
-        ON d_ini.registro_ans = p.registro_ans
-       AND (d_ini.ano * 10 + d_ini.trimestre) = p.inicio_ref
-    JOIN despesas_por_operadora_tri d_fim
-        ON d_fim.registro_ans = p.registro_ans
-       AND (d_fim.ano * 10 + d_fim.trimestre) = p.fim_ref
-    WHERE d_ini.valor_despesas IS NOT NULL
-      AND d_ini.valor_despesas > 0
-      AND d_fim.valor_despesas IS NOT NULL
+        registro_ans,
+        valor_inicial,
+        valor_final
+    FROM primeiro_ultimo_tri
+    WHERE ordem = 1
+      AND qtd_trimestres >= 2
+      AND valor_inicial IS NOT NULL
+      AND valor_inicial > 0
+      AND valor_final IS NOT NULL
 )
 SELECT
-    registro_ans,
-    razao_social,
-    uf,
-    valor_inicial,
-    valor_final,
-    ((valor_final - valor_inicial) / valor_inicial) * 100 AS crescimento_percentual
-FROM valores
+    v.registro_ans,
+    o.razao_social,
+    o.uf,
+    v.valor_inicial,
+    v.valor_final,
+    ((v.valor_final - v.valor_inicial) / v.valor_inicial) * 100 AS crescimento_percentual
+FROM valores v
+LEFT JOIN operadoras o
+    ON o.registro_ans = v.registro_ans
 ORDER BY crescimento_percentual DESC
 LIMIT 5;
 
@@ -1,39 +1,312 @@
 from __future__ import annotations
 
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Iterable
 import zipfile
 
+import numpy as np
 import pandas as pd
 
+from armazenamento import (
+    COLUNAS_PARTICAO,
+    EscritorTabela,
+    arquivos_da_tabela,
+    eh_tabela_parquet,
+    iterar_tabela,
+    particao_do_arquivo,
+    salvar_tabela,
+    tipar_colunas,
+)
 
-def agregar_despesas(caminho_enriquecido: Path, caminho_saida: Path) -> None:
-    # Lê o CSV enriquecido (já com CNPJ, RazaoSocial, UF, Ano, Trimestre, ValorDespesas) e gera um CSV agregado por RazaoSocial e UF, contendo: - RazaoSocial - UF - TotalDespesas - MediaDespesas - DesvioPadraoDespesas
-    df = pd.read_csv(caminho_enriquecido, encoding="utf-8")
 
-    # Verificações básicas
-    for col in ["RazaoSocial", "UF", "ValorDespesas"]:
-        if col not in df.columns:
-            raise ValueError(f"Coluna obrigatória ausente no enriquecido: {col}")
+# Chaves dos grupos da tabela agregada (despesas_agregadas)
+CHAVES_AGREGACAO = ("RazaoSocial", "UF")
+# Colunas de estado da tabela de estados por partição, depois das colunas de chave (ver salvar_estados)
+COLUNAS_ESTADO = ["Contagem", "Soma", "Compensacao", "Media", "M2"]
 
-    # Garante que o valor é numérico
-    df["ValorDespesas"] = pd.to_numeric(df["ValorDespesas"], errors="coerce")
-    df = df[df["ValorDespesas"].notna()]
+# Lote padrão da agregação: ela sempre lê a tabela em streaming, guardando só o estado por grupo.
+# O resultado não depende do tamanho do lote (as linhas de cada grupo são somadas na ordem da tabela).
+LINHAS_POR_LOTE_AGREGACAO = 500_000
+# Abaixo desse número de grupos com linhas restantes, a agregação de um lote deixa de andar em passos vetorizados
+# (um passo por posição dentro do grupo) e termina cada grupo num laço simples (ver EstadoGrupos._acumular_em_ordem)
+GRUPOS_POR_PASSO = 16
 
-    # Agrupamento por RazaoSocial + UF
-    grupo = df.groupby(["RazaoSocial", "UF"])["ValorDespesas"]
 
-    agregados = grupo.agg(["sum", "mean", "std"]).reset_index()
-    agregados.rename(
-        columns={
-            "sum": "TotalDespesas",
-            "mean": "MediaDespesas",
-            "std": "DesvioPadraoDespesas",
-        },
-        inplace=True,
-    )
+def _sem_na(valores: list) -> list:
+    return [None if valor is pd.NA else valor for valor in valores]
 
-    caminho_saida.parent.mkdir(parents=True, exist_ok=True)
-    agregados.to_csv(caminho_saida, index=False, encoding="utf-8")
+
+class EstadoGrupos:
+    # Estado parcial da agregação de ValorDespesas por grupo de colunas_chave (por padrão RazaoSocial, UF), em arrays indexados pelo id inteiro do grupo: contagem, soma com a compensação da soma de Kahan, e média e M2 (soma dos quadrados dos desvios em relação à média) do algoritmo de Welford. São exatamente os acumuladores do groupby().agg(["sum", "mean", "std"]) do pandas, atualizados linha a linha na ordem da tabela, então agregar a tabela em qualquer número de lotes dá o mesmo resultado, bit a bit, do groupby sobre a tabela inteira. A memória é O(grupos). Estados de partes independentes da tabela são combinados com combinar, sem reler os dados. Com manter_nulos, uma chave nula forma um grupo próprio em vez de tirar a linha da agregação.
+
+    def __init__(self, colunas_chave: tuple[str, ...] = CHAVES_AGREGACAO, manter_nulos: bool = False):
+        self.colunas_chave = tuple(colunas_chave)
+        self.manter_nulos = manter_nulos
+        self.chaves: list[tuple] = []
+        self._ids: dict[tuple, int] = {}
+        self.contagem = np.zeros(0, dtype=np.int64)
+        self.soma = np.zeros(0, dtype=np.float64)
+        self.compensacao = np.zeros(0, dtype=np.float64)
+        self.media = np.zeros(0, dtype=np.float64)
+        self.m2 = np.zeros(0, dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.chaves)
+
+    def _ids_das_chaves(self, chaves: list[tuple]) -> np.ndarray:
+        # Ids dos grupos, registrando (com estado zerado) os que ainda não existem.
+        ids = np.empty(len(chaves), dtype=np.int64)
+        for i, chave in enumerate(chaves):
+            id_grupo = self._ids.get(chave)
+            if id_grupo is None:
+                id_grupo = self._ids[chave] = len(self.chaves)
+                self.chaves.append(chave)
+            ids[i] = id_grupo
+
+        novos = len(self.chaves) - len(self.contagem)
+        if novos:
+            self.contagem = np.concatenate([self.contagem, np.zeros(novos, dtype=np.int64)])
+            for nome in ("soma", "compensacao", "media", "m2"):
+                setattr(self, nome, np.concatenate([getattr(self, nome), np.zeros(novos, dtype=np.float64)]))
+        return ids
+
+    def _acumular_em_ordem(self, ids: np.ndarray, locais: np.ndarray, valores: np.ndarray) -> None:
+        # Soma as linhas (grupo local em locais, valor) ao estado na ordem dada, sendo ids o id no estado de cada grupo local, com as mesmas contas do groupby do pandas (soma de Kahan; média e M2 de Welford). As linhas são numeradas pela posição dentro do grupo e processadas por posição: cada passo atualiza de uma vez a k-ésima linha de todos os grupos que a têm. Com os grupos do maior para o menor, esses grupos são sempre os primeiros, e cada passo opera em fatias contíguas. Quando sobram poucos grupos (o final dos maiores), um passo vetorizado custa mais do que as contas em si, e o resto de cada grupo é somado com floats do Python (as mesmas operações IEEE).
+        tamanhos = np.bincount(locais, minlength=len(ids))
+        por_tamanho = np.argsort(-tamanhos, kind="stable")
+        # Menor tipo inteiro que cabe os grupos locais: o argsort estável de inteiros pequenos é um radix sort
+        posicao_grupo = np.empty(len(ids), dtype=np.min_scalar_type(len(ids)))
+        posicao_grupo[por_tamanho] = np.arange(len(ids))
+        locais = posicao_grupo[locais]
+        grupos = ids[por_tamanho]
+        tamanhos = tamanhos[por_tamanho]
+
+        # Linhas agrupadas (do maior grupo ao menor, cada grupo na ordem das linhas) e posição de cada linha no grupo
+        ordem = np.argsort(locais, kind="stable")
+        inicios = np.cumsum(tamanhos) - tamanhos
+        posicoes = np.empty(len(locais), dtype=np.int64)
+        posicoes[ordem] = np.arange(len(locais)) - np.repeat(inicios, tamanhos)
+
+        contagem = self.contagem[grupos]
+        soma = self.soma[grupos]
+        compensacao = self.compensacao[grupos]
+        media = self.media[grupos]
+        m2 = self.m2[grupos]
+        # Como no pandas: com valores infinitos a compensação vira NaN e é zerada
+        infinitos = not np.isfinite(valores).all()
+
+        ativos = np.bincount(posicoes)
+        passos = int((ativos > GRUPOS_POR_PASSO).sum())
+        linhas = np.flatnonzero(posicoes < passos)
+        linhas = linhas[np.argsort(posicoes[linhas] * len(grupos) + locais[linhas], kind="stable")]
+        limites = np.r_[0, np.cumsum(ativos[:passos])]
+        for k in range(passos):
+            n = ativos[k]
+            valor = valores[linhas[limites[k]:limites[k + 1]]]
+
+            s = soma[:n]
+            c = compensacao[:n]
+            corrigido = valor - c
+            nova_soma = s + corrigido
+            np.subtract(nova_soma, s, out=c)
+            c -= corrigido
+            if infinitos:
+                c[np.isnan(c)] = 0.0
+            s[...] = nova_soma
+
+            contagem[:n] += 1
+            m = media[:n]
+            desvio = valor - m
+            m += desvio / contagem[:n]
+            m2[:n] += (valor - m) * desvio
+
+        for g in range(len(grupos)):
+            if tamanhos[g] <= passos:
+                break
+            s, c, n, m, q = float(soma[g]), float(compensacao[g]), int(contagem[g]), float(media[g]), float(m2[g])
+            for valor in valores[ordem[inicios[g] + passos:inicios[g] + tamanhos[g]]].tolist():
+                corrigido = valor - c
+                nova_soma = s + corrigido
+                c = nova_soma - s - corrigido
+                if c != c:
+                    c = 0.0
+                s = nova_soma
+                n += 1
+                desvio = valor - m
+                m = m + desvio / n
+                q = q + (valor - m) * desvio
+            soma[g], compensacao[g], contagem[g], media[g], m2[g] = s, c, n, m, q
+
+        self.contagem[grupos] = contagem
+        self.soma[grupos] = soma
+        self.compensacao[grupos] = compensacao
+        self.media[grupos] = media
+        self.m2[grupos] = m2
+
+    def _somar(self, ids: np.ndarray, outro: "EstadoGrupos") -> None:
+        # Combina o estado de outro (grupos ids no estado atual, na ordem de outro.chaves, sem repetição) no estado atual. Grupos novos recebem o estado de outro como está; nos demais a soma de outro (já corrigida pela compensação dela) entra como mais um termo da soma de Kahan, e média e M2 seguem a fórmula de Chan et al.: M2 = M2a + M2b + delta² * na * nb / n, com delta a diferença entre as médias.
+        novos = self.contagem[ids] == 0
+        for nome in ("contagem", "soma", "compensacao", "media", "m2"):
+            getattr(self, nome)[ids[novos]] = getattr(outro, nome)[novos]
+
+        ids = ids[~novos]
+        n_b = outro.contagem[~novos]
+        if not len(ids):
+            return
+        n_a = self.contagem[ids]
+        n = n_a + n_b
+
+        soma = self.soma[ids]
+        corrigido = (outro.soma[~novos] - outro.compensacao[~novos]) - self.compensacao[ids]
+        nova_soma = soma + corrigido
+        compensacao = nova_soma - soma - corrigido
+        compensacao[np.isnan(compensacao)] = 0.0
+        self.soma[ids] = nova_soma
+        self.compensacao[ids] = compensacao
+
+        delta = outro.media[~novos] - self.media[ids]
+        self.media[ids] += delta * n_b / n
+        self.m2[ids] += outro.m2[~novos] + delta * delta * (n_a * n_b / n)
+        self.contagem[ids] = n
+
+    def acumular(self, lote: pd.DataFrame) -> None:
+        # Soma um lote da tabela validada ao estado, continuando as somas de cada grupo na ordem das linhas. Linhas com ValorDespesas nulo ficam de fora; com chave nula também (como no groupby do pandas), a menos que manter_nulos. Dentro do lote cada coluna de chave vira códigos inteiros (factorize), combinados num código único por grupo.
+        for col in (*self.colunas_chave, "ValorDespesas"):
+            if col not in lote.columns:
+                raise ValueError(f"Coluna obrigatória ausente no enriquecido: {col}")
+
+        valores = pd.to_numeric(lote["ValorDespesas"], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+        fatorados = [pd.factorize(lote[col], use_na_sentinel=not self.manter_nulos) for col in self.colunas_chave]
+
+        validas = ~np.isnan(valores)
+        for codigos_coluna, _ in fatorados:
+            validas &= codigos_coluna >= 0
+        if not validas.any():
+            return
+        valores = valores[validas]
+        codigos = np.zeros(len(valores), dtype=np.int64)
+        for codigos_coluna, distintos in fatorados:
+            codigos = codigos * len(distintos) + codigos_coluna[validas]
+        grupos, codigos_locais = pd.factorize(codigos)
+
+        # Desfaz o código combinado, da última coluna de chave para a primeira
+        colunas: list[list] = []
+        resto = codigos_locais
+        for _, distintos in reversed(fatorados):
+            colunas.append(_sem_na(distintos.take(resto % len(distintos)).tolist()))
+            resto = resto // len(distintos)
+        chaves = list(zip(*reversed(colunas)))
+        self._acumular_em_ordem(self._ids_das_chaves(chaves), grupos, valores)
+
+    def combinar(self, outro: "EstadoGrupos") -> None:
+        # Combina o estado de uma parte independente da tabela (ex.: outra partição). Só combinar com um estado vazio é exato: nos demais casos o resultado difere do groupby sobre as duas partes juntas no último dígito do float (a soma sequencial do pandas não se reparte em somas parciais).
+        self._somar(self._ids_das_chaves(outro.chaves), outro)
+
+    def _tabela_chaves(self) -> pd.DataFrame:
+        # Uma linha por grupo, com as colunas de chave nos tipos de ESQUEMA_COLUNAS.
+        return tipar_colunas(pd.DataFrame(self.chaves, columns=list(self.colunas_chave), dtype=object))
+
+    def como_tabela_estado(self) -> pd.DataFrame:
+        tabela = self._tabela_chaves()
+        tabela["Contagem"] = self.contagem
+        tabela["Soma"] = self.soma
+        tabela["Compensacao"] = self.compensacao
+        tabela["Media"] = self.media
+        tabela["M2"] = self.m2
+        return tabela
+
+    @classmethod
+    def de_tabela_estado(
+        cls,
+        df: pd.DataFrame,
+        colunas_chave: tuple[str, ...] = CHAVES_AGREGACAO,
+        manter_nulos: bool = False,
+    ) -> "EstadoGrupos":
+        estado = cls(colunas_chave, manter_nulos)
+        estado._ids_das_chaves(list(zip(*(_sem_na(df[col].tolist()) for col in estado.colunas_chave))))
+        estado.contagem = df["Contagem"].to_numpy(dtype=np.int64, copy=True)
+        estado.soma = df["Soma"].to_numpy(dtype=np.float64, copy=True)
+        estado.compensacao = df["Compensacao"].to_numpy(dtype=np.float64, copy=True)
+        estado.media = df["Media"].to_numpy(dtype=np.float64, copy=True)
+        estado.m2 = df["M2"].to_numpy(dtype=np.float64, copy=True)
+        return estado
+
+    def como_dataframe(self) -> pd.DataFrame:
+        # Tabela agregada, com as mesmas colunas, ordem (pelas colunas de chave) e valores do groupby().agg(["sum", "mean", "std"]): média = soma / contagem (como no pandas, não a média de Welford) e desvio padrão amostral (ddof=1), nulo para grupos de uma linha.
+        agregados = self._tabela_chaves()
+        agregados["TotalDespesas"] = self.soma
+        agregados["MediaDespesas"] = self.soma / np.maximum(self.contagem, 1)
+        agregados["DesvioPadraoDespesas"] = np.sqrt(
+            np.divide(self.m2, self.contagem - 1, out=np.full(len(self), np.nan), where=self.contagem > 1)
+        )
+        return agregados.sort_values(list(self.colunas_chave), ignore_index=True)
+
+
+def _estado_da_tabela(
+    caminho: Path,
+    linhas_por_lote: int,
+    colunas_chave: tuple[str, ...] = CHAVES_AGREGACAO,
+    manter_nulos: bool = False,
+) -> EstadoGrupos:
+    estado = EstadoGrupos(colunas_chave, manter_nulos)
+    for lote in iterar_tabela(caminho, linhas_por_lote, colunas=[*colunas_chave, "ValorDespesas"]):
+        estado.acumular(lote)
+    return estado
+
+
+def calcular_estados_por_particao(
+    caminho_enriquecido: Path,
+    linhas_por_lote: int | None = None,
+    workers: int | None = None,
+    colunas_chave: tuple[str, ...] = CHAVES_AGREGACAO,
+    manter_nulos: bool = False,
+) -> list[tuple[tuple, EstadoGrupos]]:
+    # Estado da agregação de cada partição (Ano, Trimestre) da tabela, na ordem das partições, numa única leitura em lotes. Com workers > 1, cada arquivo de partição é agregado num processo do pool. O padrão é um processo só: com poucas partições (três trimestres) subir o pool custa mais do que agregar.
+    linhas_por_lote = linhas_por_lote or LINHAS_POR_LOTE_AGREGACAO
+    if not eh_tabela_parquet(caminho_enriquecido):
+        return [((), _estado_da_tabela(caminho_enriquecido, linhas_por_lote, colunas_chave, manter_nulos))]
+
+    arquivos = arquivos_da_tabela(caminho_enriquecido)
+    workers = min(workers or 1, max(len(arquivos), 1))
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parciais = list(executor.map(
+                _estado_da_tabela,
+                arquivos,
+                [linhas_por_lote] * len(arquivos),
+                [colunas_chave] * len(arquivos),
+                [manter_nulos] * len(arquivos),
+            ))
+    else:
+        parciais = [_estado_da_tabela(arquivo, linhas_por_lote, colunas_chave, manter_nulos) for arquivo in arquivos]
+
+    return [(particao_do_arquivo(caminho_enriquecido, arquivo), parcial) for arquivo, parcial in zip(arquivos, parciais)]
+
+
+def calcular_estado_grupos(caminho_enriquecido: Path, linhas_por_lote: int | None = None) -> EstadoGrupos:
+    # Estado da agregação da tabela inteira, lida em lotes na ordem de ler_tabela. Os grupos atravessam as partições, então a tabela é lida num processo só: estados de partições calculados à parte não se combinam no resultado exato do groupby (ver EstadoGrupos.combinar).
+    return _estado_da_tabela(caminho_enriquecido, linhas_por_lote or LINHAS_POR_LOTE_AGREGACAO)
+
+
+def salvar_estados(estados: Iterable[tuple[tuple, EstadoGrupos]], caminho: Path) -> None:
+    # Grava os estados por partição como tabela Parquet particionada por Ano/Trimestre (colunas de chave e COLUNAS_ESTADO), um arquivo por partição, com os floats sem perda.
+    with EscritorTabela(caminho) as escritor:
+        for particao, estado in estados:
+            df = estado.como_tabela_estado()
+            for coluna, valor in zip(COLUNAS_PARTICAO, particao):
+                df[coluna] = valor
+            escritor.escrever(df)
+
+
+def agregar_despesas(
+    caminho_enriquecido: Path,
+    caminho_saida: Path,
+    linhas_por_lote: int | None = None,
+) -> None:
+    # Lê a tabela enriquecida (já com CNPJ, RazaoSocial, UF, Ano, Trimestre, ValorDespesas) e gera uma tabela agregada (Parquet ou CSV, conforme caminho_saida) por RazaoSocial e UF, contendo: - RazaoSocial - UF - TotalDespesas - MediaDespesas - DesvioPadraoDespesas. A leitura é feita em lotes (ver EstadoGrupos): a memória depende do número de grupos, não do tamanho da tabela, e os valores são os mesmos do groupby sobre a tabela inteira.
+    salvar_tabela(calcular_estado_grupos(caminho_enriquecido, linhas_por_lote).como_dataframe(), caminho_saida)
 
 
 def gerar_zip_final(final_dir: Path, zip_path: Path) -> None:
@@ -1,25 +1,55 @@
+import json
+import os
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Iterable
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 BASE_URL = "https://dadosabertos.ans.gov.br/FTP/PDA/"
 DEMO_SUBDIR = "demonstracoes_contabeis/"
 
+# Quantidade padrão de downloads simultâneos (e de conexões no pool HTTP)
+MAX_CONEXOES_PADRAO = 4
+TAMANHO_CHUNK_DOWNLOAD = 1024 * 1024
+SUFIXO_PARCIAL = ".part"
+SUFIXO_METADADOS = ".meta.json"
 
-def _get_soup(url: str) -> BeautifulSoup:
-    # Faz um GET e devolve um BeautifulSoup com o HTML da página.
-    resp = requests.get(url)
+# Índice persistido das listagens do FTP (ano -> trimestre -> URLs)
+NOME_INDICE_LISTAGEM = "indice_listagem.json"
+TTL_INDICE_SEGUNDOS = 6 * 60 * 60
+TTL_INDICE_ANOS_FECHADOS_SEGUNDOS = 30 * 24 * 60 * 60
+
+
+def _parser_html() -> str:
+    # Usa o lxml (parser em C, bem mais rápido) quando estiver instalado; senão cai no html.parser da biblioteca padrão.
+    try:
+        import lxml  # noqa: F401
+    except ImportError:
+        return "html.parser"
+    return "lxml"
+
+
+PARSER_HTML = _parser_html()
+
+
+def _get_soup(url: str, sessao: requests.Session | None = None) -> BeautifulSoup:
+    # Faz um GET e devolve um BeautifulSoup com o HTML da página. As listagens do FTP só têm links relevantes, então parseamos apenas as tags <a>.
+    resp = (sessao or requests).get(url, timeout=(10, 60))
     resp.raise_for_status()
     html = resp.text
-    return BeautifulSoup(html, "html.parser")
+    return BeautifulSoup(html, PARSER_HTML, parse_only=SoupStrainer("a"))
 
 
-def acesso_demonstracoes_contabeis() -> str | None:
+def acesso_demonstracoes_contabeis(sessao: requests.Session | None = None) -> str | None:
     # Acessa a URL principal da ANS e retorna a URL completa da pasta 'demonstracoes_contabeis/'.
     url = BASE_URL
-    soup = _get_soup(url)
+    soup = _get_soup(url, sessao)
     links = soup.find_all("a")
 
     for link in links:
@@ -31,9 +61,9 @@ def acesso_demonstracoes_contabeis() -> str | None:
     return None
 
 
-def listar_anos(url_pasta_demonstracoes: str) -> list[int]:
+def listar_anos(url_pasta_demonstracoes: str, sessao: requests.Session | None = None) -> list[int]:
     # Recebe a URL da pasta demonstracoes_contabeis/ e retorna uma lista de anos disponíveis.
-    soup = _get_soup(url_pasta_demonstracoes)
+    soup = _get_soup(url_pasta_demonstracoes, sessao)
     year_links = soup.find_all("a")
 
     anos: list[int] = []
@@ -52,10 +82,14 @@ def listar_anos(url_pasta_demonstracoes: str) -> list[int]:
     return anos
 
 
-def _listar_zips_de_ano(url_pasta_demonstracoes: str, ano: int) -> list[tuple[int, int, str]]:
+def _listar_zips_de_ano(
+    url_pasta_demonstracoes: str,
+    ano: int,
+    sessao: requests.Session | None = None,
+) -> list[tuple[int, int, str]]:
     # Lista arquivos .zip de um determinado ano, tentando identificar o trimestre pelo nome. Retorna lista de tuplas: (ano, trimestre, url_zip) onde trimestre é 1, 2, 3 ou 4.
     ano_url = f"{url_pasta_demonstracoes}{ano}/"
-    soup = _get_soup(ano_url)
+    soup = _get_soup(ano_url, sessao)
     links = soup.find_all("a")
 
     resultados: list[tuple[int, int, str]] = []
@@ -90,63 +124,336 @@ def _listar_zips_de_ano(url_pasta_demonstracoes: str, ano: int) -> list[tuple[in
     return resultados
 
 
+def _carregar_indice(caminho_indice: Path | None, url_pasta_demonstracoes: str) -> dict:
+    # Lê o índice persistido de listagens (ano -> trimestre -> URLs). Descarta o índice se ele foi gerado para outra URL base.
+    if caminho_indice is None or not caminho_indice.exists():
+        return {}
+
+    try:
+        with open(caminho_indice, "r", encoding="utf-8") as f:
+            indice = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if indice.get("url") != url_pasta_demonstracoes:
+        return {}
+
+    return indice.get("anos", {})
+
+
+def _salvar_indice(caminho_indice: Path, url_pasta_demonstracoes: str, anos: dict) -> None:
+    caminho_indice.parent.mkdir(parents=True, exist_ok=True)
+    temporario = caminho_indice.with_name(caminho_indice.name + ".tmp")
+    with open(temporario, "w", encoding="utf-8") as f:
+        json.dump({"url": url_pasta_demonstracoes, "anos": anos}, f, ensure_ascii=False, indent=2)
+    os.replace(temporario, caminho_indice)
+
+
+def _entrada_valida(entrada: dict | None, ano: int, ano_mais_recente: int, agora: float, ttl_segundos: float) -> bool:
+    # Anos "fechados" (mais de um ano antes do mais recente) praticamente não mudam, então usam um TTL bem maior que os anos em andamento.
+    if not entrada:
+        return False
+
+    ttl = ttl_segundos if ano >= ano_mais_recente - 1 else TTL_INDICE_ANOS_FECHADOS_SEGUNDOS
+    return agora - entrada.get("listado_em", 0) < ttl
+
+
+def identificar_zips_por_trimestre(
+    url_pasta_demonstracoes: str,
+    caminho_indice: Path | None = None,
+    sessao: requests.Session | None = None,
+    max_conexoes: int = MAX_CONEXOES_PADRAO,
+    ttl_segundos: float = TTL_INDICE_SEGUNDOS,
+) -> dict[tuple[int, int], list[str]]:
+    # Varre os anos da pasta demonstracoes_contabeis do mais recente para o mais antigo, buscando as listagens em paralelo (em lotes de max_conexoes anos) e parando assim que encontra 3 trimestres distintos. Listagens ainda dentro do TTL são reaproveitadas do índice em caminho_indice, sem nova requisição. Retorna os 3 últimos trimestres (ano, trimestre), em ordem, com as URLs dos zips de cada um.
+    sessao = sessao or criar_sessao_http(max_conexoes)
+    anos = listar_anos(url_pasta_demonstracoes, sessao)
+    if not anos:
+        return {}
+
+    indice = _carregar_indice(caminho_indice, url_pasta_demonstracoes)
+    agora = time.time()
+    ano_mais_recente = anos[-1]
+
+    def _listar(ano: int) -> dict:
+        trimestres: dict[str, list[str]] = {}
+        for _, tri, zip_url in _listar_zips_de_ano(url_pasta_demonstracoes, ano, sessao):
+            trimestres.setdefault(str(tri), []).append(zip_url)
+        return {"listado_em": agora, "trimestres": trimestres}
 
-def identificar_zips_ultimos_tres_trimestres(url_pasta_demonstracoes: str) -> list[str]:
-    # Varrre todos os anos da pasta demonstracoes_contabeis, encontra zips por trimestre e identifica quais são os zips dos 3 trimestres mais recentes. Retorna uma lista de URLs de zips dos 3 últimos trimestres.
-    anos = listar_anos(url_pasta_demonstracoes)
     todos: list[tuple[int, int, str]] = []
+    trimestres_encontrados: set[tuple[int, int]] = set()
+
+    with ThreadPoolExecutor(max_workers=max_conexoes) as executor:
+        pendentes = sorted(anos, reverse=True)
+        while pendentes and len(trimestres_encontrados) < 3:
+            lote, pendentes = pendentes[:max_conexoes], pendentes[max_conexoes:]
+
+            a_buscar = [
+                ano for ano in lote
+                if not _entrada_valida(indice.get(str(ano)), ano, ano_mais_recente, agora, ttl_segundos)
+            ]
+            for ano, entrada in zip(a_buscar, executor.map(_listar, a_buscar)):
+                indice[str(ano)] = entrada
 
-    for ano in anos:
-        todos.extend(_listar_zips_de_ano(url_pasta_demonstracoes, ano))
+            for ano in lote:
+                for tri, urls in indice[str(ano)]["trimestres"].items():
+                    trimestres_encontrados.add((ano, int(tri)))
+                    todos.extend((ano, int(tri), url) for url in urls)
+
+    if caminho_indice is not None:
+        _salvar_indice(caminho_indice, url_pasta_demonstracoes, indice)
 
     if not todos:
-        return []
+        return {}
 
     todos.sort(key=lambda t: (t[0], t[1]))
 
-    # Pega os 3 últimos "trimestres distintos"
-    trimestres_ordenados = [(ano, tri) for ano, tri, _ in todos]
-    trimestres_unicos: list[tuple[int, int]] = []
-    for ano, tri in trimestres_ordenados:
-        if (ano, tri) not in trimestres_unicos:
-            trimestres_unicos.append((ano, tri))
+    # Pega os 3 últimos "trimestres distintos" e todos os zips que pertencem a eles
+    urls_por_trimestre: dict[tuple[int, int], list[str]] = {
+        trimestre: [] for trimestre in sorted(trimestres_encontrados)[-3:]
+    }
+    for ano, tri, zip_url in todos:
+        if (ano, tri) in urls_por_trimestre:
+            urls_por_trimestre[(ano, tri)].append(zip_url)
+
+    return urls_por_trimestre
+
+
+def identificar_zips_ultimos_tres_trimestres(
+    url_pasta_demonstracoes: str,
+    caminho_indice: Path | None = None,
+    sessao: requests.Session | None = None,
+    max_conexoes: int = MAX_CONEXOES_PADRAO,
+    ttl_segundos: float = TTL_INDICE_SEGUNDOS,
+) -> list[str]:
+    # Retorna uma lista de URLs de zips dos 3 últimos trimestres (ver identificar_zips_por_trimestre).
+    urls_por_trimestre = identificar_zips_por_trimestre(
+        url_pasta_demonstracoes, caminho_indice, sessao, max_conexoes, ttl_segundos
+    )
+    return [url for urls in urls_por_trimestre.values() for url in urls]
+
+
+def criar_sessao_http(max_conexoes: int = MAX_CONEXOES_PADRAO) -> requests.Session:
+    # Cria uma requests.Session com pool de conexões do tamanho de max_conexoes e retentativas automáticas (backoff exponencial) para erros transitórios do servidor da ANS.
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET", "HEAD"),
+    )
+    adapter = HTTPAdapter(pool_connections=max_conexoes, pool_maxsize=max_conexoes, max_retries=retry)
+
+    sessao = requests.Session()
+    sessao.mount("https://", adapter)
+    sessao.mount("http://", adapter)
+    return sessao
+
+
+def _caminho_metadados(caminho: Path) -> Path:
+    return caminho.with_name(caminho.name + SUFIXO_METADADOS)
+
+
+def _ler_metadados(caminho: Path) -> dict:
+    # Lê o arquivo de metadados (ETag, Last-Modified, Content-Length) guardado ao lado do arquivo baixado. Retorna {} se não existir ou estiver corrompido.
+    try:
+        with open(_caminho_metadados(caminho), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _salvar_metadados(caminho: Path, metadados: dict) -> None:
+    # Grava os metadados de forma atômica (arquivo temporário + replace), para não deixar JSON pela metade se o processo for interrompido.
+    destino = _caminho_metadados(caminho)
+    temporario = destino.with_name(destino.name + ".tmp")
+    with open(temporario, "w", encoding="utf-8") as f:
+        json.dump(metadados, f, ensure_ascii=False, indent=2)
+    os.replace(temporario, destino)
+
+
+def descartar_validadores(destino_raw: Path, *arquivos: Path) -> None:
+    # Apaga os metadados dos downloads (ETag/Last-Modified) em destino_raw e dos arquivos indicados, e o índice de listagens: o próximo download relista o FTP e baixa tudo de novo, sem requisições condicionais (--force download).
+    for metadados in destino_raw.glob(f"*{SUFIXO_METADADOS}"):
+        metadados.unlink()
+    for arquivo in arquivos:
+        _caminho_metadados(arquivo).unlink(missing_ok=True)
+    (destino_raw / NOME_INDICE_LISTAGEM).unlink(missing_ok=True)
+
+
+def _metadados_da_resposta(url: str, resp: requests.Response) -> dict:
+    # Extrai da resposta HTTP os campos usados para downloads condicionais e retomada.
+    tamanho = resp.headers.get("Content-Length")
+    if resp.status_code == 206:
+        # Em respostas parciais o tamanho total vem em Content-Range: "bytes 100-199/1234"
+        content_range = resp.headers.get("Content-Range", "")
+        tamanho = content_range.rsplit("/", 1)[-1] if "/" in content_range else None
+
+    return {
+        "url": url,
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "content_length": int(tamanho) if tamanho and tamanho.isdigit() else None,
+    }
+
+
+def _mesma_versao(anterior: dict, atual: dict) -> bool:
+    # Compara duas versões do mesmo arquivo remoto. ETag tem prioridade; sem ETag, usa Last-Modified + Content-Length.
+    if anterior.get("url") != atual.get("url"):
+        return False
+
+    if anterior.get("etag") and atual.get("etag"):
+        return anterior["etag"] == atual["etag"]
+
+    if not anterior.get("last_modified") or not atual.get("last_modified"):
+        return False
+
+    return (
+        anterior["last_modified"] == atual["last_modified"]
+        and anterior.get("content_length") == atual.get("content_length")
+    )
+
+
+def baixar_arquivo(sessao: requests.Session, url: str, caminho: Path) -> tuple[Path, str]:
+    # Baixa url para caminho de forma condicional e retomável. - Se o arquivo já existe completo e o servidor responde 304 (ou os metadados não mudaram), não baixa de novo. - Se existe um ".part" de uma execução interrompida, retoma com Range/If-Range. - O download é feito no ".part" e só é renomeado para o nome final quando termina. Retorna (caminho, status), onde status é "inalterado", "retomado" ou "baixado".
+    parcial = caminho.with_name(caminho.name + SUFIXO_PARCIAL)
+    anteriores = _ler_metadados(caminho)
+
+    headers: dict[str, str] = {}
+    retomando = False
+
+    if caminho.exists() and anteriores.get("completo") and anteriores.get("url") == url:
+        # Arquivo completo em disco: pede só se mudou
+        if anteriores.get("etag"):
+            headers["If-None-Match"] = anteriores["etag"]
+        if anteriores.get("last_modified"):
+            headers["If-Modified-Since"] = anteriores["last_modified"]
+    elif parcial.exists() and anteriores.get("url") == url:
+        # Download interrompido: tenta continuar de onde parou, desde que o arquivo remoto seja o mesmo
+        validador = anteriores.get("etag") or anteriores.get("last_modified")
+        ja_baixado = parcial.stat().st_size
+        if validador and ja_baixado > 0:
+            headers["Range"] = f"bytes={ja_baixado}-"
+            headers["If-Range"] = validador
+            retomando = True
+
+    with sessao.get(url, headers=headers, stream=True, timeout=(10, 60)) as resp:
+        if resp.status_code == 304:
+            return caminho, "inalterado"
+
+        if retomando and resp.status_code == 416:
+            # Range fora do arquivo: o ".part" já estava completo (a execução anterior parou antes de renomear)
+            # ou é maior que o arquivo remoto. Confere o tamanho; se não bater, descarta e baixa de novo.
+            total = resp.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+            if total.isdigit() and int(total) == ja_baixado:
+                os.replace(parcial, caminho)
+                _salvar_metadados(caminho, {**anteriores, "content_length": ja_baixado, "completo": True})
+                return caminho, "retomado"
+            parcial.unlink()
+            return baixar_arquivo(sessao, url, caminho)
 
-    ultimos_tres = trimestres_unicos[-3:]
+        resp.raise_for_status()
+        atuais = _metadados_da_resposta(url, resp)
 
-    # Agora pega todos os zips que pertencem a esses 3 trimestres
-    urls_selecionadas: list[str] = []
-    for ano, tri, zip_url in todos:
-        if (ano, tri) in ultimos_tres:
-            urls_selecionadas.append(zip_url)
+        # Servidor ignorou os headers condicionais, mas a versão é a mesma: descarta o corpo
+        if "If-None-Match" in headers or "If-Modified-Since" in headers:
+            if _mesma_versao(anteriores, atuais) and caminho.stat().st_size == atuais.get("content_length"):
+                return caminho, "inalterado"
+
+        # 206 = servidor aceitou o Range; 200 = If-Range falhou (arquivo mudou) e veio o arquivo inteiro
+        retomado = retomando and resp.status_code == 206
+        _salvar_metadados(caminho, {**atuais, "completo": False})
+
+        with open(parcial, "ab" if retomado else "wb") as f:
+            for chunk in resp.iter_content(chunk_size=TAMANHO_CHUNK_DOWNLOAD):
+                if chunk:
+                    f.write(chunk)
+
+    tamanho_esperado = atuais.get("content_length")
+    if tamanho_esperado is not None and parcial.stat().st_size != tamanho_esperado:
+        raise IOError(
+            f"Download incompleto de {url}: {parcial.stat().st_size} de {tamanho_esperado} bytes. "
+            "Execute novamente para retomar."
+        )
+
+    os.replace(parcial, caminho)
+    _salvar_metadados(caminho, {**atuais, "completo": True})
+    return caminho, "retomado" if retomado else "baixado"
+
+
+def baixar_arquivos(
+    urls: list[str],
+    destino_raw: Path,
+    max_conexoes: int = MAX_CONEXOES_PADRAO,
+    sessao: requests.Session | None = None,
+) -> list[Path]:
+    # Baixa várias URLs em paralelo (uma thread por download, compartilhando o pool de conexões da sessão) para a pasta destino_raw. Retorna os caminhos na mesma ordem das URLs.
+    destino_raw.mkdir(parents=True, exist_ok=True)
+    if not urls:
+        return []
+
+    sessao = sessao or criar_sessao_http(max_conexoes)
 
-    return urls_selecionadas
+    def _baixar(url: str) -> tuple[Path, str]:
+        nome_arquivo = url.split("/")[-1]
+        return baixar_arquivo(sessao, url, destino_raw / nome_arquivo)
 
+    with ThreadPoolExecutor(max_workers=min(max_conexoes, len(urls))) as executor:
+        resultados = list(executor.map(_baixar, urls))
 
-def baixar_arquivos_dos_ultimos_tres_trimestres(destino_raw: Path) -> list[Path]:
-    # Descobre a URL da pasta de demonstracoes contabeis, identifica os zips dos 3 últimos trimestres e baixa todos para a pasta destino_raw. Retorna a lista de caminhos dos arquivos .zip baixados.
+    for caminho, status in resultados:
+        print(f"  {caminho.name}: {status}")
+
+    return [caminho for caminho, _ in resultados]
+
+
+def baixar_arquivos_dos_ultimos_tres_trimestres(
+    destino_raw: Path,
+    max_conexoes: int = MAX_CONEXOES_PADRAO,
+) -> list[Path]:
+    # Descobre a URL da pasta de demonstracoes contabeis, identifica os zips dos 3 últimos trimestres e baixa todos para a pasta destino_raw (em paralelo, pulando arquivos que não mudaram desde a última execução). Retorna a lista de caminhos dos arquivos .zip baixados.
     destino_raw.mkdir(parents=True, exist_ok=True)
 
-    url_demonstracoes = acesso_demonstracoes_contabeis()
+    sessao = criar_sessao_http(max_conexoes)
+
+    url_demonstracoes = acesso_demonstracoes_contabeis(sessao)
     if not url_demonstracoes:
         raise RuntimeError("Não foi possível localizar a pasta 'demonstracoes_contabeis'.")
 
-    zip_urls = identificar_zips_ultimos_tres_trimestres(url_demonstracoes)
-    caminhos: list[Path] = []
+    zip_urls = identificar_zips_ultimos_tres_trimestres(
+        url_demonstracoes,
+        caminho_indice=destino_raw / NOME_INDICE_LISTAGEM,
+        sessao=sessao,
+        max_conexoes=max_conexoes,
+    )
+    return baixar_arquivos(zip_urls, destino_raw, max_conexoes=max_conexoes, sessao=sessao)
+
+
+def baixar_arquivos_dos_trimestres_novos(
+    destino_raw: Path,
+    trimestres_existentes: Iterable[tuple[int, int]],
+    max_conexoes: int = MAX_CONEXOES_PADRAO,
+) -> dict[tuple[int, int], list[Path]]:
+    # Como baixar_arquivos_dos_ultimos_tres_trimestres, mas só baixa os zips dos trimestres que não estão em trimestres_existentes (usado pela ingestão incremental). Retorna os 3 últimos trimestres, em ordem, com os zips baixados de cada um (lista vazia para os já existentes).
+    destino_raw.mkdir(parents=True, exist_ok=True)
+    existentes = set(trimestres_existentes)
 
-    for zip_url in zip_urls:
-        nome_arquivo = zip_url.split("/")[-1]
-        caminho = destino_raw / nome_arquivo
+    sessao = criar_sessao_http(max_conexoes)
 
-        resp = requests.get(zip_url, stream=True)
-        resp.raise_for_status()
-        with open(caminho, "wb") as f:
-            for chunk in resp.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-
-        caminhos.append(caminho)
+    url_demonstracoes = acesso_demonstracoes_contabeis(sessao)
+    if not url_demonstracoes:
+        raise RuntimeError("Não foi possível localizar a pasta 'demonstracoes_contabeis'.")
 
-    return caminhos
+    urls_por_trimestre = identificar_zips_por_trimestre(
+        url_demonstracoes,
+        caminho_indice=destino_raw / NOME_INDICE_LISTAGEM,
+        sessao=sessao,
+        max_conexoes=max_conexoes,
+    )
+    return {
+        trimestre: [] if trimestre in existentes else baixar_arquivos(urls, destino_raw, max_conexoes=max_conexoes, sessao=sessao)
+        for trimestre, urls in urls_por_trimestre.items()
+    }
 
 
 if __name__ == "__main__":
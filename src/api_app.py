@@ -1,23 +1,62 @@
 from __future__ import annotations
 
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import os
+import sys
+import threading
 from pathlib import Path
-from typing import List, Optional
+from typing import Iterator, List, Optional
 
+import numpy as np
 import pandas as pd
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
+# A API roda como "uvicorn src.api_app:app"; os módulos da pipeline usam imports absolutos a partir de src/
+SRC_DIR = Path(__file__).resolve().parent
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+from armazenamento import ler_tabela  # noqa: E402
+from busca import IndiceBusca, somente_digitos  # noqa: E402
+from cubo import DIMENSOES_CUBO, consultar_cubo  # noqa: E402
+from motor_analitico import NOMES_ANALISES, carregar_analises, executar_analise  # noqa: E402
+from snapshot_api import (  # noqa: E402
+    COLUNAS_DESPESAS_API,
+    COLUNAS_OPERADORA,
+    DadosApi,
+    carregar_dados_api,
+    montar_dados_api,
+    snapshot_disponivel,
+)
+
 
-BASE_DIR = Path(__file__).resolve().parent.parent
+BASE_DIR = SRC_DIR.parent
 DATA_DIR = BASE_DIR / "data"
 PROCESSED_DIR = DATA_DIR / "processed"
 FINAL_DIR = DATA_DIR / "final"
 
-# Usamos o consolidado VALIDADO gerado pelo main.py
+# Usamos o consolidado VALIDADO gerado pelo main.py (tabelas Parquet; os CSVs ficam como fallback)
+CONSOLIDADO_ENRIQUECIDO = PROCESSED_DIR / "consolidado_enriquecido_validado.parquet"
+DESPESAS_AGREGADAS = PROCESSED_DIR / "despesas_agregadas.parquet"
 CONSOLIDADO_ENRIQUECIDO_CSV = PROCESSED_DIR / "consolidado_enriquecido_validado.csv"
 DESPESAS_AGREGADAS_CSV = FINAL_DIR / "despesas_agregadas.csv"
 
+# Snapshot binário gerado pela pipeline (etapa snapshot_api), aberto com mmap; sem ele, a API monta
+# os mesmos dados a partir das tabelas acima
+SNAPSHOT_API = PROCESSED_DIR / "api_snapshot"
+
+# Banco SQLite gerado pela pipeline (etapa analises) onde rodam as queries de sql/analytics.sql
+BANCO_ANALITICO = PROCESSED_DIR / "analises.sqlite"
+
+# Cubo UF x Modalidade x Ano x Trimestre gerado pela pipeline (etapa cubo), consultado em /api/cubo
+CUBO_DESPESAS = PROCESSED_DIR / "cubo_despesas.parquet"
+
 
 # -------------------------------------------------
 # Modelos de resposta (Pydantic)
@@ -50,14 +89,40 @@ class DespesaItem(BaseModel):
 class EstatisticasResponse(BaseModel):
     total_despesas: float
     media_despesas: float
-    top5_operadoras: List[OperadoraDetalhe]
+    top_operadoras: List[OperadoraDetalhe]
+    # Nome antigo do ranking, mantido só para top_n=5 (o padrão): nulo nos demais
+    top5_operadoras: Optional[List[OperadoraDetalhe]] = None
+
+
+class AnaliseResponse(BaseModel):
+    nome: str
+    linhas: List[dict]
+
+
+class CelulaCubo(BaseModel):
+    # Dimensões consolidadas (fora de "dimensoes") ficam como None
+    uf: Optional[str] = None
+    modalidade: Optional[str] = None
+    ano: Optional[int] = None
+    trimestre: Optional[int] = None
+    quantidade: int
+    total_despesas: float
+    media_despesas: Optional[float] = None
+    desvio_padrao_despesas: Optional[float] = None
+
+
+class CuboResponse(BaseModel):
+    dimensoes: List[str]
+    celulas: List[CelulaCubo]
 
 
 class PaginatedResponse(BaseModel):
     data: List[OperadoraResumo]
-    page: int
+    # Nulo na paginação por cursor, que ignora page
+    page: Optional[int] = None
     limit: int
-    total: int
+    total: Optional[int] = None
+    next_cursor: Optional[str] = None
 
 
 # -------------------------------------------------
@@ -85,36 +150,465 @@ app.add_middleware(
 # Carregamento dos dados em memória
 # -------------------------------------------------
 
+# Intervalo (segundos) entre verificações de novas saídas da pipeline; 0 desliga a verificação periódica
+# (com API_ADMIN_TOKEN definido, a recarga continua disponível via POST /api/admin/recarregar)
+INTERVALO_RECARGA_SEGUNDOS = float(os.environ.get("API_INTERVALO_RECARGA", "60"))
+
+# Quantas buscas distintas (posições/níveis do resultado) cada snapshot guarda para paginar sem refazer a busca
+MAX_BUSCAS_EM_CACHE = 256
+
+# POST /api/admin/recarregar exige o header X-Admin-Token com este valor; sem ele definido, a rota responde 404
+TOKEN_ADMIN = os.environ.get("API_ADMIN_TOKEN")
+
+
+def _primeiro_existente(*caminhos: Path) -> Path:
+    for caminho in caminhos:
+        if caminho.exists():
+            return caminho
+    raise RuntimeError(f"Arquivo não encontrado: {caminhos[0]}")
+
+
+def _caminhos_dados() -> tuple[Path, ...]:
+    # Arquivos de onde o snapshot é montado (e dos quais sai a versão dos dados).
+    if snapshot_disponivel(SNAPSHOT_API):
+        return (SNAPSHOT_API,)
+    return (
+        _primeiro_existente(CONSOLIDADO_ENRIQUECIDO, CONSOLIDADO_ENRIQUECIDO_CSV),
+        _primeiro_existente(DESPESAS_AGREGADAS, DESPESAS_AGREGADAS_CSV),
+    )
+
+
+class SnapshotDados:
+    # Tudo o que a API serve para uma versão dos arquivos da pipeline: as tabelas (no formato compacto de compactar_dados) e todos os índices derivados. É montado por inteiro antes de ser publicado e não muda depois (só os caches de busca e de estatísticas por top_n são preenchidos sob demanda), então uma requisição usa o mesmo snapshot do início ao fim, mesmo que outro seja publicado no meio.
+
+    def __init__(self, versao: str, dados: DadosApi):
+        # Custo proporcional ao número de operadoras: as despesas e o histórico ficam nas colunas de DadosApi (mapeadas em memória quando vêm do snapshot binário).
+        self.versao = versao
+        self.operadoras = dados.operadoras
+        self.despesas = dados.despesas
+        self.df_agregado = dados.agregado
+        self.historico = dados.historico
+        self._inicio_despesas = dados.inicio_despesas
+        self._inicio_historico = dados.inicio_historico
+
+        # Uma linha por CNPJ (RazaoSocial/Modalidade/UF), já ordenada; a paginação só fatia esta tabela
+        codigos_cnpj = self.operadoras["CNPJ"].cat.codes.to_numpy()
+        _, primeiros_ids = np.unique(codigos_cnpj, return_index=True)
+        self.df_operadoras = self.operadoras.iloc[primeiros_ids][COLUNAS_OPERADORA].reset_index(drop=True)
+        self.cnpjs_operadoras = self.df_operadoras["CNPJ"].to_numpy(dtype=object)
+
+        # Índice de busca (trigramas, sem acentos) alinhado às linhas de df_operadoras
+        self.indice_busca = IndiceBusca(self.df_operadoras["CNPJ"], self.df_operadoras["RazaoSocial"])
+        self._buscas: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+
+        # Índices por CNPJ (só dígitos): código do CNPJ (posição nas faixas) e detalhe pronto
+        self.codigo_cnpj = {somente_digitos(cnpj): codigo for codigo, cnpj in enumerate(self.operadoras["CNPJ"].cat.categories)}
+        self.detalhes_operadora = _montar_detalhes_operadoras(self.operadoras, self.df_agregado)
+
+        # Estatísticas materializadas (ETag de /api/estatisticas = versao)
+        self.total_despesas = dados.total_despesas
+        self.media_despesas = dados.media_despesas
+        # (RazaoSocial, UF) -> (CNPJ, Modalidade) da primeira linha da operadora no consolidado
+        self.representantes_agregado = _montar_representantes(self.operadoras)
+        self._estatisticas_por_top_n: dict[int, EstatisticasResponse] = {}
+
+    def linhas_operadora(self, cnpj: str) -> Optional[pd.DataFrame]:
+        # Linhas de despesas de uma operadora (CNPJ com ou sem máscara), via faixa pré-calculada.
+        codigo = self.codigo_cnpj.get(somente_digitos(cnpj))
+        if codigo is None:
+            return None
+        return self.despesas.iloc[self._inicio_despesas[codigo] : self._inicio_despesas[codigo + 1]]
+
+    def historico_operadora(self, cnpj: str) -> Optional[List[DespesaItem]]:
+        # Histórico trimestral pré-calculado (Ano/Trimestre/soma de ValorDespesas) de uma operadora.
+        codigo = self.codigo_cnpj.get(somente_digitos(cnpj))
+        if codigo is None:
+            return None
+        trecho = self.historico.iloc[self._inicio_historico[codigo] : self._inicio_historico[codigo + 1]]
+        return [
+            DespesaItem(ano=int(ano), trimestre=int(trimestre), valor_despesas=float(valor))
+            for ano, trimestre, valor in zip(
+                trecho["Ano"].tolist(), trecho["Trimestre"].tolist(), trecho["ValorDespesas"].tolist()
+            )
+        ]
+
+    def buscar(self, busca: str) -> tuple[np.ndarray, np.ndarray]:
+        # Resultado da busca (posições em df_operadoras e nível de relevância), em cache por consulta.
+        resultado = self._buscas.get(busca)
+        if resultado is None:
+            if len(self._buscas) >= MAX_BUSCAS_EM_CACHE:
+                self._buscas.clear()
+            resultado = self.indice_busca.buscar_com_niveis(busca)
+            self._buscas[busca] = resultado
+        return resultado
+
+    def estatisticas(self, top_n: int) -> EstatisticasResponse:
+        resultado = self._estatisticas_por_top_n.get(top_n)
+        if resultado is None:
+            resultado = _montar_estatisticas(self, top_n)
+            self._estatisticas_por_top_n[top_n] = resultado
+        return resultado
+
+
+def montar_snapshot() -> SnapshotDados:
+    # Abre o snapshot binário da pipeline (mmap, custo de milissegundos) ou, se ele não existir, lê as tabelas e monta os mesmos dados em memória. Falha se os arquivos mudarem durante a leitura (pipeline gravando), para não publicar uma mistura de duas versões.
+    caminhos = _caminhos_dados()
+    versao = _versao_dados(*caminhos)
+
+    if caminhos == (SNAPSHOT_API,):
+        dados = carregar_dados_api(SNAPSHOT_API)
+    else:
+        caminho_enriquecido, caminho_agregado = caminhos
+        dados = montar_dados_api(ler_tabela(caminho_enriquecido, colunas=COLUNAS_DESPESAS_API), ler_tabela(caminho_agregado))
+
+    if _versao_dados(*_caminhos_dados()) != versao:
+        raise RuntimeError("os arquivos de dados mudaram durante a leitura")
+
+    return SnapshotDados(versao, dados)
 
-df_enriquecido: Optional[pd.DataFrame] = None
-df_agregado: Optional[pd.DataFrame] = None
+
+class GerenciadorSnapshots:
+    # Publica snapshots e controla quantos ficam em memória. Cada requisição pega o snapshot atual com adquirir() e o devolve com liberar(). Ao publicar um novo, o anterior fica aposentado até a última requisição que o usa terminar, e a próxima recarga só começa a montar outro snapshot depois disso: nunca há mais de dois em memória.
+
+    def __init__(self):
+        self._condicao = threading.Condition()
+        self._recarga = threading.Lock()
+        self._atual: Optional[SnapshotDados] = None
+        self._aposentado: Optional[SnapshotDados] = None
+        self._em_uso: dict[int, int] = {}
+
+    @property
+    def atual(self) -> Optional[SnapshotDados]:
+        return self._atual
+
+    def adquirir(self) -> SnapshotDados:
+        with self._condicao:
+            snapshot = self._atual
+            if snapshot is None:
+                raise HTTPException(status_code=500, detail="Dados não carregados")
+            self._em_uso[id(snapshot)] = self._em_uso.get(id(snapshot), 0) + 1
+            return snapshot
+
+    def liberar(self, snapshot: SnapshotDados) -> None:
+        with self._condicao:
+            restantes = self._em_uso[id(snapshot)] - 1
+            if restantes:
+                self._em_uso[id(snapshot)] = restantes
+                return
+            del self._em_uso[id(snapshot)]
+            if snapshot is self._aposentado:
+                self._aposentado = None
+                self._condicao.notify_all()
+
+    def recarregar(self, forcar: bool = False) -> bool:
+        # Monta e publica um novo snapshot se os arquivos mudaram (ou sempre, com forcar). Retorna True se publicou. Só uma recarga roda por vez.
+        with self._recarga:
+            atual = self._atual
+            if not forcar and atual is not None and atual.versao == _versao_dados(*_caminhos_dados()):
+                return False
+
+            # Espera as requisições que ainda usam o snapshot aposentado antes de montar outro
+            with self._condicao:
+                while self._aposentado is not None:
+                    self._condicao.wait()
+
+            novo = montar_snapshot()
+
+            with self._condicao:
+                anterior = self._atual
+                self._atual = novo
+                if anterior is not None and id(anterior) in self._em_uso:
+                    self._aposentado = anterior
+            return True
+
+
+snapshots = GerenciadorSnapshots()
+
+_parar_recarga = threading.Event()
+_pedido_recarga = threading.Event()
 
 
 def carregar_dados() -> None:
-    global df_enriquecido, df_agregado
+    snapshots.recarregar(forcar=True)
+
+
+def _laco_recarga() -> None:
+    # Roda numa thread: a cada INTERVALO_RECARGA_SEGUNDOS (ou quando o admin pede) verifica se a pipeline gerou novos arquivos e, se sim, publica um novo snapshot. Falhas mantêm o snapshot atual e são tentadas de novo na próxima volta.
+    intervalo = INTERVALO_RECARGA_SEGUNDOS if INTERVALO_RECARGA_SEGUNDOS > 0 else None
+    while not _parar_recarga.is_set():
+        _pedido_recarga.wait(intervalo)
+        forcar = _pedido_recarga.is_set()
+        _pedido_recarga.clear()
+        if _parar_recarga.is_set():
+            break
+
+        try:
+            if snapshots.recarregar(forcar=forcar):
+                print(f"[api] Dados recarregados (versão {snapshots.atual.versao}).")
+        except Exception as erro:
+            versao = snapshots.atual.versao if snapshots.atual is not None else "-"
+            print(f"[api] Falha ao recarregar os dados ({erro}); mantendo a versão {versao}.")
+
+
+def snapshot_atual() -> Iterator[SnapshotDados]:
+    # Dependência das rotas: o snapshot fica reservado até a resposta terminar.
+    snapshot = snapshots.adquirir()
+    try:
+        yield snapshot
+    finally:
+        snapshots.liberar(snapshot)
 
-    if not CONSOLIDADO_ENRIQUECIDO_CSV.exists():
-        raise RuntimeError(f"Arquivo não encontrado: {CONSOLIDADO_ENRIQUECIDO_CSV}")
 
-    if not DESPESAS_AGREGADAS_CSV.exists():
-        raise RuntimeError(f"Arquivo não encontrado: {DESPESAS_AGREGADAS_CSV}")
+class CacheAnalises:
+    # Resultados das queries de sql/analytics.sql, calculados na primeira requisição e guardados enquanto o banco analítico não mudar (a versão é a mesma assinatura de _versao_dados). As queries e o banco não fazem parte do snapshot: o banco é lido direto do disco, só para leitura.
+
+    def __init__(self):
+        self._trava = threading.Lock()
+        self._versao: Optional[str] = None
+        self._resultados: dict[str, List[dict]] = {}
+
+    def obter(self, nome: str) -> tuple[str, List[dict]]:
+        if not BANCO_ANALITICO.exists():
+            raise HTTPException(status_code=503, detail="Banco analítico não gerado; execute a pipeline (etapa analises)")
+
+        versao = _versao_dados(BANCO_ANALITICO)
+        with self._trava:
+            if versao != self._versao:
+                self._versao = versao
+                self._resultados = {}
+            linhas = self._resultados.get(nome)
+            if linhas is None:
+                linhas = executar_analise(BANCO_ANALITICO, nome, carregar_analises())
+                self._resultados[nome] = linhas
+        return versao, linhas
+
+
+analises = CacheAnalises()
+
+
+class CacheCubo:
+    # Células do cubo (etapa cubo da pipeline), lidas na primeira requisição e guardadas enquanto a tabela não mudar (mesma assinatura de _versao_dados). São poucas centenas de linhas: cada consulta consolida as células em memória, sem cache por consulta.
+
+    def __init__(self):
+        self._trava = threading.Lock()
+        self._versao: Optional[str] = None
+        self._celulas: Optional[pd.DataFrame] = None
+
+    def obter(self) -> tuple[str, pd.DataFrame]:
+        if not CUBO_DESPESAS.exists():
+            raise HTTPException(status_code=503, detail="Cubo de despesas não gerado; execute a pipeline (etapa cubo)")
+
+        versao = _versao_dados(CUBO_DESPESAS)
+        with self._trava:
+            if versao != self._versao:
+                self._celulas = ler_tabela(CUBO_DESPESAS)
+                self._versao = versao
+            return versao, self._celulas
+
+
+cubo = CacheCubo()
+
+# Nome de cada dimensão do cubo na API (parâmetros e campos de CelulaCubo)
+NOMES_DIMENSOES_API = {coluna.lower(): coluna for coluna in DIMENSOES_CUBO}
+
+
+def _versao_dados(*caminhos: Path) -> str:
+    # Versão dos dados carregados: hash de (caminho, tamanho, mtime) de cada arquivo das tabelas. Muda sempre que a pipeline regrava uma delas.
+    h = hashlib.blake2b(digest_size=8)
+    for caminho in caminhos:
+        arquivos = sorted(p for p in caminho.rglob("*") if p.is_file()) if caminho.is_dir() else [caminho]
+        for arquivo in arquivos:
+            stat = arquivo.stat()
+            h.update(f"{arquivo}|{stat.st_size}|{stat.st_mtime_ns}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+def _etag_confere(request: Request, etag: str) -> bool:
+    # If-None-Match: lista de ETags separadas por vírgula (fortes ou fracos, W/"...") ou "*". Comparação fraca, como manda o HTTP para GET: ignora o W/ e compara cada ETag inteiro com o atual.
+    cabecalho = request.headers.get("if-none-match")
+    if not cabecalho:
+        return False
+    for candidato in cabecalho.split(","):
+        candidato = candidato.strip()
+        if candidato == "*" or candidato.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def _texto_ou_none(valor: object) -> Optional[str]:
+    return None if pd.isna(valor) else str(valor)
+
+
+def _float_ou_none(valor: object) -> Optional[float]:
+    return None if pd.isna(valor) else float(valor)
 
-    df_enriquecido = pd.read_csv(CONSOLIDADO_ENRIQUECIDO_CSV, encoding="utf-8")
-    df_agregado = pd.read_csv(DESPESAS_AGREGADAS_CSV, encoding="utf-8")
 
-    # Normalizações básicas
-    for col in ("CNPJ", "RazaoSocial", "Modalidade", "UF"):
-        if col in df_enriquecido.columns:
-            df_enriquecido[col] = df_enriquecido[col].astype(str).str.strip()
+def _montar_detalhes_operadoras(operadoras: pd.DataFrame, df_ag: pd.DataFrame) -> dict[str, OperadoraDetalhe]:
+    # Detalhe de cada operadora (CNPJ só com dígitos -> OperadoraDetalhe). Os dados cadastrais vêm da primeira linha da operadora no consolidado e os agregados da primeira linha de RazaoSocial + UF na tabela agregada.
+    agregados: dict[tuple[str, str], tuple[float, Optional[float], Optional[float]]] = {}
+    colunas_ag = ["RazaoSocial", "UF", "TotalDespesas", "MediaDespesas", "DesvioPadraoDespesas"]
+    if not df_ag.empty:
+        for razao, uf, total, media, desvio in df_ag[colunas_ag].drop_duplicates(["RazaoSocial", "UF"]).itertuples(index=False):
+            agregados[(razao, uf)] = (float(total), _float_ou_none(media), _float_ou_none(desvio))
+
+    primeiras = operadoras.sort_values("PrimeiraLinha").drop_duplicates("CNPJ")
+
+    detalhes: dict[str, OperadoraDetalhe] = {}
+    for cnpj, razao, modalidade, uf in primeiras[COLUNAS_OPERADORA].itertuples(index=False):
+        total, media, desvio = agregados.get((razao, uf), (0.0, None, None))
+        detalhes[somente_digitos(cnpj)] = OperadoraDetalhe(
+            cnpj=cnpj,
+            razao_social=str(razao),
+            modalidade=_texto_ou_none(modalidade),
+            uf=_texto_ou_none(uf),
+            total_despesas=total,
+            media_despesas=media,
+            desvio_padrao_despesas=desvio,
+        )
+    return detalhes
+
+
+def _montar_representantes(operadoras: pd.DataFrame) -> dict[tuple[str, str], tuple[str, Optional[str]]]:
+    # CNPJ representativo de cada RazaoSocial + UF (usado no top-N das estatísticas): primeira linha no consolidado.
+    primeiras = operadoras.sort_values("PrimeiraLinha").drop_duplicates(["RazaoSocial", "UF"])
+    return {
+        (razao, uf): (cnpj, _texto_ou_none(modalidade))
+        for razao, uf, cnpj, modalidade in primeiras[["RazaoSocial", "UF", "CNPJ", "Modalidade"]].itertuples(index=False)
+    }
+
+
+def _indices_top_n(valores: np.ndarray, n: int) -> np.ndarray:
+    # Posições dos n maiores valores, em ordem decrescente (NaN por último), via seleção parcial (argpartition) em vez de ordenar tudo.
+    n = min(n, len(valores))
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+    chave = np.where(np.isnan(valores), -np.inf, valores)
+    selecionados = np.argpartition(-chave, n - 1)[:n]
+    return selecionados[np.lexsort((selecionados, -chave[selecionados]))]
+
+
+def _montar_estatisticas(snapshot: SnapshotDados, top_n: int) -> EstatisticasResponse:
+    df_agregado = snapshot.df_agregado
+    totais = df_agregado["TotalDespesas"].to_numpy(dtype=np.float64, na_value=np.nan)
+    top = df_agregado.iloc[_indices_top_n(totais, top_n)]
+
+    operadoras: List[OperadoraDetalhe] = []
+    for razao, uf, total, media, desvio in top[
+        ["RazaoSocial", "UF", "TotalDespesas", "MediaDespesas", "DesvioPadraoDespesas"]
+    ].itertuples(index=False):
+        cnpj, modalidade = snapshot.representantes_agregado.get((razao, uf), ("", None))
+        operadoras.append(
+            OperadoraDetalhe(
+                cnpj=cnpj,
+                razao_social=str(razao),
+                modalidade=modalidade,
+                uf=str(uf),
+                total_despesas=float(total),
+                media_despesas=_float_ou_none(media),
+                desvio_padrao_despesas=_float_ou_none(desvio),
+            )
+        )
+
+    return EstatisticasResponse(
+        total_despesas=snapshot.total_despesas,
+        media_despesas=snapshot.media_despesas,
+        top_operadoras=operadoras,
+        top5_operadoras=operadoras if top_n == 5 else None,
+    )
 
-    for col in ("RazaoSocial", "UF"):
-        if col in df_agregado.columns:
-            df_agregado[col] = df_agregado[col].astype(str).str.strip()
+
+def _mapeado_em_memoria(valores: np.ndarray) -> bool:
+    # True se o array (ou o array de que ele é view) vem de np.load(..., mmap_mode="r").
+    while valores is not None:
+        if isinstance(valores, np.memmap):
+            return True
+        valores = valores.base
+    return False
+
+
+def relatorio_memoria(snapshot: SnapshotDados) -> dict:
+    # Bytes por coluna (memory_usage deep) das tabelas do snapshot.
+    tabelas = {
+        "operadoras": snapshot.operadoras,
+        "despesas": snapshot.despesas,
+        "agregado": snapshot.df_agregado,
+        "listagem_operadoras": snapshot.df_operadoras,
+        "historico": snapshot.historico,
+    }
+    relatorio: dict = {
+        "versao": snapshot.versao,
+        "mapeado_em_memoria": _mapeado_em_memoria(snapshot.despesas["ValorDespesas"].to_numpy()),
+        "tabelas": {},
+        "total_bytes": 0,
+    }
+    for nome, df in tabelas.items():
+        uso = df.memory_usage(index=True, deep=True)
+        relatorio["tabelas"][nome] = {
+            "linhas": len(df),
+            "colunas": {str(col): {"dtype": str(df[col].dtype), "bytes": int(uso[col])} for col in df.columns},
+            "indice_bytes": int(uso["Index"]),
+            "total_bytes": int(uso.sum()),
+        }
+        relatorio["total_bytes"] += int(uso.sum())
+    return relatorio
+
+
+def _codificar_cursor(versao: str, busca: str, nivel: int, cnpj: str, proxima: int) -> str:
+    # Cursor opaco: chave de ordenação (nível de relevância, CNPJ) da última operadora entregue, a versão dos dados, a busca e a posição da próxima linha nessa versão.
+    dados = json.dumps({"v": versao, "q": busca, "n": nivel, "c": cnpj, "p": proxima}, separators=(",", ":"), ensure_ascii=False)
+    return base64.urlsafe_b64encode(dados.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decodificar_cursor(cursor: str) -> dict:
+    try:
+        dados = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8"))
+        if not (
+            isinstance(dados, dict)
+            and isinstance(dados.get("v"), str)
+            and isinstance(dados.get("q"), str)
+            and isinstance(dados.get("n"), int)
+            and isinstance(dados.get("c"), str)
+            and isinstance(dados.get("p"), int)
+            and dados["p"] >= 0
+        ):
+            raise ValueError(cursor)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    return dados
+
+
+def _inicio_apos_chave(cnpjs: np.ndarray, niveis: Optional[np.ndarray], nivel: int, cnpj: str) -> int:
+    # Primeira posição da listagem cuja chave (nível, CNPJ) vem depois da chave do cursor. Sem busca a listagem é ordenada só por CNPJ (busca binária); com busca, por nível e CNPJ.
+    if niveis is None:
+        return int(np.searchsorted(cnpjs, cnpj, side="right"))
+    depois = (niveis > nivel) | ((niveis == nivel) & (cnpjs > cnpj))
+    return int(np.argmax(depois)) if depois.any() else len(cnpjs)
+
+
+def _operadoras_resumo(df: pd.DataFrame) -> List[OperadoraResumo]:
+    # Serializa usando os arrays das colunas (zip), sem iterrows.
+    return [
+        OperadoraResumo(cnpj=cnpj, razao_social=razao, modalidade=_texto_ou_none(modalidade), uf=_texto_ou_none(uf))
+        for cnpj, razao, modalidade, uf in zip(
+            df["CNPJ"].tolist(),
+            df["RazaoSocial"].tolist(),
+            df["Modalidade"].tolist(),
+            df["UF"].tolist(),
+        )
+    ]
 
 
 @app.on_event("startup")
 def on_startup() -> None:
     carregar_dados()
+    _parar_recarga.clear()
+    threading.Thread(target=_laco_recarga, name="recarga-dados", daemon=True).start()
+
+
+@app.on_event("shutdown")
+def on_shutdown() -> None:
+    _parar_recarga.set()
+    _pedido_recarga.set()
 
 
 # -------------------------------------------------
@@ -127,198 +621,246 @@ def listar_operadoras(
     page: int = Query(1, ge=1),
     limit: int = Query(10, ge=1, le=100),
     busca: Optional[str] = Query(None, description="Busca por CNPJ ou Razão Social"),
+    cursor: Optional[str] = Query(None, description="next_cursor da página anterior (substitui page)"),
+    com_total: bool = Query(True, description="Incluir o total de operadoras da listagem"),
+    snapshot: SnapshotDados = Depends(snapshot_atual),
 ):
     """
-    Lista operadoras com paginação (offset-based).
-    Busca opcional por CNPJ ou Razão Social.
+    Lista operadoras com paginação por página (page/limit) ou por cursor (keyset).
+    Busca opcional por CNPJ ou Razão Social, sem diferenciar acentos e maiúsculas.
+    Com busca, os resultados vêm por relevância: CNPJ exato > prefixo > substring.
+
+    Toda resposta traz next_cursor (None na última página). Passando-o em cursor,
+    a próxima página continua depois da última operadora entregue, com o mesmo
+    custo em qualquer profundidade e sem pular ou repetir operadoras se os dados
+    forem recarregados entre uma página e outra. Com cursor, page é ignorado e vem nulo.
     """
-    if df_enriquecido is None:
-        raise HTTPException(status_code=500, detail="Dados não carregados")
-
-    df = df_enriquecido.copy()
-
-    # Agrupa por CNPJ + RazaoSocial + Modalidade + UF para ter uma linha por operadora
-    df_grouped = (
-        df.groupby(["CNPJ", "RazaoSocial", "Modalidade", "UF"], dropna=False)
-        .size()
-        .reset_index()
-        .rename(columns={0: "qtd_registros"})
-    )
+    busca = busca or ""
 
     if busca:
-        busca_lower = busca.lower()
-        df_grouped = df_grouped[
-            df_grouped["CNPJ"].str.lower().str.contains(busca_lower)
-            | df_grouped["RazaoSocial"].str.lower().str.contains(busca_lower)
-        ]
-
-    total = len(df_grouped)
+        posicoes, niveis = snapshot.buscar(busca)
+        cnpjs = snapshot.cnpjs_operadoras[posicoes]
+    else:
+        posicoes, niveis = None, None
+        cnpjs = snapshot.cnpjs_operadoras
+
+    if cursor:
+        dados = _decodificar_cursor(cursor)
+        if dados["q"] != busca:
+            raise HTTPException(status_code=400, detail="Cursor não corresponde à busca informada")
+        # A posição só vale na mesma versão e se apontar logo depois do CNPJ do cursor; senão, busca pela chave
+        p = dados["p"]
+        if dados["v"] == snapshot.versao and 0 < p <= len(cnpjs) and str(cnpjs[p - 1]) == dados["c"]:
+            inicio = p
+        else:
+            inicio = _inicio_apos_chave(cnpjs, niveis, dados["n"], dados["c"])
+    else:
+        inicio = (page - 1) * limit
 
-    offset = (page - 1) * limit
-    df_page = df_grouped.iloc[offset : offset + limit]
+    fim = min(inicio + limit, len(cnpjs))
+    inicio = min(inicio, fim)
+    pagina = posicoes[inicio:fim] if posicoes is not None else slice(inicio, fim)
+    df_page = snapshot.df_operadoras.iloc[pagina]
 
-    data = [
-        OperadoraResumo(
-            cnpj=row["CNPJ"],
-            razao_social=row["RazaoSocial"],
-            modalidade=row.get("Modalidade"),
-            uf=row.get("UF"),
-        )
-        for _, row in df_page.iterrows()
-    ]
+    next_cursor = None
+    if fim < len(cnpjs) and fim > inicio:
+        nivel = int(niveis[fim - 1]) if niveis is not None else 0
+        next_cursor = _codificar_cursor(snapshot.versao, busca, nivel, str(cnpjs[fim - 1]), fim)
 
     return PaginatedResponse(
-        data=data,
-        page=page,
+        data=_operadoras_resumo(df_page),
+        page=None if cursor else page,
         limit=limit,
-        total=total,
+        total=len(cnpjs) if com_total else None,
+        next_cursor=next_cursor,
     )
 
 
-@app.get("/api/operadoras/{cnpj}", response_model=OperadoraDetalhe)
-def detalhar_operadora(cnpj: str):
+@app.get("/api/operadoras/sugestoes", response_model=List[OperadoraResumo])
+def sugerir_operadoras(
+    q: str = Query(..., min_length=1, description="Trecho da Razão Social ou do CNPJ"),
+    k: int = Query(10, ge=1, le=50),
+    snapshot: SnapshotDados = Depends(snapshot_atual),
+):
     """
-    Retorna detalhes de uma operadora específica, incluindo dados agregados de despesas.
+    Autocompletar: retorna as k operadoras mais relevantes para o trecho digitado.
     """
-    if df_enriquecido is None or df_agregado is None:
-        raise HTTPException(status_code=500, detail="Dados não carregados")
+    return _operadoras_resumo(snapshot.df_operadoras.iloc[snapshot.indice_busca.sugerir(q, k)])
 
-    # Normaliza CNPJ
-    cnpj_str = str(cnpj).strip()
 
-    df_op = df_enriquecido[df_enriquecido["CNPJ"] == cnpj_str]
-    if df_op.empty:
+# As rotas por CNPJ usam {cnpj:path} para aceitar o CNPJ mascarado ("12.345.678/0001-90").
+# A rota de histórico vem antes da de detalhe, senão "{cnpj:path}" capturaria o "/despesas".
+@app.get("/api/operadoras/{cnpj:path}/despesas", response_model=List[DespesaItem])
+def historico_despesas_operadora(cnpj: str, snapshot: SnapshotDados = Depends(snapshot_atual)):
+    """
+    Retorna histórico de despesas (Ano/Trimestre/Valor) de uma operadora.
+    """
+    historico = snapshot.historico_operadora(cnpj)
+    if historico is None:
         raise HTTPException(status_code=404, detail="Operadora não encontrada")
 
-    # Usa primeira linha como base de dados cadastrais
-    base = df_op.iloc[0]
-
-    # Pega agregados pela RazaoSocial + UF
-    razao = base["RazaoSocial"]
-    uf = base["UF"]
+    return historico
 
-    df_ag = df_agregado[
-        (df_agregado["RazaoSocial"] == razao) & (df_agregado["UF"] == uf)
-    ]
 
-    if df_ag.empty:
-        total = 0.0
-        media = None
-        desvio = None
-    else:
-        ag = df_ag.iloc[0]
-        total = float(ag["TotalDespesas"])
-        media = float(ag["MediaDespesas"]) if not pd.isna(ag["MediaDespesas"]) else None
-        desvio = (
-            float(ag["DesvioPadraoDespesas"])
-            if not pd.isna(ag["DesvioPadraoDespesas"])
-            else None
-        )
+@app.get("/api/operadoras/{cnpj:path}", response_model=OperadoraDetalhe)
+def detalhar_operadora(cnpj: str, snapshot: SnapshotDados = Depends(snapshot_atual)):
+    """
+    Retorna detalhes de uma operadora específica, incluindo dados agregados de despesas.
+    """
+    # CNPJ normalizado para dígitos: aceita "12.345.678/0001-90" e "12345678000190"
+    detalhe = snapshot.detalhes_operadora.get(somente_digitos(cnpj))
+    if detalhe is None:
+        raise HTTPException(status_code=404, detail="Operadora não encontrada")
 
-    return OperadoraDetalhe(
-        cnpj=cnpj_str,
-        razao_social=str(base["RazaoSocial"]),
-        modalidade=str(base.get("Modalidade")) if "Modalidade" in base else None,
-        uf=str(base.get("UF")) if "UF" in base else None,
-        total_despesas=total,
-        media_despesas=media,
-        desvio_padrao_despesas=desvio,
-    )
+    return detalhe
 
 
-@app.get("/api/operadoras/{cnpj}/despesas", response_model=List[DespesaItem])
-def historico_despesas_operadora(cnpj: str):
-    """
-    Retorna histórico de despesas (Ano/Trimestre/Valor) de uma operadora.
+@app.get("/api/estatisticas", response_model=EstatisticasResponse)
+def estatisticas(
+    request: Request,
+    response: Response,
+    top_n: int = Query(5, ge=1, le=100, description="Quantidade de operadoras no ranking"),
+    snapshot: SnapshotDados = Depends(snapshot_atual),
+):
     """
-    if df_enriquecido is None:
-        raise HTTPException(status_code=500, detail="Dados não carregados")
+    Retorna estatísticas agregadas:
+    - total geral de despesas
+    - média geral
+    - top N operadoras (por TotalDespesas, via tabela agregada; campo top_operadoras,
+      repetido em top5_operadoras quando top_n=5, por compatibilidade)
 
-    cnpj_str = str(cnpj).strip()
+    Calculadas uma vez por versão dos dados e servidas da memória. O ETag muda
+    quando os dados mudam; If-None-Match com o ETag atual responde 304.
+    """
+    etag = f'"{snapshot.versao}-{top_n}"'
+    if _etag_confere(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
 
-    df_op = df_enriquecido[df_enriquecido["CNPJ"] == cnpj_str]
-    if df_op.empty:
-        raise HTTPException(status_code=404, detail="Operadora não encontrada")
+    response.headers["ETag"] = etag
+    return snapshot.estatisticas(top_n)
 
-    # Faz um agrupamento por ano/trimestre somando ValorDespesas
-    df_hist = (
-        df_op.groupby(["Ano", "Trimestre"])["ValorDespesas"]
-        .sum()
-        .reset_index()
-        .sort_values(["Ano", "Trimestre"])
-    )
 
-    itens = [
-        DespesaItem(
-            ano=int(row["Ano"]),
-            trimestre=int(row["Trimestre"]),
-            valor_despesas=float(row["ValorDespesas"]),
-        )
-        for _, row in df_hist.iterrows()
-    ]
+@app.get("/api/analises", response_model=List[str])
+def listar_analises():
+    """
+    Nomes das análises de sql/analytics.sql disponíveis em /api/analises/{nome}.
+    """
+    return list(NOMES_ANALISES)
 
-    return itens
 
+@app.get("/api/analises/{nome}", response_model=AnaliseResponse)
+def analise(nome: str, request: Request, response: Response):
+    """
+    Executa uma query de sql/analytics.sql no banco analítico (SQLite) gerado pela pipeline:
+    - crescimento: top 5 operadoras por crescimento percentual entre o primeiro e o último trimestre
+    - despesas_por_uf: top 5 UFs por total de despesas, com média por operadora
+    - acima_da_media: operadoras acima da média geral em pelo menos 2 trimestres
 
-@app.get("/api/estatisticas", response_model=EstatisticasResponse)
-def estatisticas():
+    O resultado fica em cache até o banco ser regerado; If-None-Match com o ETag atual responde 304.
     """
-    Retorna estatísticas agregadas:
-    - total geral de despesas
-    - média geral
-    - top 5 operadoras (por TotalDespesas, via tabela agregada)
+    if nome not in NOMES_ANALISES:
+        raise HTTPException(status_code=404, detail=f"Análise desconhecida. Disponíveis: {', '.join(NOMES_ANALISES)}")
+
+    versao, linhas = analises.obter(nome)
+    etag = f'"{versao}-{nome}"'
+    if _etag_confere(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    response.headers["ETag"] = etag
+    return AnaliseResponse(nome=nome, linhas=linhas)
+
+
+@app.get("/api/cubo", response_model=CuboResponse)
+def consultar_cubo_despesas(
+    request: Request,
+    response: Response,
+    dimensoes: str = Query("", description="Dimensões do resultado, separadas por vírgula: uf, modalidade, ano, trimestre"),
+    uf: Optional[List[str]] = Query(None, description="Filtra pelas UFs indicadas (repetível)"),
+    modalidade: Optional[List[str]] = Query(None, description="Filtra pelas modalidades indicadas (repetível)"),
+    ano: Optional[List[int]] = Query(None, description="Filtra pelos anos indicados (repetível)"),
+    trimestre: Optional[List[int]] = Query(None, description="Filtra pelos trimestres indicados (repetível)"),
+):
     """
-    if df_enriquecido is None or df_agregado is None:
-        raise HTTPException(status_code=500, detail="Dados não carregados")
+    Consulta o cubo de despesas UF x Modalidade x Ano x Trimestre materializado pela pipeline.
 
-    # Total e média global
-    df_valid = df_enriquecido.copy()
-    df_valid["ValorDespesas"] = pd.to_numeric(
-        df_valid["ValorDespesas"], errors="coerce"
-    )
-    df_valid = df_valid[df_valid["ValorDespesas"].notna()]
-    total = float(df_valid["ValorDespesas"].sum())
-    media = float(df_valid["ValorDespesas"].mean()) if not df_valid.empty else 0.0
-
-    # Top 5 operadoras (usando agregados)
-    df_top5 = df_agregado.sort_values("TotalDespesas", ascending=False).head(5)
-
-    top5: List[OperadoraDetalhe] = []
-    for _, row in df_top5.iterrows():
-        razao = str(row["RazaoSocial"])
-        uf = str(row["UF"])
-
-        # tenta achar um CNPJ representativo para essa Razao/UF
-        df_match = df_enriquecido[
-            (df_enriquecido["RazaoSocial"] == razao)
-            & (df_enriquecido["UF"] == uf)
-        ]
-        if df_match.empty:
-            cnpj = ""
-            modalidade = None
-        else:
-            base = df_match.iloc[0]
-            cnpj = str(base["CNPJ"])
-            modalidade = str(base.get("Modalidade")) if "Modalidade" in base else None
+    Os filtros fatiam o cubo; as dimensões pedidas definem as linhas do resultado e as
+    demais são consolidadas (ex.: dimensoes=uf,ano&modalidade=Cooperativa Médica). Sem
+    dimensões, retorna o total. Quantidade, total, média e desvio padrão saem das
+    contagens/somas guardadas por célula, sem reler as despesas.
 
-        top5.append(
-            OperadoraDetalhe(
-                cnpj=cnpj,
-                razao_social=razao,
-                modalidade=modalidade,
-                uf=uf,
-                total_despesas=float(row["TotalDespesas"]),
-                media_despesas=float(row["MediaDespesas"])
-                if not pd.isna(row["MediaDespesas"])
-                else None,
-                desvio_padrao_despesas=float(row["DesvioPadraoDespesas"])
-                if not pd.isna(row["DesvioPadraoDespesas"])
-                else None,
-            )
+    O ETag muda quando o cubo é regerado; If-None-Match com o ETag atual responde 304.
+    """
+    nomes = [nome.strip().lower() for nome in dimensoes.split(",") if nome.strip()]
+    desconhecidas = [nome for nome in nomes if nome not in NOMES_DIMENSOES_API]
+    if desconhecidas:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Dimensões desconhecidas: {', '.join(desconhecidas)}. Disponíveis: {', '.join(NOMES_DIMENSOES_API)}",
+        )
+    nomes = list(dict.fromkeys(nomes))
+
+    filtros = {
+        NOMES_DIMENSOES_API[nome]: valores
+        for nome, valores in (
+            ("uf", [valor.strip().upper() for valor in uf] if uf else None),
+            ("modalidade", modalidade),
+            ("ano", ano),
+            ("trimestre", trimestre),
         )
+        if valores
+    }
+
+    versao, celulas = cubo.obter()
+    consulta = json.dumps([nomes, {coluna: sorted(valores) for coluna, valores in filtros.items()}], ensure_ascii=False)
+    etag = f'"{versao}-{hashlib.blake2b(consulta.encode("utf-8"), digest_size=8).hexdigest()}"'
+    if _etag_confere(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    resultado = consultar_cubo(celulas, [NOMES_DIMENSOES_API[nome] for nome in nomes], filtros)
+    linhas = []
+    for registro in resultado.to_dict("records"):
+        linhas.append(CelulaCubo(
+            uf=_texto_ou_none(registro["UF"]) if "uf" in nomes else None,
+            modalidade=_texto_ou_none(registro["Modalidade"]) if "modalidade" in nomes else None,
+            ano=None if "ano" not in nomes or pd.isna(registro["Ano"]) else int(registro["Ano"]),
+            trimestre=None if "trimestre" not in nomes or pd.isna(registro["Trimestre"]) else int(registro["Trimestre"]),
+            quantidade=int(registro["Contagem"]),
+            total_despesas=float(registro["TotalDespesas"]),
+            media_despesas=_float_ou_none(registro["MediaDespesas"]),
+            desvio_padrao_despesas=_float_ou_none(registro["DesvioPadraoDespesas"]),
+        ))
+
+    response.headers["ETag"] = etag
+    return CuboResponse(dimensoes=nomes, celulas=linhas)
+
+
+def exigir_token_admin(x_admin_token: Optional[str] = Header(None)) -> None:
+    # Rotas administrativas só existem com API_ADMIN_TOKEN definido (senão 404) e exigem o mesmo valor em X-Admin-Token (senão 403).
+    if not TOKEN_ADMIN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest((x_admin_token or "").encode("utf-8"), TOKEN_ADMIN.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Token de administração inválido")
+
+
+@app.post("/api/admin/recarregar", status_code=202, dependencies=[Depends(exigir_token_admin)])
+def solicitar_recarga():
+    """
+    Pede uma recarga imediata dos dados (mesmo sem mudança detectada nos arquivos).
+    O novo snapshot é montado em segundo plano e publicado quando estiver pronto;
+    até lá as requisições continuam sendo atendidas pela versão atual.
 
-    return EstatisticasResponse(
-        total_despesas=total,
-        media_despesas=media,
-        top5_operadoras=top5,
-    )
+    Só existe com API_ADMIN_TOKEN definido (senão responde 404) e exige o mesmo valor em X-Admin-Token.
+    """
+    _pedido_recarga.set()
+    atual = snapshots.atual
+    return {"status": "recarga agendada", "versao_atual": atual.versao if atual is not None else None}
+
+
+@app.get("/api/_debug/memory", dependencies=[Depends(exigir_token_admin)])
+def memoria(snapshot: SnapshotDados = Depends(snapshot_atual)):
+    """
+    Memória ocupada pelos dados do snapshot atual (bytes por coluna de cada tabela).
+
+    Mesma proteção de /api/admin/recarregar: só existe com API_ADMIN_TOKEN definido e exige X-Admin-Token.
+    """
+    return relatorio_memoria(snapshot)
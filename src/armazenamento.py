@@ -0,0 +1,276 @@
+from __future__ import annotations
+
+import os
+import shutil
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# Tipos de cada coluna conhecida da pipeline. Aplicados ao salvar e ao ler, para que CNPJ/RegistroANS
+# nunca virem número (e percam zeros à esquerda ou ganhem ".0") entre uma etapa e outra.
+ESQUEMA_COLUNAS: dict[str, str] = {
+    "RegistroANS": "string",
+    "CNPJ": "string",
+    "RazaoSocial": "string",
+    "Modalidade": "string",
+    "UF": "string",
+    "Ano": "Int16",
+    "Trimestre": "Int8",
+    "ValorDespesas": "float64",
+    "TotalDespesas": "float64",
+    "MediaDespesas": "float64",
+    "DesvioPadraoDespesas": "float64",
+}
+
+COLUNAS_PARTICAO = ("Ano", "Trimestre")
+VALOR_PARTICAO_NULO = "__NULL__"
+NOME_ARQUIVO_PARTE = "parte-00000.parquet"
+
+# Estimativa usada para converter um orçamento de memória em tamanho de lote no modo streaming
+BYTES_POR_LINHA_EM_TRANSITO = 2048
+
+
+def tipar_colunas(df: pd.DataFrame) -> pd.DataFrame:
+    # Converte as colunas conhecidas para o tipo definido em ESQUEMA_COLUNAS (colunas desconhecidas ficam como estão).
+    for col, tipo in ESQUEMA_COLUNAS.items():
+        if col not in df.columns:
+            continue
+        if tipo.startswith(("Int", "float")) and not pd.api.types.is_numeric_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], errors="coerce")
+        df[col] = df[col].astype(tipo)
+    return df
+
+
+def eh_tabela_parquet(caminho: Path) -> bool:
+    return caminho.suffix.lower() == ".parquet"
+
+
+def _valor_particao(valor: object) -> str:
+    return VALOR_PARTICAO_NULO if pd.isna(valor) else str(int(valor))
+
+
+def _ler_valor_particao(texto: str) -> int | None:
+    return None if texto == VALOR_PARTICAO_NULO else int(texto)
+
+
+def particao_do_arquivo(caminho: Path, arquivo: Path) -> tuple[int | None, ...]:
+    # Valores de partição (Ano, Trimestre) de um arquivo da tabela, lidos das pastas Ano=.../Trimestre=...; () para arquivos na raiz.
+    return tuple(_ler_valor_particao(parte.partition("=")[2]) for parte in arquivo.relative_to(caminho).parts[:-1])
+
+
+def _pasta_particao(caminho: Path, valores: tuple) -> Path:
+    return caminho.joinpath(*(f"{col}={_valor_particao(v)}" for col, v in zip(COLUNAS_PARTICAO, valores)))
+
+
+def arquivos_da_tabela(caminho: Path) -> list[Path]:
+    # Lista os arquivos .parquet de uma tabela em ordem de (Ano, Trimestre), com partições nulas por último.
+    if caminho.is_file():
+        return [caminho]
+
+    def _chave(arquivo: Path) -> tuple:
+        return tuple((1, 0) if numero is None else (0, numero) for numero in particao_do_arquivo(caminho, arquivo))
+
+    return sorted(caminho.rglob("*.parquet"), key=_chave)
+
+
+def particoes_da_tabela(caminho: Path) -> list[tuple[int | None, ...]]:
+    # (Ano, Trimestre) de cada partição de uma tabela Parquet, na ordem de arquivos_da_tabela. Tabela inexistente ou sem partições: lista vazia.
+    if not caminho.is_dir():
+        return []
+    return [particao_do_arquivo(caminho, arquivo) for arquivo in arquivos_da_tabela(caminho) if arquivo.parent != caminho]
+
+
+class EscritorTabela:
+    # Escreve uma tabela intermediária em partes (lotes de linhas), sem precisar ter a tabela inteira em memória. - caminho ".csv": CSV em UTF-8 (entregáveis) - caminho ".parquet": diretório Parquet particionado por Ano/Trimestre (quando as colunas existem), no formato Ano=2025/Trimestre=1/parte-00000.parquet, com um ParquetWriter aberto por partição. Tudo é escrito num diretório/arquivo temporário e trocado no fechamento, então quem lê nunca vê uma tabela pela metade. Uso: with EscritorTabela(caminho) as escritor: escritor.escrever(lote)
+
+    def __init__(self, caminho: Path, particionar: bool = True):
+        self.caminho = caminho
+        self.particionar = particionar
+        self.linhas = 0
+        self._temporario = caminho.with_name(caminho.name + ".tmp")
+        self._esquema: pa.Schema | None = None
+        self._escritores: dict[tuple, pq.ParquetWriter] = {}
+        self._ultimo_vazio: pd.DataFrame | None = None
+        self._csv_iniciado = False
+
+    def __enter__(self) -> "EscritorTabela":
+        self.caminho.parent.mkdir(parents=True, exist_ok=True)
+        remover_caminho(self._temporario)
+        if eh_tabela_parquet(self.caminho):
+            self._temporario.mkdir(parents=True)
+        return self
+
+    def escrever(self, df: pd.DataFrame) -> None:
+        df = tipar_colunas(df.copy())
+
+        if df.empty:
+            # Lotes vazios só importam se a tabela inteira for vazia (para preservar as colunas)
+            self._ultimo_vazio = df
+            return
+
+        self.linhas += len(df)
+
+        if not eh_tabela_parquet(self.caminho):
+            df.to_csv(self._temporario, mode="a", header=not self._csv_iniciado, index=False, encoding="utf-8")
+            self._csv_iniciado = True
+            return
+
+        if self._esquema is None:
+            self._esquema = pa.Schema.from_pandas(df, preserve_index=False)
+
+        colunas_particao = [c for c in COLUNAS_PARTICAO if c in df.columns] if self.particionar else []
+        if not colunas_particao:
+            self._escrever_particao((), df)
+            return
+
+        for valores, grupo in df.groupby(colunas_particao, dropna=False, sort=True):
+            if not isinstance(valores, tuple):
+                valores = (valores,)
+            particao = tuple(f"{col}={_valor_particao(v)}" for col, v in zip(colunas_particao, valores))
+            self._escrever_particao(particao, grupo)
+
+    def _escrever_particao(self, particao: tuple, df: pd.DataFrame) -> None:
+        escritor = self._escritores.get(particao)
+        if escritor is None:
+            pasta = self._temporario.joinpath(*particao)
+            pasta.mkdir(parents=True, exist_ok=True)
+            escritor = pq.ParquetWriter(pasta / NOME_ARQUIVO_PARTE, self._esquema)
+            self._escritores[particao] = escritor
+        escritor.write_table(pa.Table.from_pandas(df, schema=self._esquema, preserve_index=False))
+
+    def __exit__(self, tipo_erro, erro, traceback) -> None:
+        for escritor in self._escritores.values():
+            escritor.close()
+
+        if tipo_erro is not None:
+            # Falhou no meio: descarta o temporário e mantém a tabela anterior
+            remover_caminho(self._temporario)
+            return
+
+        if self.linhas == 0:
+            vazio = self._ultimo_vazio if self._ultimo_vazio is not None else pd.DataFrame()
+            if eh_tabela_parquet(self.caminho):
+                pq.write_table(pa.Table.from_pandas(vazio, preserve_index=False), self._temporario / NOME_ARQUIVO_PARTE)
+            else:
+                vazio.to_csv(self._temporario, index=False, encoding="utf-8")
+
+        antigo = self.caminho.with_name(self.caminho.name + ".old")
+        if self.caminho.exists():
+            remover_caminho(antigo)
+            os.replace(self.caminho, antigo)
+        os.replace(self._temporario, self.caminho)
+        remover_caminho(antigo)
+
+
+def remover_caminho(caminho: Path) -> None:
+    # Apaga um arquivo ou diretório (tabela particionada), se existir.
+    if caminho.is_dir():
+        shutil.rmtree(caminho)
+    elif caminho.exists():
+        caminho.unlink()
+
+
+def substituir_particoes(caminho: Path, novas: Path, remover: Iterable[tuple] = ()) -> None:
+    # Atualiza uma tabela Parquet particionada sem reescrevê-la: cada partição da tabela novas (gravada à parte com EscritorTabela) entra no lugar da partição de mesmo (Ano, Trimestre) em caminho, e as partições em remover são apagadas. Cada pasta de partição é trocada com os.replace; as demais partições ficam intactas. A tabela novas é consumida.
+    if not eh_tabela_parquet(caminho):
+        raise ValueError(f"Só tabelas Parquet particionadas podem ser atualizadas por partição: {caminho}")
+    caminho.mkdir(parents=True, exist_ok=True)
+
+    for arquivo in arquivos_da_tabela(novas):
+        if arquivo.parent == novas:
+            # Tabela sem linhas (arquivo único na raiz): não há partição a trocar
+            continue
+        destino = caminho / arquivo.parent.relative_to(novas)
+        destino.parent.mkdir(parents=True, exist_ok=True)
+        antigo = destino.with_name(destino.name + ".old")
+        remover_caminho(antigo)
+        if destino.exists():
+            os.replace(destino, antigo)
+        os.replace(arquivo.parent, destino)
+        remover_caminho(antigo)
+
+    for valores in remover:
+        pasta = _pasta_particao(caminho, valores)
+        remover_caminho(pasta)
+        if pasta.parent != caminho and pasta.parent.is_dir() and not any(pasta.parent.iterdir()):
+            pasta.parent.rmdir()
+
+    # Uma tabela que estava vazia é só um arquivo na raiz (ver EscritorTabela); com partições ele sobraria como linhas a mais
+    raiz = caminho / NOME_ARQUIVO_PARTE
+    if raiz.exists() and particoes_da_tabela(caminho):
+        raiz.unlink()
+    remover_caminho(novas)
+
+
+def salvar_tabela(df: pd.DataFrame, caminho: Path, particionar: bool = True) -> None:
+    # Salva um DataFrame inteiro como tabela intermediária (ver EscritorTabela para o formato).
+    with EscritorTabela(caminho, particionar=particionar) as escritor:
+        escritor.escrever(df)
+
+
+def ler_tabela(caminho: Path, colunas: Iterable[str] | None = None) -> pd.DataFrame:
+    # Lê uma tabela intermediária (diretório/arquivo Parquet ou CSV legado) já com os tipos de ESQUEMA_COLUNAS. Para Parquet, colunas limita as colunas lidas do disco.
+    colunas = list(colunas) if colunas is not None else None
+
+    if not eh_tabela_parquet(caminho):
+        texto = {col: "string" for col, tipo in ESQUEMA_COLUNAS.items() if tipo == "string"}
+        df = pd.read_csv(caminho, encoding="utf-8", dtype=texto, usecols=colunas)
+        return tipar_colunas(df)
+
+    arquivos = arquivos_da_tabela(caminho)
+    if not arquivos:
+        return pd.DataFrame(columns=colunas or [])
+
+    tabelas = [pq.read_table(arquivo, columns=colunas) for arquivo in arquivos]
+    df = pa.concat_tables(tabelas).to_pandas()
+    return tipar_colunas(df)
+
+
+def iterar_tabela(
+    caminho: Path,
+    linhas_por_lote: int,
+    colunas: Iterable[str] | None = None,
+) -> Iterator[pd.DataFrame]:
+    # Lê uma tabela intermediária em lotes de até linhas_por_lote linhas, na mesma ordem de ler_tabela, mantendo em memória só um lote por vez. Sempre produz pelo menos um lote (vazio, se a tabela for vazia), para que as colunas sejam conhecidas.
+    colunas = list(colunas) if colunas is not None else None
+
+    if not eh_tabela_parquet(caminho):
+        texto = {col: "string" for col, tipo in ESQUEMA_COLUNAS.items() if tipo == "string"}
+        algum = False
+        for lote in pd.read_csv(caminho, encoding="utf-8", dtype=texto, usecols=colunas, chunksize=linhas_por_lote):
+            algum = True
+            yield tipar_colunas(lote)
+        if not algum:
+            yield tipar_colunas(pd.read_csv(caminho, encoding="utf-8", dtype=texto, usecols=colunas))
+        return
+
+    arquivos = arquivos_da_tabela(caminho)
+    if not arquivos:
+        yield pd.DataFrame(columns=colunas or [])
+        return
+
+    algum = False
+    for arquivo in arquivos:
+        parquet = pq.ParquetFile(arquivo)
+        for lote in parquet.iter_batches(batch_size=linhas_por_lote, columns=colunas):
+            if lote.num_rows == 0:
+                continue
+            algum = True
+            yield tipar_colunas(lote.to_pandas())
+
+    if not algum:
+        yield tipar_colunas(pq.read_table(arquivos[0], columns=colunas).to_pandas())
+
+
+def linhas_por_lote_para_memoria(memoria_mb: float) -> int:
+    # Converte um orçamento de memória (MB) em tamanho de lote, usando uma estimativa conservadora de bytes por linha em trânsito (lote lido + cópias do merge/validação + lote escrito).
+    return max(int(memoria_mb * 1024 * 1024 / BYTES_POR_LINHA_EM_TRANSITO), 1_000)
+
+
+def exportar_csv(caminho_tabela: Path, caminho_csv: Path) -> None:
+    # Gera o CSV entregável a partir de uma tabela intermediária.
+    salvar_tabela(ler_tabela(caminho_tabela), caminho_csv)
@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+import pandas as pd
+
+from aggregation import agregar_despesas
+from armazenamento import ler_tabela, salvar_tabela
+from cubo import gerar_cubo
+from dados_sinteticos import ESCALA_MAXIMA, ESCALA_MINIMA, escala_argumento, gerar_dados_sinteticos
+from enrichment import construir_indice_cadastro, enriquecer_consolidado_com_cadastro
+from file_processing import identificar_arquivos_despesas, ler_e_normalizar_arquivos, listar_membros_zip
+from instrumentacao import pico_memoria_mb, zerar_pico_memoria
+from motor_analitico import criar_banco_analitico
+from snapshot_api import gerar_snapshot_api
+from validation import validar_dados_consolidados
+
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+BASELINE_PADRAO = BASE_DIR / "benchmarks" / "baseline.json"
+
+# Uma etapa é regressão se ficar mais lenta (ou usar mais memória) que a baseline além desta fração
+TOLERANCIA_PADRAO = 0.25
+
+# Etapas muito rápidas oscilam demais para comparar em porcentagem
+SEGUNDOS_MINIMOS_PARA_COMPARAR = 0.05
+
+
+def _medir(nome: str, linhas: int, funcao: Callable[[], Any]) -> dict[str, Any]:
+    # Libera o lixo da etapa anterior antes de zerar o pico, para que ele não conte na etapa medida
+    gc.collect()
+    pico_por_etapa = zerar_pico_memoria()
+    inicio = time.perf_counter()
+    funcao()
+    segundos = time.perf_counter() - inicio
+
+    resultado = {
+        "segundos": round(segundos, 4),
+        "linhas": linhas,
+        "linhas_por_segundo": round(linhas / segundos, 1) if segundos > 0 else None,
+        "pico_memoria_mb": round(pico_memoria_mb(), 1),
+        "pico_memoria_por_etapa": pico_por_etapa,
+    }
+    print(
+        f"  {nome:<15} {resultado['segundos']:>9.3f}s  {resultado['linhas_por_segundo'] or 0:>14,.0f} linhas/s  "
+        f"pico {resultado['pico_memoria_mb']:>8.1f} MB"
+    )
+    return resultado
+
+
+def executar_benchmark(
+    diretorio: Path,
+    escala: float,
+    semente: int,
+    workers: int | None,
+    linhas_por_lote: int | None,
+) -> dict[str, Any]:
+    # Gera os dados sintéticos em diretorio/ e mede cada etapa da pipeline com as funções reais (sem download).
+    print(f"Gerando dados sintéticos (escala {escala}, semente {semente})...")
+    arquivos = gerar_dados_sinteticos(diretorio / "raw", escala=escala, semente=semente)
+
+    processed = diretorio / "processed"
+    consolidado = processed / "consolidado_despesas.parquet"
+    cadastro_indice = processed / "cadastro_indice.parquet"
+    enriquecido = processed / "consolidado_enriquecido.parquet"
+    validado = processed / "consolidado_enriquecido_validado.parquet"
+    agregado = processed / "despesas_agregadas.parquet"
+
+    linhas_entrada = arquivos.linhas_por_trimestre * len(arquivos.zips)
+    etapas: dict[str, dict[str, Any]] = {}
+
+    def _consolidar() -> None:
+        membros = identificar_arquivos_despesas(listar_membros_zip(arquivos.zips))
+        salvar_tabela(ler_e_normalizar_arquivos(membros, workers=workers), consolidado)
+
+    print("Etapas:")
+    etapas["consolidacao"] = _medir("consolidacao", linhas_entrada, _consolidar)
+    etapas["cadastro"] = _medir(
+        "cadastro", arquivos.operadoras, lambda: construir_indice_cadastro(arquivos.cadastro, cadastro_indice)
+    )
+
+    linhas_consolidado = len(ler_tabela(consolidado, colunas=["Ano"]))
+    etapas["enriquecimento"] = _medir(
+        "enriquecimento",
+        linhas_consolidado,
+        lambda: enriquecer_consolidado_com_cadastro(consolidado, cadastro_indice, enriquecido, linhas_por_lote=linhas_por_lote),
+    )
+
+    linhas_enriquecido = len(ler_tabela(enriquecido, colunas=["Ano"]))
+    etapas["validacao"] = _medir(
+        "validacao",
+        linhas_enriquecido,
+        lambda: validar_dados_consolidados(enriquecido, validado, linhas_por_lote=linhas_por_lote),
+    )
+
+    linhas_validado = len(ler_tabela(validado, colunas=["Ano"]))
+    etapas["agregacao"] = _medir("agregacao", linhas_validado, lambda: agregar_despesas(validado, agregado, linhas_por_lote))
+    etapas["cubo"] = _medir(
+        "cubo", linhas_validado, lambda: gerar_cubo(validado, processed / "cubo_despesas.parquet", linhas_por_lote, workers)
+    )
+    etapas["snapshot_api"] = _medir(
+        "snapshot_api", linhas_validado, lambda: gerar_snapshot_api(validado, agregado, processed / "api_snapshot")
+    )
+    etapas["analises"] = _medir(
+        "analises",
+        linhas_consolidado,
+        lambda: criar_banco_analitico(consolidado, cadastro_indice, agregado, processed / "analises.sqlite"),
+    )
+
+    return {
+        "escala": escala,
+        "semente": semente,
+        "workers": workers,
+        "linhas_por_lote": linhas_por_lote,
+        "ambiente": {
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "plataforma": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "etapas": etapas,
+    }
+
+
+def comparar_com_baseline(resultado: dict[str, Any], baseline: dict[str, Any], tolerancia: float) -> list[str]:
+    # Compara tempo e pico de memória de cada etapa com a baseline. Retorna a lista de regressões (vazia se tudo dentro da tolerância).
+    if baseline.get("escala") != resultado["escala"] or baseline.get("semente") != resultado["semente"]:
+        print(
+            f"Aviso: baseline gerada com escala {baseline.get('escala')} e semente {baseline.get('semente')}; "
+            f"a comparação só é justa com os mesmos parâmetros."
+        )
+
+    regressoes: list[str] = []
+    print(f"Comparação com a baseline (tolerância {tolerancia:.0%}):")
+    for etapa, atual in resultado["etapas"].items():
+        anterior = baseline.get("etapas", {}).get(etapa)
+        if anterior is None:
+            print(f"  {etapa:<15} sem baseline")
+            continue
+
+        variacao_tempo = atual["segundos"] / anterior["segundos"] - 1 if anterior["segundos"] else 0.0
+        variacao_memoria = (
+            atual["pico_memoria_mb"] / anterior["pico_memoria_mb"] - 1 if anterior["pico_memoria_mb"] else 0.0
+        )
+
+        situacao = "ok"
+        if variacao_tempo > tolerancia and atual["segundos"] >= SEGUNDOS_MINIMOS_PARA_COMPARAR:
+            situacao = "REGRESSÃO (tempo)"
+            regressoes.append(f"{etapa}: tempo {anterior['segundos']:.3f}s -> {atual['segundos']:.3f}s ({variacao_tempo:+.0%})")
+        if variacao_memoria > tolerancia and atual["pico_memoria_por_etapa"] and anterior.get("pico_memoria_por_etapa"):
+            situacao = "REGRESSÃO (memória)" if situacao == "ok" else "REGRESSÃO (tempo e memória)"
+            regressoes.append(
+                f"{etapa}: pico {anterior['pico_memoria_mb']:.1f} MB -> {atual['pico_memoria_mb']:.1f} MB ({variacao_memoria:+.0%})"
+            )
+
+        print(f"  {etapa:<15} tempo {variacao_tempo:+7.1%}  memória {variacao_memoria:+7.1%}  {situacao}")
+
+    return regressoes
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark das etapas da pipeline (consolidação, cadastro, enriquecimento, validação, agregação, snapshot da API, banco analítico) com dados sintéticos."
+    )
+    parser.add_argument(
+        "--escala",
+        type=escala_argumento,
+        default=1.0,
+        help=f"Volume dos dados sintéticos ({ESCALA_MINIMA} a {ESCALA_MAXIMA}).",
+    )
+    parser.add_argument("--semente", type=int, default=42)
+    parser.add_argument("--workers", type=int, default=None, help="Processos na leitura dos arquivos (padrão: CPUs).")
+    parser.add_argument("--linhas-por-lote", type=int, default=None, help="Modo em lotes no enriquecimento e validação.")
+    parser.add_argument("--diretorio", type=Path, default=None, help="Onde gerar os dados (padrão: diretório temporário).")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PADRAO, help="Arquivo JSON da baseline.")
+    parser.add_argument("--salvar-baseline", action="store_true", help="Grava o resultado como nova baseline.")
+    parser.add_argument("--tolerancia", type=float, default=TOLERANCIA_PADRAO, help="Variação aceita antes de acusar regressão (0.25 = 25%%).")
+    parser.add_argument("--saida", type=Path, default=None, help="Grava o resultado desta execução em JSON.")
+    args = parser.parse_args(argv)
+
+    # O diretório temporário só é criado (e apagado no fim) quando --diretorio não é informado
+    contexto = contextlib.nullcontext(args.diretorio) if args.diretorio else tempfile.TemporaryDirectory(prefix="benchmark_ans_")
+    with contexto as diretorio:
+        resultado = executar_benchmark(Path(diretorio), args.escala, args.semente, args.workers, args.linhas_por_lote)
+
+    if args.saida:
+        args.saida.parent.mkdir(parents=True, exist_ok=True)
+        args.saida.write_text(json.dumps(resultado, indent=2, ensure_ascii=False), encoding="utf-8")
+
+    if args.salvar_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps(resultado, indent=2, ensure_ascii=False), encoding="utf-8")
+        print(f"Baseline salva em {args.baseline}.")
+        return 0
+
+    if not args.baseline.exists():
+        print(f"Sem baseline em {args.baseline}; rode com --salvar-baseline para criar uma.")
+        return 0
+
+    baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+    regressoes = comparar_com_baseline(resultado, baseline, args.tolerancia)
+    if regressoes:
+        print("Regressões encontradas:")
+        for regressao in regressoes:
+            print(f"  - {regressao}")
+        return 1
+
+    print("Nenhuma regressão em relação à baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
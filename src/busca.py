@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import re
+import unicodedata
+from typing import Iterable
+
+import numpy as np
+
+
+TAMANHO_NGRAMA = 3
+
+# Consultas só com dígitos e caracteres de máscara ("12.345.678/0001-90") são tratadas como CNPJ
+_PADRAO_CNPJ = re.compile(r"[\d.\-/\s]+")
+
+# Ordem do ranking: CNPJ exato > prefixo (CNPJ ou Razão Social) > substring
+RANK_CNPJ_EXATO = 0
+RANK_PREFIXO = 1
+RANK_SUBSTRING = 2
+
+
+def normalizar_texto(texto: object) -> str:
+    # Remove acentos, passa para maiúsculas e colapsa espaços: "Saúde  Ltda" -> "SAUDE LTDA".
+    if texto is None:
+        return ""
+    texto = unicodedata.normalize("NFKD", str(texto))
+    texto = "".join(ch for ch in texto if not unicodedata.combining(ch))
+    return " ".join(texto.upper().split())
+
+
+def somente_digitos(texto: object) -> str:
+    return re.sub(r"\D", "", "" if texto is None else str(texto))
+
+
+def _ngramas(texto: str) -> set[str]:
+    return {texto[i : i + TAMANHO_NGRAMA] for i in range(len(texto) - TAMANHO_NGRAMA + 1)}
+
+
+def _indexar(textos: list[str]) -> dict[str, np.ndarray]:
+    # Índice invertido n-grama -> posições (ordenadas) dos textos que o contêm.
+    postings: dict[str, list[int]] = {}
+    for posicao, texto in enumerate(textos):
+        for ngrama in _ngramas(texto):
+            postings.setdefault(ngrama, []).append(posicao)
+    return {ngrama: np.asarray(posicoes, dtype=np.int32) for ngrama, posicoes in postings.items()}
+
+
+class IndiceBusca:
+    # Índice de busca sobre as operadoras (na ordem da tabela de operadoras da API). Razão Social é normalizada sem acentos e em maiúsculas, e o CNPJ reduzido aos dígitos. Cada campo tem um índice invertido de trigramas: a consulta só verifica (substring exata) as operadoras que contêm todos os trigramas dela, então não há regex nem varredura de todas as linhas. Consultas com menos de 3 caracteres usam varredura simples, que é barata no volume de operadoras.
+
+    def __init__(self, cnpjs: Iterable[object], razoes_sociais: Iterable[object]):
+        self.cnpjs = [somente_digitos(c) for c in cnpjs]
+        self.razoes = [normalizar_texto(r) for r in razoes_sociais]
+        self._ngramas_cnpj = _indexar(self.cnpjs)
+        self._ngramas_razao = _indexar(self.razoes)
+
+    def __len__(self) -> int:
+        return len(self.cnpjs)
+
+    @staticmethod
+    def _candidatos(consulta: str, indice: dict[str, np.ndarray], total: int) -> np.ndarray:
+        ngramas = _ngramas(consulta)
+        if not ngramas:
+            return np.arange(total, dtype=np.int32)
+
+        postings = sorted((indice.get(ngrama) for ngrama in ngramas), key=lambda p: 0 if p is None else len(p))
+        if postings[0] is None:
+            return np.empty(0, dtype=np.int32)
+
+        candidatos = postings[0]
+        for posting in postings[1:]:
+            candidatos = np.intersect1d(candidatos, posting, assume_unique=True)
+            if len(candidatos) == 0:
+                break
+        return candidatos
+
+    def buscar(self, consulta: str) -> np.ndarray:
+        # Posições das operadoras que casam com a consulta, ordenadas por relevância (CNPJ exato > prefixo > substring) e, dentro de cada nível, pela ordem da tabela.
+        return self.buscar_com_niveis(consulta)[0]
+
+    def buscar_com_niveis(self, consulta: str) -> tuple[np.ndarray, np.ndarray]:
+        # Como buscar, mas devolve também o nível de relevância (RANK_*) de cada posição.
+        texto = normalizar_texto(consulta)
+        if not texto:
+            return np.arange(len(self), dtype=np.int64), np.full(len(self), RANK_SUBSTRING, dtype=np.int64)
+
+        ranks: dict[int, int] = {}
+
+        # Razão Social: prefixo ou substring do texto normalizado
+        for posicao in self._candidatos(texto, self._ngramas_razao, len(self)).tolist():
+            razao = self.razoes[posicao]
+            if razao.startswith(texto):
+                ranks[posicao] = RANK_PREFIXO
+            elif texto in razao:
+                ranks[posicao] = RANK_SUBSTRING
+
+        # CNPJ: só quando a consulta parece um CNPJ (com ou sem máscara)
+        digitos = somente_digitos(consulta) if _PADRAO_CNPJ.fullmatch(consulta.strip()) else ""
+        if digitos:
+            for posicao in self._candidatos(digitos, self._ngramas_cnpj, len(self)).tolist():
+                cnpj = self.cnpjs[posicao]
+                if cnpj == digitos:
+                    rank = RANK_CNPJ_EXATO
+                elif cnpj.startswith(digitos):
+                    rank = RANK_PREFIXO
+                elif digitos in cnpj:
+                    rank = RANK_SUBSTRING
+                else:
+                    continue
+                ranks[posicao] = min(rank, ranks.get(posicao, rank))
+
+        if not ranks:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        posicoes = np.fromiter(ranks.keys(), dtype=np.int64, count=len(ranks))
+        niveis = np.fromiter(ranks.values(), dtype=np.int64, count=len(ranks))
+        ordem = np.lexsort((posicoes, niveis))
+        return posicoes[ordem], niveis[ordem]
+
+    def sugerir(self, consulta: str, k: int) -> np.ndarray:
+        # Top-k da busca, para autocompletar.
+        return self.buscar(consulta)[:k]
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+from aggregation import calcular_estados_por_particao, salvar_estados
+
+
+# Dimensões do cubo de despesas, na ordem das colunas. Ano/Trimestre também particionam a tabela do cubo.
+DIMENSOES_CUBO = ("UF", "Modalidade", "Ano", "Trimestre")
+COLUNAS_MEDIDAS_CUBO = ["Contagem", "TotalDespesas", "MediaDespesas", "DesvioPadraoDespesas"]
+
+
+def gerar_cubo(
+    caminho_validado: Path,
+    caminho_saida: Path,
+    linhas_por_lote: int | None = None,
+    workers: int | None = None,
+) -> int:
+    # Materializa o cubo de despesas da tabela validada: uma célula por combinação de DIMENSOES_CUBO presente nos dados, com contagem, soma e M2 de ValorDespesas (ver aggregation.EstadoGrupos), gravado como tabela particionada por Ano/Trimestre. Chaves nulas (ex.: Modalidade ausente no cadastro) formam células próprias, então a soma das células é sempre o total da tabela. Retorna o número de células.
+    estados = calcular_estados_por_particao(
+        caminho_validado,
+        linhas_por_lote=linhas_por_lote,
+        workers=workers,
+        colunas_chave=DIMENSOES_CUBO,
+        manter_nulos=True,
+    )
+    salvar_estados(estados, caminho_saida)
+    return sum(len(estado) for _, estado in estados)
+
+
+def consultar_cubo(
+    cubo: pd.DataFrame,
+    dimensoes: Iterable[str] = (),
+    filtros: dict[str, list] | None = None,
+) -> pd.DataFrame:
+    # Fatia (filtros: dimensão -> valores aceitos) e consolida as células do cubo nas dimensões pedidas (roll-up das demais), sem reler os dados: as células de cada grupo são combinadas pela fórmula de Chan et al. (n = Σn, soma = Σsoma, M2 = Σ(M2 + n·(média da célula − média do grupo)²)). Sem dimensões, devolve uma linha com o total. O resultado tem as dimensões pedidas (ordenadas, nulos por último) e COLUNAS_MEDIDAS_CUBO, com desvio padrão amostral (ddof=1), nulo para grupos de uma linha.
+    dimensoes = list(dimensoes)
+    for coluna in [*dimensoes, *(filtros or {})]:
+        if coluna not in DIMENSOES_CUBO:
+            raise ValueError(f"Dimensão desconhecida: {coluna} (dimensões: {', '.join(DIMENSOES_CUBO)})")
+
+    celulas = cubo
+    for coluna, valores in (filtros or {}).items():
+        celulas = celulas[celulas[coluna].isin(valores)]
+
+    if dimensoes:
+        grupos = celulas.groupby(dimensoes, dropna=False, sort=True).ngroup().to_numpy()
+        resultado = (
+            celulas[dimensoes].drop_duplicates().sort_values(dimensoes, na_position="last", ignore_index=True)
+        )
+        # ngroup numera os grupos na ordem ordenada das chaves (nulos por último), a mesma de resultado
+        total_grupos = len(resultado)
+    else:
+        grupos = np.zeros(len(celulas), dtype=np.int64)
+        resultado = pd.DataFrame(index=range(1))
+        total_grupos = 1
+
+    contagem_celula = celulas["Contagem"].to_numpy(dtype=np.float64)
+    soma_celula = celulas["Soma"].to_numpy(dtype=np.float64)
+    contagem = np.bincount(grupos, weights=contagem_celula, minlength=total_grupos)
+    soma = np.bincount(grupos, weights=soma_celula, minlength=total_grupos)
+    media = np.divide(soma, contagem, out=np.full(total_grupos, np.nan), where=contagem > 0)
+
+    desvios = soma_celula / contagem_celula - media[grupos]
+    m2 = np.bincount(
+        grupos,
+        weights=celulas["M2"].to_numpy(dtype=np.float64) + contagem_celula * desvios * desvios,
+        minlength=total_grupos,
+    )
+
+    resultado["Contagem"] = contagem.astype(np.int64)
+    resultado["TotalDespesas"] = soma
+    resultado["MediaDespesas"] = media
+    resultado["DesvioPadraoDespesas"] = np.sqrt(
+        np.divide(m2, contagem - 1, out=np.full(total_grupos, np.nan), where=contagem > 1)
+    )
+    return resultado
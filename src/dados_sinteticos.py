@@ -0,0 +1,235 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import io
+import zipfile
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from validation import PESOS_DV1, PESOS_DV2
+
+
+# Escala 1 ~ volume de um trimestre real reduzido: 1.000 operadoras x 60 contas por trimestre.
+# --escala multiplica o número de operadoras (1x a 50x).
+OPERADORAS_POR_ESCALA = 1_000
+ESCALA_MINIMA = 1
+ESCALA_MAXIMA = 50
+CONTAS_POR_OPERADORA = 60
+
+# Trimestres gerados por padrão (os 3 mais recentes que a pipeline baixaria)
+TRIMESTRES_PADRAO = ((2024, 3), (2024, 4), (2025, 1))
+
+# A ANS já publicou os zips nos dois formatos de nome; os trimestres gerados alternam entre eles
+FORMATOS_NOME_ZIP = ("{ano}_{tri}_trimestre", "{tri}T{ano}")
+
+UFS = ("SP", "RJ", "MG", "RS", "PR", "SC", "BA", "PE", "CE", "GO", "DF", "ES", "PA", "AM", "MT", "MS")
+MODALIDADES = (
+    "Medicina de Grupo",
+    "Cooperativa Médica",
+    "Autogestão",
+    "Seguradora Especializada em Saúde",
+    "Odontologia de Grupo",
+    "Cooperativa Odontológica",
+    "Filantropia",
+)
+PALAVRAS_RAZAO = ("SAÚDE", "ASSISTÊNCIA", "MÉDICA", "ODONTO", "VIDA", "PLANOS", "SERVIÇOS", "CLÍNICAS", "UNIÃO", "PREVIDÊNCIA")
+SUFIXOS_RAZAO = ("LTDA", "S.A.", "COOPERATIVA DE TRABALHO MÉDICO", "EIRELI")
+CONTAS = (
+    ("4", "DESPESAS"),
+    ("41", "EVENTOS / SINISTROS CONHECIDOS OU AVISADOS"),
+    ("411", "EVENTOS/ SINISTROS CONHECIDOS OU AVISADOS DE ASSISTÊNCIA A SAÚDE MEDICO HOSPITALAR"),
+    ("4111", "CONSULTAS MÉDICAS"),
+    ("4112", "EXAMES"),
+    ("4113", "TERAPIAS"),
+    ("4114", "INTERNAÇÕES"),
+    ("46", "DESPESAS ADMINISTRATIVAS"),
+)
+
+# Proporções de casos problemáticos, como nos dados reais
+FRACAO_SEM_CADASTRO = 0.01
+FRACAO_CNPJ_INVALIDO = 0.02
+FRACAO_CNPJ_REPETIDO = 0.01
+FRACAO_VALOR_ZERO_OU_NEGATIVO = 0.05
+
+
+class ArquivosSinteticos(NamedTuple):
+    zips: list[Path]
+    cadastro: Path
+    linhas_por_trimestre: int
+    operadoras: int
+
+
+def _gerar_cnpjs(rng: np.random.Generator, quantidade: int) -> np.ndarray:
+    # CNPJs válidos (com dígitos verificadores) e distintos: 8 dígitos de raiz sorteados + filial 0001.
+    raizes = rng.choice(90_000_000, size=quantidade, replace=False) + 10_000_000
+    digitos = np.zeros((quantidade, 14), dtype=np.int64)
+    for i in range(8):
+        digitos[:, 7 - i] = (raizes // 10**i) % 10
+    digitos[:, 11] = 1
+
+    for posicao, pesos in ((12, PESOS_DV1), (13, PESOS_DV2)):
+        resto = (digitos[:, :posicao] * pesos).sum(axis=1) % 11
+        digitos[:, posicao] = np.where(resto < 2, 0, 11 - resto)
+
+    return np.array(["".join(map(str, linha)) for linha in digitos], dtype=object)
+
+
+def _gerar_razoes(rng: np.random.Generator, quantidade: int) -> np.ndarray:
+    palavras = rng.choice(len(PALAVRAS_RAZAO), size=(quantidade, 2))
+    sufixos = rng.choice(len(SUFIXOS_RAZAO), size=quantidade)
+    return np.array(
+        [
+            f"{PALAVRAS_RAZAO[a]} {PALAVRAS_RAZAO[b]} {i + 1} {SUFIXOS_RAZAO[s]}"
+            for i, ((a, b), s) in enumerate(zip(palavras, sufixos))
+        ],
+        dtype=object,
+    )
+
+
+def _csv_latin1(df: pd.DataFrame) -> bytes:
+    # CSV no dialeto da ANS: ";" como separador, vírgula decimal, tudo entre aspas, Latin-1.
+    texto = io.StringIO()
+    df.to_csv(texto, sep=";", decimal=",", index=False, quoting=csv.QUOTE_ALL, float_format="%.2f")
+    return texto.getvalue().encode("latin-1")
+
+
+def gerar_cadastro(
+    rng: np.random.Generator,
+    registros: np.ndarray,
+    destino: Path,
+) -> None:
+    # Cadastro de operadoras ativas no layout do Relatorio_cadop. Uma fração das operadoras fica fora do cadastro (sem match no enriquecimento), outra tem CNPJ inválido e outra repete o CNPJ de outra operadora.
+    quantidade = len(registros)
+    no_cadastro = rng.random(quantidade) >= FRACAO_SEM_CADASTRO
+    cnpjs = _gerar_cnpjs(rng, quantidade)
+
+    invalidos = rng.random(quantidade) < FRACAO_CNPJ_INVALIDO
+    cnpjs[invalidos] = [c[:-1] + str((int(c[-1]) + 1) % 10) for c in cnpjs[invalidos]]
+
+    repetidos = np.flatnonzero(rng.random(quantidade) < FRACAO_CNPJ_REPETIDO)
+    if len(repetidos):
+        cnpjs[repetidos] = cnpjs[rng.integers(0, quantidade, size=len(repetidos))]
+
+    df = pd.DataFrame(
+        {
+            "REGISTRO_OPERADORA": registros.astype(str),
+            "CNPJ": cnpjs,
+            "Razao_Social": _gerar_razoes(rng, quantidade),
+            "Nome_Fantasia": [f"OPERADORA {r}" for r in registros],
+            "Modalidade": np.asarray(MODALIDADES, dtype=object)[rng.integers(0, len(MODALIDADES), quantidade)],
+            "Logradouro": "RUA DAS FLORES",
+            "Numero": rng.integers(1, 3000, quantidade).astype(str),
+            "Bairro": "CENTRO",
+            "Cidade": "SÃO PAULO",
+            "UF": np.asarray(UFS, dtype=object)[rng.integers(0, len(UFS), quantidade)],
+            "CEP": rng.integers(10_000_000, 99_999_999, quantidade).astype(str),
+            "Data_Registro_ANS": "2001-01-01",
+        }
+    )[no_cadastro]
+
+    destino.parent.mkdir(parents=True, exist_ok=True)
+    destino.write_bytes(_csv_latin1(df))
+
+
+def gerar_trimestre(
+    rng: np.random.Generator,
+    registros: np.ndarray,
+    ano: int,
+    tri: int,
+    contas_por_operadora: int,
+    destino_zip: Path,
+) -> int:
+    # Demonstrações contábeis de um trimestre (layout DATA;REG_ANS;CD_CONTA_CONTABIL;DESCRICAO;VL_SALDO_INICIAL;VL_SALDO_FINAL) dentro de um zip com um CSV de mesmo nome. Retorna o número de linhas.
+    quantidade = len(registros) * contas_por_operadora
+    contas = rng.integers(0, len(CONTAS), quantidade)
+
+    saldo_final = np.round(rng.lognormal(mean=11, sigma=1.5, size=quantidade), 2)
+    problematicos = rng.random(quantidade) < FRACAO_VALOR_ZERO_OU_NEGATIVO
+    saldo_final[problematicos] = np.round(-rng.random(problematicos.sum()) * 1000, 2) * rng.integers(0, 2, problematicos.sum())
+    saldo_inicial = np.round(saldo_final * rng.uniform(0.5, 1.0, quantidade), 2)
+
+    df = pd.DataFrame(
+        {
+            "DATA": f"{ano}-{3 * (tri - 1) + 1:02d}-01",
+            "REG_ANS": np.repeat(registros, contas_por_operadora).astype(str),
+            "CD_CONTA_CONTABIL": np.asarray([c for c, _ in CONTAS], dtype=object)[contas],
+            "DESCRICAO": np.asarray([d for _, d in CONTAS], dtype=object)[contas],
+            "VL_SALDO_INICIAL": saldo_inicial,
+            "VL_SALDO_FINAL": saldo_final,
+        }
+    )
+
+    destino_zip.parent.mkdir(parents=True, exist_ok=True)
+    # Data fixa no membro do zip, para que a mesma semente gere exatamente os mesmos bytes
+    membro = zipfile.ZipInfo(f"{destino_zip.stem}.csv", date_time=(ano, 3 * (tri - 1) + 1, 1, 0, 0, 0))
+    membro.compress_type = zipfile.ZIP_DEFLATED
+    with zipfile.ZipFile(destino_zip, "w") as zf:
+        zf.writestr(membro, _csv_latin1(df))
+    return quantidade
+
+
+def gerar_dados_sinteticos(
+    destino: Path,
+    escala: float = 1.0,
+    semente: int = 42,
+    trimestres: tuple[tuple[int, int], ...] = TRIMESTRES_PADRAO,
+    contas_por_operadora: int = CONTAS_POR_OPERADORA,
+) -> ArquivosSinteticos:
+    # Gera, de forma determinística (mesma semente = mesmos arquivos), os zips trimestrais e o cadastro de operadoras em destino/. Os zips alternam os formatos de nome antigo ('2024_3_trimestre.zip') e novo ('4T2024.zip').
+    if not ESCALA_MINIMA <= escala <= ESCALA_MAXIMA:
+        raise ValueError(f"Escala {escala} fora do intervalo de {ESCALA_MINIMA} a {ESCALA_MAXIMA}.")
+    rng = np.random.default_rng(semente)
+    operadoras = max(int(OPERADORAS_POR_ESCALA * escala), 1)
+    registros = np.sort(rng.choice(900_000, size=operadoras, replace=False) + 100_000)
+
+    destino.mkdir(parents=True, exist_ok=True)
+    cadastro = destino / "cadastro_operadoras.csv"
+    gerar_cadastro(rng, registros, cadastro)
+
+    zips: list[Path] = []
+    linhas = 0
+    for indice, (ano, tri) in enumerate(trimestres):
+        nome = FORMATOS_NOME_ZIP[indice % len(FORMATOS_NOME_ZIP)].format(ano=ano, tri=tri)
+        destino_zip = destino / f"{nome}.zip"
+        linhas = gerar_trimestre(rng, registros, ano, tri, contas_por_operadora, destino_zip)
+        zips.append(destino_zip)
+
+    return ArquivosSinteticos(zips=zips, cadastro=cadastro, linhas_por_trimestre=linhas, operadoras=operadoras)
+
+
+def escala_argumento(texto: str) -> float:
+    # Tipo do argumento --escala (aqui e no benchmark): recusa valores fora de ESCALA_MINIMA..ESCALA_MAXIMA já na linha de comando.
+    try:
+        escala = float(texto)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"escala inválida: {texto!r}")
+    if not ESCALA_MINIMA <= escala <= ESCALA_MAXIMA:
+        raise argparse.ArgumentTypeError(f"a escala vai de {ESCALA_MINIMA} a {ESCALA_MAXIMA} (recebido {texto})")
+    return escala
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Gera zips trimestrais e cadastro de operadoras sintéticos no formato da ANS.")
+    parser.add_argument("destino", type=Path, help="Diretório de saída.")
+    parser.add_argument(
+        "--escala",
+        type=escala_argumento,
+        default=1.0,
+        help=f"Multiplicador do volume, de {ESCALA_MINIMA} a {ESCALA_MAXIMA} (1 = {OPERADORAS_POR_ESCALA} operadoras).",
+    )
+    parser.add_argument("--semente", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    arquivos = gerar_dados_sinteticos(args.destino, escala=args.escala, semente=args.semente)
+    print(
+        f"{len(arquivos.zips)} zips ({arquivos.linhas_por_trimestre} linhas por trimestre) "
+        f"e cadastro com {arquivos.operadoras} operadoras gerados em {args.destino}."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,41 @@
 from __future__ import annotations
 
+import os
 import re
 import unicodedata
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
 from bs4 import BeautifulSoup
 
+from api_ans import baixar_arquivo, criar_sessao_http
+from armazenamento import EscritorTabela, iterar_tabela, ler_tabela, salvar_tabela
+from file_processing import ler_csv
+
 
 CADASTRO_BASE_URL = "https://dadosabertos.ans.gov.br/FTP/PDA/operadoras_de_plano_de_saude_ativas/"
 
+# Colunas do índice do cadastro -> coluna normalizada de origem no CSV da ANS
+COLUNAS_INDICE_CADASTRO = {
+    "CNPJ": "cnpj",
+    "RazaoSocial": "razao_social",
+    "Modalidade": "modalidade",
+    "UF": "uf",
+}
+
+# Colunas do cadastro usadas no enriquecimento (nomes normalizados)
+COLUNAS_CADASTRO = {
+    "registro_operadora": "string",
+    "cnpj": "string",
+    "razao_social": "string",
+    "modalidade": "string",
+    "uf": "string",
+}
+
 
 def _get_soup(url: str) -> BeautifulSoup:
     resp = requests.get(url)
@@ -38,13 +63,9 @@ def baixar_cadastro_operadoras(destino_csv: Path) -> None:
     csv_nome = csv_links[-1]
     url_csv = CADASTRO_BASE_URL + csv_nome
 
-    resp = requests.get(url_csv, stream=True)
-    resp.raise_for_status()
-
-    with open(destino_csv, "wb") as f:
-        for chunk in resp.iter_content(chunk_size=8192):
-            if chunk:
-                f.write(chunk)
+    # Download condicional/retomável: se o cadastro não mudou desde a última execução, nada é baixado
+    _, status = baixar_arquivo(criar_sessao_http(1), url_csv, destino_csv)
+    print(f"  {destino_csv.name}: {status}")
 
 
 def _normalizar_colunas(df: pd.DataFrame) -> pd.DataFrame:
@@ -64,94 +85,147 @@ def _normalizar_colunas(df: pd.DataFrame) -> pd.DataFrame:
 
 
 def _ler_csv_generico(caminho: Path) -> pd.DataFrame:
-    # Tenta ler o CSV de cadastro tentando combinações de encoding e separador.
-    erros: list[Exception] = []
-    for encoding in ("utf-8", "latin1"):
-        for sep in (";", ","):
-            try:
-                return pd.read_csv(
-                    caminho,
-                    sep=sep,
-                    engine="python",
-                    encoding=encoding,
-                )
-            except Exception as e:
-                erros.append(e)
-    raise erros[-1] if erros else ValueError(f"Não foi possível ler o arquivo: {caminho}")
-
-
-def enriquecer_consolidado_com_cadastro(
-    caminho_consolidado: Path,
-    caminho_cadastro: Path,
-    caminho_saida: Path,
-) -> None:
-    # Faz o join entre: - consolidado_despesas.csv  (RegistroANS, Ano, Trimestre, ValorDespesas) - cadastro_operadoras.csv   (REGISTRO_OPERADORA, CNPJ, Razao_Social, Modalidade, UF, ...) usando: RegistroANS (consolidado)  <->  REGISTRO_OPERADORA (cadastro) Saída: CSV com colunas: - RegistroANS - CNPJ - RazaoSocial - Modalidade - UF - Ano - Trimestre - ValorDespesas
-    
-    # Lê consolidado
-    df_cons = pd.read_csv(caminho_consolidado, encoding="utf-8")
+    # Lê o CSV de cadastro em uma passada só (formato detectado pela amostra inicial), trazendo apenas as colunas usadas no join, todas como texto para não perder zeros à esquerda do CNPJ.
+    return ler_csv(caminho, COLUNAS_CADASTRO)
+
+
+class IndiceCadastro:
+    # Índice compacto do cadastro de operadoras, chaveado pelo REGISTRO_OPERADORA como inteiro. Guarda só CNPJ/RazaoSocial/Modalidade/UF, como colunas categóricas alinhadas a um array ordenado de registros, então o join vira uma busca binária (np.searchsorted) + take por códigos, em vez de um merge por texto entre tabelas largas. É salvo em Parquet depois do download e reaproveitado entre execuções e pela API.
+
+    def __init__(self, registros: np.ndarray, atributos: pd.DataFrame):
+        self.registros = registros
+        self.atributos = atributos
+
+    @classmethod
+    def construir(cls, caminho_cadastro: Path) -> "IndiceCadastro":
+        # Monta o índice a partir do CSV de cadastro baixado da ANS. Registros repetidos ficam com a última ocorrência (a mais recente no arquivo); registros não numéricos são descartados.
+        df_cad = _ler_csv_generico(caminho_cadastro)
+        df_cad = _normalizar_colunas(df_cad)
+        # Pelo seu head, as colunas ficam:
+        # registro_operadora, cnpj, razao_social, nome_fantasia, modalidade, ..., uf, ...
+
+        if "registro_operadora" not in df_cad.columns:
+            raise ValueError("Cadastro não possui coluna 'REGISTRO_OPERADORA' normalizada ('registro_operadora').")
+
+        registros = pd.to_numeric(df_cad["registro_operadora"].str.strip(), errors="coerce")
+        df_cad = df_cad[registros.notna()].assign(registro=registros.dropna().astype("int64"))
+        df_cad = df_cad.drop_duplicates("registro", keep="last").sort_values("registro", kind="stable")
+
+        atributos = pd.DataFrame(index=pd.RangeIndex(len(df_cad)))
+        for coluna, origem in COLUNAS_INDICE_CADASTRO.items():
+            if origem in df_cad.columns:
+                valores = df_cad[origem].str.strip().to_numpy()
+            else:
+                valores = np.full(len(df_cad), pd.NA, dtype=object)
+            atributos[coluna] = pd.Categorical(valores)
+
+        return cls(df_cad["registro"].to_numpy(dtype="int64"), atributos)
+
+    @classmethod
+    def carregar(cls, caminho_indice: Path) -> "IndiceCadastro":
+        df = pq.read_table(caminho_indice).to_pandas()
+        return cls(df.pop("RegistroANS").to_numpy(dtype="int64"), df.reset_index(drop=True))
+
+    def salvar(self, caminho_indice: Path) -> None:
+        caminho_indice.parent.mkdir(parents=True, exist_ok=True)
+        df = self.atributos.copy()
+        df.insert(0, "RegistroANS", self.registros)
+        temporario = caminho_indice.with_name(caminho_indice.name + ".tmp")
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), temporario)
+        os.replace(temporario, caminho_indice)
+
+    def __len__(self) -> int:
+        return len(self.registros)
+
+    def posicoes(self, registros: pd.Series) -> np.ndarray:
+        # Posição de cada registro no índice, ou -1 se não estiver no cadastro (inclui valores não numéricos).
+        chaves = pd.to_numeric(registros.astype("string").str.strip(), errors="coerce")
+        validos = chaves.notna().to_numpy()
+        chaves = chaves.fillna(-1).to_numpy(dtype="int64")
+
+        if len(self.registros) == 0:
+            return np.full(len(chaves), -1, dtype="int64")
+
+        posicoes = np.searchsorted(self.registros, chaves)
+        posicoes = np.minimum(posicoes, len(self.registros) - 1)
+        encontrados = validos & (self.registros[posicoes] == chaves)
+        return np.where(encontrados, posicoes, -1)
+
+    def atributo(self, coluna: str, posicoes: np.ndarray) -> pd.Categorical:
+        # Valores de uma coluna do cadastro para as posições dadas (-1 vira nulo), sem materializar strings: só os códigos são copiados.
+        categorico = self.atributos[coluna].cat
+        codigos = categorico.codes.to_numpy()
+        return pd.Categorical.from_codes(
+            np.where(posicoes >= 0, codigos[np.maximum(posicoes, 0)], -1),
+            categories=categorico.categories,
+        )
+
+
+def carregar_indice_cadastro(caminho: Path) -> IndiceCadastro:
+    # Aceita o índice já salvo (.parquet) ou o CSV bruto do cadastro.
+    if caminho.suffix.lower() == ".parquet":
+        return IndiceCadastro.carregar(caminho)
+    return IndiceCadastro.construir(caminho)
+
+
+def construir_indice_cadastro(caminho_cadastro: Path, caminho_indice: Path) -> IndiceCadastro:
+    # Monta o índice compacto a partir do CSV de cadastro e salva em caminho_indice.
+    indice = IndiceCadastro.construir(caminho_cadastro)
+    indice.salvar(caminho_indice)
+    return indice
+
+
+def _enriquecer_lote(df_cons: pd.DataFrame, indice: IndiceCadastro) -> tuple[pd.DataFrame, np.ndarray]:
+    # Enriquece um lote do consolidado (ou o consolidado inteiro) com o índice do cadastro. Retorna o lote enriquecido e os RegistroANS distintos que não têm correspondência no cadastro.
     df_cons = _normalizar_colunas(df_cons)
     # Esperamos: registroans, valordespesas, ano, trimestre
 
-    # Lê cadastro
-    df_cad = _ler_csv_generico(caminho_cadastro)
-    df_cad = _normalizar_colunas(df_cad)
-    # Pelo seu head, as colunas ficam:
-    # registro_operadora, cnpj, razao_social, nome_fantasia, modalidade, ..., uf, ...
-
-    cols_cons = list(df_cons.columns)
-    cols_cad = list(df_cad.columns)
-
     # Garante que as colunas que precisamos existem
-    if "registroans" not in cols_cons:
+    if "registroans" not in df_cons.columns:
         raise ValueError("Consolidado não possui coluna 'RegistroANS' normalizada ('registroans').")
 
-    if "registro_operadora" not in cols_cad:
-        raise ValueError("Cadastro não possui coluna 'REGISTRO_OPERADORA' normalizada ('registro_operadora').")
-
-    # Converte chaves de join para string, garantindo mesma base de comparação
-    df_cons["registroans"] = df_cons["registroans"].astype(str).str.strip()
-    df_cad["registro_operadora"] = df_cad["registro_operadora"].astype(str).str.strip()
-
-    # Faz join LEFT: mantemos todas as linhas do consolidado
-    df_merged = df_cons.merge(
-        df_cad,
-        left_on="registroans",
-        right_on="registro_operadora",
-        how="left",
-    )
+    registros = df_cons["registroans"].astype("string").str.strip()
+    posicoes = indice.posicoes(registros)
 
-    # Monta dataframe final com nomes bonitos
-    df_final = pd.DataFrame()
-    df_final["RegistroANS"] = df_merged["registroans"].astype(str)
+    # Monta dataframe final com nomes bonitos (LEFT join: mantemos todas as linhas do consolidado)
+    df_final = pd.DataFrame(index=df_cons.index)
+    df_final["RegistroANS"] = registros
+    for coluna in COLUNAS_INDICE_CADASTRO:
+        df_final[coluna] = indice.atributo(coluna, posicoes)
 
-    # CNPJ
-    if "cnpj" in df_merged.columns:
-        df_final["CNPJ"] = df_merged["cnpj"].astype(str)
-    else:
-        df_final["CNPJ"] = ""
+    # Ano, Trimestre, ValorDespesas
+    df_final["Ano"] = df_cons["ano"] if "ano" in df_cons.columns else None
+    df_final["Trimestre"] = df_cons["trimestre"] if "trimestre" in df_cons.columns else None
+    df_final["ValorDespesas"] = df_cons["valordespesas"] if "valordespesas" in df_cons.columns else None
 
-    # Razão Social
-    if "razao_social" in df_merged.columns:
-        df_final["RazaoSocial"] = df_merged["razao_social"].astype(str)
-    else:
-        df_final["RazaoSocial"] = ""
+    nao_encontrados = registros[posicoes < 0].unique()
+    return df_final.reset_index(drop=True), np.asarray(nao_encontrados, dtype=object)
 
-    # Modalidade
-    if "modalidade" in df_merged.columns:
-        df_final["Modalidade"] = df_merged["modalidade"].astype(str)
-    else:
-        df_final["Modalidade"] = ""
 
-    # UF
-    if "uf" in df_merged.columns:
-        df_final["UF"] = df_merged["uf"].astype(str)
+def enriquecer_consolidado_com_cadastro(
+    caminho_consolidado: Path,
+    caminho_cadastro: Path,
+    caminho_saida: Path,
+    linhas_por_lote: int | None = None,
+) -> list[str]:
+    # Faz o join entre: - consolidado_despesas  (RegistroANS, Ano, Trimestre, ValorDespesas) - cadastro de operadoras (índice compacto .parquet ou o CSV bruto com REGISTRO_OPERADORA, CNPJ, Razao_Social, Modalidade, UF, ...) usando: RegistroANS (consolidado)  <->  REGISTRO_OPERADORA (cadastro) Saída: tabela (Parquet particionado por Ano/Trimestre, ou CSV) com colunas: - RegistroANS - CNPJ - RazaoSocial - Modalidade - UF - Ano - Trimestre - ValorDespesas Com linhas_por_lote, o consolidado é lido, enriquecido e gravado em lotes desse tamanho (memória limitada); o resultado é o mesmo do modo em memória. Retorna os RegistroANS sem correspondência no cadastro (também informados no log).
+    indice = carregar_indice_cadastro(caminho_cadastro)
+    nao_encontrados: set[str] = set()
+
+    if linhas_por_lote is None:
+        # Lê consolidado (tabela intermediária Parquet ou CSV)
+        df_final, sem_match = _enriquecer_lote(ler_tabela(caminho_consolidado), indice)
+        salvar_tabela(df_final, caminho_saida)
+        nao_encontrados.update(sem_match)
     else:
-        df_final["UF"] = ""
+        with EscritorTabela(caminho_saida) as escritor:
+            for lote in iterar_tabela(caminho_consolidado, linhas_por_lote):
+                df_final, sem_match = _enriquecer_lote(lote, indice)
+                escritor.escrever(df_final)
+                nao_encontrados.update(sem_match)
 
-    # Ano, Trimestre, ValorDespesas
-    df_final["Ano"] = df_merged["ano"] if "ano" in df_merged.columns else None
-    df_final["Trimestre"] = df_merged["trimestre"] if "trimestre" in df_merged.columns else None
-    df_final["ValorDespesas"] = df_merged["valordespesas"] if "valordespesas" in df_merged.columns else None
+    if nao_encontrados:
+        exemplos = ", ".join(sorted(str(r) for r in nao_encontrados)[:10])
+        print(f"  {len(nao_encontrados)} RegistroANS sem correspondência no cadastro (ex.: {exemplos}).")
 
-    caminho_saida.parent.mkdir(parents=True, exist_ok=True)
-    df_final.to_csv(caminho_saida, index=False, encoding="utf-8")
+    return sorted(str(r) for r in nao_encontrados)
@@ -1,86 +1,271 @@
 from __future__ import annotations
 
+import csv
+import io
+import json
+import os
 import re
 import unicodedata
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Iterable, List
+from typing import BinaryIO, Iterable, Iterator, List, NamedTuple
 
+import numpy as np
 import pandas as pd
 
 
-def extrair_arquivos_zip(arquivos_zip: Iterable[Path], destino_processed: Path) -> List[Path]:
-    # Recebe uma lista de arquivos .zip e extrai o conteúdo para a pasta destino_processed. Retorna a lista de arquivos extraídos (CSV/TXT/XLS/XLSX).
-    destino_processed.mkdir(parents=True, exist_ok=True)
+EXTENSOES_DADOS = (".csv", ".txt", ".xls", ".xlsx")
+
+
+class MembroZip(NamedTuple):
+    # Um arquivo de dados dentro de um .zip baixado. É a unidade que alimenta a etapa de leitura, sem extrair nada para o disco.
+    zip_path: Path
+    nome: str
+    tamanho: int
+    crc: int
+
+
+def listar_membros_zip(arquivos_zip: Iterable[Path], caminho_manifesto: Path | None = None) -> List[MembroZip]:
+    # Recebe uma lista de arquivos .zip e monta o manifesto dos arquivos de dados (CSV/TXT/XLS/XLSX) contidos neles: zip, nome do membro, tamanho e CRC. Nada é extraído; os membros são lidos direto do zip depois. Se caminho_manifesto for informado, o manifesto também é salvo em JSON.
+    membros: List[MembroZip] = []
 
     for zip_path in arquivos_zip:
         with zipfile.ZipFile(zip_path, "r") as zf:
-            zf.extractall(destino_processed)
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                if Path(info.filename).suffix.lower() not in EXTENSOES_DADOS:
+                    continue
+                membros.append(MembroZip(Path(zip_path), info.filename, info.file_size, info.CRC))
+
+    if caminho_manifesto is not None:
+        caminho_manifesto.parent.mkdir(parents=True, exist_ok=True)
+        with open(caminho_manifesto, "w", encoding="utf-8") as f:
+            json.dump(
+                [
+                    {"zip": str(m.zip_path), "membro": m.nome, "tamanho": m.tamanho, "crc": m.crc}
+                    for m in membros
+                ],
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+
+    return membros
+
+
+def identificar_arquivos_despesas(membros: Iterable[MembroZip]) -> List[MembroZip]:
+    # Identifica arquivos que potencialmente contêm dados de despesas/sinistros. Por enquanto, simplificamos: consideramos todos os arquivos CSV/TXT/XLS/XLSX dos zips como candidatos a terem informações relevantes (a checagem de layout acontece na leitura).
+    return [m for m in membros if Path(m.nome).suffix.lower() in EXTENSOES_DADOS]
+
+
+@contextmanager
+def _abrir_origem(origem: Path | MembroZip) -> Iterator[BinaryIO]:
+    # Abre um arquivo em disco ou um membro de zip (via ZipFile.open, em streaming) como arquivo binário.
+    if isinstance(origem, MembroZip):
+        with zipfile.ZipFile(origem.zip_path, "r") as zf:
+            with zf.open(origem.nome, "r") as f:
+                yield f
+    else:
+        with open(origem, "rb") as f:
+            yield f
+
+
+def _nome_origem(origem: Path | MembroZip) -> Path:
+    return Path(origem.nome) if isinstance(origem, MembroZip) else Path(origem)
+
+
+class DialetoCSV(NamedTuple):
+    # Formato detectado de um CSV a partir da amostra inicial: encoding, separador, separador decimal e nomes das colunas do cabeçalho (como estão no arquivo).
+    encoding: str
+    sep: str
+    decimal: str
+    colunas: tuple[str, ...]
+
+
+TAMANHO_AMOSTRA_DIALETO = 64 * 1024
+SEPARADORES_CANDIDATOS = (";", ",", "\t", "|")
 
-    # Depois de extrair, varre a pasta e pega só arquivos de dados
-    extraidos: List[Path] = []
-    for ext in ("*.csv", "*.txt", "*.xls", "*.xlsx"):
-        extraidos.extend(destino_processed.glob(ext))
+# Colunas do layout de demonstrações contábeis que a pipeline usa, com o dtype de leitura
+COLUNAS_DESPESAS = {
+    "reg_ans": "string",
+    "vl_saldo_final": "float64",
+}
 
-    return extraidos
+_cache_dialetos: dict[tuple, DialetoCSV] = {}
 
 
-def identificar_arquivos_despesas(destino_processed: Path) -> List[Path]:
-    # Identifica arquivos que potencialmente contêm dados de despesas/sinistros. Por enquanto, simplificamos: consideramos todos os arquivos CSV/TXT/XLS/XLSX extraídos dos zips como candidatos a terem informações relevantes.
-    arquivos: List[Path] = []
-    for ext in ("*.csv", "*.txt", "*.xls", "*.xlsx"):
-        arquivos.extend(destino_processed.glob(ext))
-    return arquivos
+def _chave_origem(origem: Path | MembroZip) -> tuple:
+    # Identifica uma versão específica do arquivo: membros de zip pelo CRC, arquivos em disco por tamanho + mtime.
+    if isinstance(origem, MembroZip):
+        return (str(origem.zip_path), origem.nome, origem.tamanho, origem.crc)
+    stat = Path(origem).stat()
+    return (str(origem), stat.st_size, stat.st_mtime_ns)
 
 
-def _ler_arquivo_generico(caminho: Path) -> pd.DataFrame:
-    # Lê um arquivo em formato CSV, TXT ou XLS/XLSX e devolve um DataFrame pandas. Tenta automaticamente: - encoding UTF-8 e, se falhar, Latin-1 - separadores ; e ,
-    sufixo = caminho.suffix.lower()
+def _decodificar_amostra(amostra: bytes) -> tuple[str, str]:
+    # Decide o encoding pela amostra: BOM -> utf-8-sig; UTF-8 válido -> utf-8; senão latin1. A amostra pode terminar no meio de um caractere multibyte, então um erro só nos últimos bytes não descarta o UTF-8.
+    if amostra.startswith(b"\xef\xbb\xbf"):
+        return "utf-8-sig", amostra[3:].decode("utf-8", errors="ignore")
+
+    try:
+        return "utf-8", amostra.decode("utf-8")
+    except UnicodeDecodeError as e:
+        if e.start >= len(amostra) - 3:
+            return "utf-8", amostra[: e.start].decode("utf-8")
+        return "latin1", amostra.decode("latin1")
+
+
+def _detectar_separador(linhas: list[str]) -> str:
+    # Escolhe o separador que gera o mesmo número de campos (> 1) em todas as linhas da amostra; em caso de empate, o que gera mais campos.
+    melhor_sep, melhor_campos = ";", 0
+    for sep in SEPARADORES_CANDIDATOS:
+        contagens = {len(campos) for campos in csv.reader(linhas, delimiter=sep)}
+        if len(contagens) == 1:
+            campos = contagens.pop()
+            if campos > melhor_campos:
+                melhor_sep, melhor_campos = sep, campos
+    return melhor_sep
+
+
+def _detectar_decimal(linhas: list[str], sep: str) -> str:
+    # Conta campos no formato "123,45" vs "123.45" nas linhas de dados da amostra.
+    if sep == ",":
+        return "."
+
+    virgula = ponto = 0
+    for campos in csv.reader(linhas[1:], delimiter=sep):
+        for campo in campos:
+            campo = campo.strip()
+            if re.fullmatch(r"-?\d+,\d+", campo):
+                virgula += 1
+            elif re.fullmatch(r"-?\d+\.\d+", campo):
+                ponto += 1
+    return "," if virgula > ponto else "."
+
+
+def detectar_dialeto_csv(origem: Path | MembroZip) -> DialetoCSV:
+    # Detecta encoding, separador e decimal lendo só os primeiros KB do arquivo (ou do membro do zip). O resultado fica em cache por versão do arquivo, então cada arquivo é inspecionado uma única vez.
+    chave = _chave_origem(origem)
+    if chave in _cache_dialetos:
+        return _cache_dialetos[chave]
+
+    with _abrir_origem(origem) as f:
+        amostra = f.read(TAMANHO_AMOSTRA_DIALETO)
+        arquivo_inteiro = len(amostra) < TAMANHO_AMOSTRA_DIALETO
+
+    encoding, texto = _decodificar_amostra(amostra)
+    linhas = texto.splitlines()
+    if not arquivo_inteiro and len(linhas) > 1:
+        # Descarta a última linha, que provavelmente foi cortada pela amostra
+        linhas = linhas[:-1]
+    linhas = [linha for linha in linhas if linha.strip()]
+
+    if not linhas:
+        raise ValueError(f"Arquivo vazio: {origem}")
+
+    sep = _detectar_separador(linhas)
+    decimal = _detectar_decimal(linhas, sep)
+    colunas = tuple(next(csv.reader(linhas[:1], delimiter=sep)))
+
+    dialeto = DialetoCSV(encoding, sep, decimal, colunas)
+    _cache_dialetos[chave] = dialeto
+    return dialeto
+
+
+def ler_csv(origem: Path | MembroZip, colunas: dict[str, str] | None = None) -> pd.DataFrame:
+    # Lê um CSV em uma única passada com o engine C do pandas, usando o dialeto detectado. colunas mapeia nome normalizado -> dtype (ex.: {"reg_ans": "string"}); só essas colunas são lidas (as que não existirem no arquivo são ignoradas). Sem colunas, lê tudo.
+    dialeto = detectar_dialeto_csv(origem)
+
+    usecols: list[str] | None = None
+    dtype: dict[str, str] | None = None
+    if colunas is not None:
+        originais = {_normalizar_nome(c): c for c in dialeto.colunas}
+        usecols = [originais[nome] for nome in colunas if nome in originais]
+        dtype = {originais[nome]: tipo for nome, tipo in colunas.items() if nome in originais}
+        if not usecols:
+            return pd.DataFrame()
+
+    def _ler(encoding: str, dtype: dict[str, str] | None) -> pd.DataFrame:
+        with _abrir_origem(origem) as f:
+            return pd.read_csv(
+                f,
+                sep=dialeto.sep,
+                decimal=dialeto.decimal,
+                encoding=encoding,
+                engine="c",
+                usecols=usecols,
+                dtype=dtype,
+            )
+
+    encoding = dialeto.encoding
+    try:
+        try:
+            return _ler(encoding, dtype)
+        except UnicodeDecodeError:
+            # A amostra era ASCII/UTF-8, mas o restante do arquivo não: relê como latin1 e corrige o cache
+            encoding = "latin1"
+            _cache_dialetos[_chave_origem(origem)] = dialeto._replace(encoding=encoding)
+            return _ler(encoding, dtype)
+    except ValueError:
+        # Algum valor numérico não bate com o dtype: lê como texto e converte com coerção (valores inválidos viram NaN)
+        df = _ler(encoding, {col: "string" for col in dtype} if dtype else None)
+        for col, tipo in (dtype or {}).items():
+            if tipo.startswith("float"):
+                df[col] = pd.to_numeric(df[col].str.strip().str.replace(dialeto.decimal, ".", regex=False), errors="coerce")
+        return df
+
+
+def _ler_arquivo_generico(origem: Path | MembroZip, colunas: dict[str, str] | None = None) -> pd.DataFrame:
+    # Lê um arquivo em formato CSV, TXT ou XLS/XLSX (em disco ou dentro de um zip) e devolve um DataFrame pandas. Para CSV/TXT o formato (encoding, separador, decimal) é detectado antes e o arquivo é lido uma vez só, restrito às colunas pedidas.
+    sufixo = _nome_origem(origem).suffix.lower()
 
     if sufixo in [".csv", ".txt"]:
-        erros: list[Exception] = []
-
-        for encoding in ("utf-8", "latin1"):
-            for sep in (";", ","):
-                try:
-                    return pd.read_csv(
-                        caminho,
-                        sep=sep,
-                        engine="python",
-                        encoding=encoding,
-                    )
-                except Exception as e:
-                    erros.append(e)
-
-        raise erros[-1] if erros else ValueError(f"Não foi possível ler o arquivo: {caminho}")
+        return ler_csv(origem, colunas)
 
     elif sufixo in [".xls", ".xlsx"]:
+        # Leitores de Excel precisam de um arquivo com seek; lemos o membro inteiro para memória
+        with _abrir_origem(origem) as f:
+            conteudo = io.BytesIO(f.read())
         try:
-            return pd.read_excel(caminho)
+            return pd.read_excel(conteudo)
         except Exception:
             # fallback genérico
-            return pd.read_excel(caminho, engine="openpyxl")
+            conteudo.seek(0)
+            return pd.read_excel(conteudo, engine="openpyxl")
 
     else:
-        raise ValueError(f"Formato de arquivo não suportado: {caminho}")
+        raise ValueError(f"Formato de arquivo não suportado: {origem}")
+
+
+def _normalizar_nome(col: object) -> str:
+    # Normaliza um nome de coluna: - remove aspas e espaços extras - deixa tudo minúsculo - remove acentos - substitui caracteres não alfanuméricos por '_'
+    nome = str(col).strip().strip('"').lower()
+    nome = unicodedata.normalize("NFKD", nome)
+    nome = "".join(ch for ch in nome if not unicodedata.combining(ch))
+    nome = re.sub(r"[^a-z0-9]+", "_", nome)
+    return nome.strip("_")
 
 
 def _normalizar_colunas(df: pd.DataFrame) -> pd.DataFrame:
-    # Normaliza os nomes das colunas: - remove aspas e espaços extras - deixa tudo minúsculo - remove acentos - substitui caracteres não alfanuméricos por '_'
-    colunas_novas: list[str] = []
-
-    for col in df.columns:
-        nome = str(col).strip().strip('"').lower()
-        nome = unicodedata.normalize("NFKD", nome)
-        nome = "".join(ch for ch in nome if not unicodedata.combining(ch))
-        nome = re.sub(r"[^a-z0-9]+", "_", nome)
-        nome = nome.strip("_")
-        colunas_novas.append(nome)
-
-    df.columns = colunas_novas
+    # Normaliza os nomes das colunas (ver _normalizar_nome).
+    df.columns = [_normalizar_nome(col) for col in df.columns]
     return df
 
 
+def _extrair_ano_trimestre(origem: Path | MembroZip) -> tuple[int | None, int | None]:
+    # Extrai ano e trimestre de um arquivo. Para membros de zip, tenta primeiro o nome do membro e depois o nome do próprio zip.
+    if isinstance(origem, MembroZip):
+        ano, tri = _extrair_ano_trimestre_do_nome(Path(origem.nome))
+        if ano is None:
+            ano, tri = _extrair_ano_trimestre_do_nome(origem.zip_path)
+        return ano, tri
+
+    return _extrair_ano_trimestre_do_nome(origem)
+
+
 def _extrair_ano_trimestre_do_nome(caminho: Path) -> tuple[int | None, int | None]:
     # Tenta extrair ano e trimestre do nome do arquivo usando regex. Suporta formatos: - '2009_1_trimestre' - '2009-2-tri' - '1T2011', '2t2025', etc.
     nome = caminho.stem.lower()  # sem extensão
@@ -102,30 +287,57 @@ def _extrair_ano_trimestre_do_nome(caminho: Path) -> tuple[int | None, int | Non
     return None, None
 
 
-def ler_e_normalizar_arquivos(arquivos_despesas: Iterable[Path]) -> pd.DataFrame:
-    # Lê todos os arquivos de demonstrações contábeis dos trimestres selecionados e produz um DataFrame consolidado com: - RegistroANS   (REG_ANS) - Ano - Trimestre - ValorDespesas (VL_SALDO_FINAL, por enquanto sem filtro por tipo de conta) Posteriormente, vamos enriquecer esses dados com CNPJ, Razão Social, UF etc. usando o cadastro de operadoras.
-    linhas: list[pd.DataFrame] = []
+def _processar_arquivo(origem: Path | MembroZip) -> tuple | None:
+    # Lê, normaliza e projeta um único arquivo de despesas. Roda tanto no caminho serial quanto nos processos do pool, então é a única fonte da lógica de leitura. Devolve buffers compactos em vez de um DataFrame: - códigos int32 + categorias distintas do REG_ANS (poucas centenas de operadoras) - array float64 dos valores - ano e trimestre. Retorna None se o arquivo não puder ser lido ou não tiver o layout esperado.
+    try:
+        df = _ler_arquivo_generico(origem, COLUNAS_DESPESAS)
+    except Exception:
+        # Não conseguiu ler esse arquivo, segue pro próximo
+        return None
 
-    for caminho in arquivos_despesas:
-        try:
-            df = _ler_arquivo_generico(caminho)
-        except Exception:
-            # Não conseguiu ler esse arquivo, segue pro próximo
-            continue
+    df = _normalizar_colunas(df)
+    colunas = df.columns
+
+    # Precisamos de pelo menos REG_ANS e VL_SALDO_FINAL
+    if "reg_ans" not in colunas or "vl_saldo_final" not in colunas:
+        # Este arquivo provavelmente não é o layout que esperamos
+        return None
+
+    ano, tri = _extrair_ano_trimestre(origem)
+
+    # REG_ANS vazio vira nulo (código -1), não uma operadora "<NA>": a linha segue sem cadastro e é descartada na validação
+    registros = df["reg_ans"].astype("string").str.strip()
+    codigos, categorias = pd.factorize(registros.mask(registros == ""))
+    valores = pd.to_numeric(df["vl_saldo_final"], errors="coerce").to_numpy(dtype="float64")
+
+    return codigos.astype("int32"), np.asarray(categorias, dtype=object), valores, ano, tri
 
-        df = _normalizar_colunas(df)
-        colunas = df.columns
 
-        # Precisamos de pelo menos REG_ANS e VL_SALDO_FINAL
-        if "reg_ans" not in colunas or "vl_saldo_final" not in colunas:
-            # Este arquivo provavelmente não é o layout que esperamos
+def ler_e_normalizar_arquivos(
+    arquivos_despesas: Iterable[Path | MembroZip],
+    workers: int | None = None,
+) -> pd.DataFrame:
+    # Lê todos os arquivos de demonstrações contábeis dos trimestres selecionados e produz um DataFrame consolidado com: - RegistroANS   (REG_ANS) - Ano - Trimestre - ValorDespesas (VL_SALDO_FINAL, por enquanto sem filtro por tipo de conta) Os arquivos são processados em paralelo num pool de processos (um arquivo por tarefa) com até `workers` processos (padrão: número de CPUs); workers=1 processa tudo no processo atual. O resultado é o mesmo nos dois modos, na ordem dos arquivos de entrada. Posteriormente, vamos enriquecer esses dados com CNPJ, Razão Social, UF etc. usando o cadastro de operadoras.
+    arquivos = list(arquivos_despesas)
+    workers = min(workers or os.cpu_count() or 1, max(len(arquivos), 1))
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            resultados = list(executor.map(_processar_arquivo, arquivos))
+    else:
+        resultados = [_processar_arquivo(origem) for origem in arquivos]
+
+    linhas: list[pd.DataFrame] = []
+
+    for resultado in resultados:
+        if resultado is None:
             continue
 
-        ano, tri = _extrair_ano_trimestre_do_nome(caminho)
+        codigos, categorias, valores, ano, tri = resultado
 
         temp = pd.DataFrame()
-        temp["RegistroANS"] = df["reg_ans"].astype(str).str.strip()
-        temp["ValorDespesas"] = pd.to_numeric(df["vl_saldo_final"], errors="coerce")
+        temp["RegistroANS"] = pd.array(categorias, dtype="string").take(codigos, allow_fill=True)
+        temp["ValorDespesas"] = valores
         temp["Ano"] = ano
         temp["Trimestre"] = tri
 
@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+from typing import Any, NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from aggregation import calcular_estado_grupos
+from armazenamento import ler_tabela, particoes_da_tabela, remover_caminho, salvar_tabela, substituir_particoes
+from cubo import gerar_cubo
+from enrichment import enriquecer_consolidado_com_cadastro
+from file_processing import identificar_arquivos_despesas, ler_e_normalizar_arquivos, listar_membros_zip
+from validation import validar_dados_consolidados
+
+
+Trimestre = tuple[int, int]
+
+
+class TabelasIncrementais(NamedTuple):
+    # Tabelas particionadas por Ano/Trimestre que a ingestão incremental atualiza partição a partição. cubo guarda as células UF/Modalidade/Ano/Trimestre (ver cubo.gerar_cubo) e fica por último: é a última tabela trocada.
+    consolidado: Path
+    enriquecido: Path
+    validado: Path
+    cubo: Path
+
+
+def trimestres_das_tabelas(tabelas: TabelasIncrementais) -> list[Trimestre] | None:
+    # Trimestres presentes nas tabelas, em ordem. None se as tabelas não tiverem exatamente as mesmas partições (ex.: ingestão interrompida no meio) ou tiverem partições sem ano/trimestre: nesses casos só a reconstrução completa deixa tudo consistente.
+    particoes = [particoes_da_tabela(tabela) for tabela in tabelas]
+    if any(p != particoes[0] for p in particoes[1:]):
+        return None
+    if any(len(p) != 2 or None in p for p in particoes[0]):
+        return None
+    return [(ano, tri) for ano, tri in particoes[0]]
+
+
+def ler_metadados(caminho: Path) -> dict[str, Any]:
+    try:
+        with open(caminho, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def salvar_metadados(caminho: Path, hash_cadastro: str | None, trimestres: list[Trimestre]) -> None:
+    # Registra com qual índice do cadastro as tabelas incrementais foram enriquecidas. Se o cadastro mudar, os trimestres antigos teriam sido enriquecidos de outro jeito numa reconstrução, então a ingestão incremental deixa de valer.
+    caminho.parent.mkdir(parents=True, exist_ok=True)
+    temporario = caminho.with_name(caminho.name + ".tmp")
+    with open(temporario, "w", encoding="utf-8") as f:
+        json.dump({"cadastro": hash_cadastro, "trimestres": [list(t) for t in trimestres]}, f, indent=2)
+    os.replace(temporario, caminho)
+
+
+def motivo_para_reconstruir(tabelas: TabelasIncrementais, caminho_metadados: Path, hash_cadastro: str | None) -> str | None:
+    # Por que a ingestão incremental não pode partir do estado atual (None se pode).
+    trimestres = trimestres_das_tabelas(tabelas)
+    if not trimestres:
+        return "sem estado por trimestre de uma execução anterior"
+
+    metadados = ler_metadados(caminho_metadados)
+    if metadados.get("trimestres") != [list(t) for t in trimestres]:
+        return "estado por trimestre não corresponde ao registrado"
+    if metadados.get("cadastro") != hash_cadastro:
+        return "cadastro de operadoras mudou desde a última execução"
+    return None
+
+
+def ingerir_trimestres(
+    zips_por_trimestre: dict[Trimestre, list[Path]],
+    retirar: list[Trimestre],
+    tabelas: TabelasIncrementais,
+    caminho_cadastro: Path,
+    diretorio_trabalho: Path,
+    workers: int | None = None,
+    linhas_por_lote: int | None = None,
+) -> dict[str, int]:
+    # Processa só os zips dos trimestres novos (consolidação, enriquecimento, validação e cubo, com as mesmas funções da pipeline completa) em tabelas à parte em diretorio_trabalho, e depois troca as partições desses trimestres nas tabelas e apaga as dos trimestres em retirar. O cubo é trocado por último: se algo falhar no meio, as partições deixam de bater e a próxima execução reconstrói tudo. Retorna as linhas descartadas na validação, por motivo.
+    remover_caminho(diretorio_trabalho)
+    diretorio_trabalho.mkdir(parents=True)
+    novas = TabelasIncrementais(*(diretorio_trabalho / tabela.name for tabela in tabelas))
+    rejeicoes: dict[str, int] = {}
+
+    zips = [caminho for caminhos in zips_por_trimestre.values() for caminho in caminhos]
+    if zips:
+        arquivos_despesas = identificar_arquivos_despesas(listar_membros_zip(zips))
+        df = ler_e_normalizar_arquivos(arquivos_despesas, workers=workers)
+
+        particoes = df[["Ano", "Trimestre"]].drop_duplicates()
+        fora = [
+            (ano, tri) for ano, tri in particoes.itertuples(index=False, name=None)
+            if pd.isna(ano) or pd.isna(tri) or (int(ano), int(tri)) not in zips_por_trimestre
+        ]
+        if fora:
+            raise ValueError(
+                f"Os zips de {', '.join(f'{a}/{t}' for a, t in zips_por_trimestre)} têm linhas de outros trimestres "
+                f"({', '.join(f'{a}/{t}' for a, t in fora)}); rode a pipeline completa."
+            )
+        print(f"{len(df)} linhas normalizadas.")
+
+        salvar_tabela(df, novas.consolidado)
+        del df
+        enriquecer_consolidado_com_cadastro(novas.consolidado, caminho_cadastro, novas.enriquecido, linhas_por_lote=linhas_por_lote)
+        rejeicoes = validar_dados_consolidados(novas.enriquecido, novas.validado, linhas_por_lote=linhas_por_lote)
+        gerar_cubo(novas.validado, novas.cubo, workers=workers)
+
+    for tabela, nova in zip(tabelas, novas):
+        substituir_particoes(tabela, nova, remover=retirar)
+    remover_caminho(diretorio_trabalho)
+    return rejeicoes
+
+
+def _bits(serie: pd.Series) -> np.ndarray:
+    return serie.to_numpy(dtype=np.float64, na_value=np.nan).view(np.int64)
+
+
+def verificar_por_reconstrucao(caminho_validado: Path, caminho_agregado: Path) -> int:
+    # Refaz a agregação inteira a partir da tabela validada (como a pipeline completa) e confere que ela é idêntica, bit a bit, à tabela agregada atual. Levanta RuntimeError com os grupos divergentes; retorna o número de grupos conferidos.
+    esperado = calcular_estado_grupos(caminho_validado).como_dataframe()
+    atual = ler_tabela(caminho_agregado)
+
+    chaves = ["RazaoSocial", "UF"]
+    if len(esperado) != len(atual) or not esperado[chaves].equals(atual[chaves]):
+        raise RuntimeError(
+            f"Agregados divergem da reconstrução: {len(atual)} grupos na tabela, {len(esperado)} na reconstrução."
+        )
+
+    divergentes = np.zeros(len(esperado), dtype=bool)
+    for coluna in ("TotalDespesas", "MediaDespesas", "DesvioPadraoDespesas"):
+        divergentes |= _bits(esperado[coluna]) != _bits(atual[coluna])
+    if divergentes.any():
+        exemplos = ", ".join(f"{r}/{u}" for r, u in esperado.loc[divergentes, chaves].head(5).itertuples(index=False, name=None))
+        raise RuntimeError(f"Agregados divergem da reconstrução em {int(divergentes.sum())} grupos (ex.: {exemplos}).")
+    return len(esperado)
@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import cProfile
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+
+import pyarrow.parquet as pq
+
+from armazenamento import arquivos_da_tabela, eh_tabela_parquet
+
+
+NOME_RELATORIO = "run_report.json"
+# Histórico de todas as execuções (uma linha JSON por execução), para acompanhar a vazão ao longo do tempo
+NOME_HISTORICO = "run_reports.jsonl"
+
+
+def zerar_pico_memoria() -> bool:
+    # Zera o pico de RSS do processo (VmHWM) no Linux, para medir o pico de cada etapa separadamente. Retorna False onde não é suportado (aí o pico medido é o acumulado do processo).
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def pico_memoria_mb() -> float:
+    try:
+        with open("/proc/self/status", "r") as f:
+            for linha in f:
+                if linha.startswith("VmHWM:"):
+                    return int(linha.split()[1]) / 1024
+    except OSError:
+        pass
+    return _maxrss_mb(resource.RUSAGE_SELF)
+
+
+def _maxrss_mb(quem: int) -> float:
+    # ru_maxrss: KB no Linux, bytes no macOS
+    pico = resource.getrusage(quem).ru_maxrss
+    return pico / (1024 * 1024) if sys.platform == "darwin" else pico / 1024
+
+
+def tamanho_em_bytes(caminho: Path) -> int | None:
+    # Tamanho de um arquivo ou de todos os arquivos de um diretório (tabela particionada, snapshot). None se não existir.
+    if caminho.is_file():
+        return caminho.stat().st_size
+    if caminho.is_dir():
+        return sum(p.stat().st_size for p in caminho.rglob("*") if p.is_file())
+    return None
+
+
+def contar_linhas(caminho: Path) -> int | None:
+    # Linhas de uma tabela Parquet intermediária, lidas só dos metadados dos arquivos (sem ler os dados). None para outros formatos ou se a tabela não existir.
+    if not eh_tabela_parquet(caminho) or not caminho.exists():
+        return None
+    return sum(pq.ParquetFile(arquivo).metadata.num_rows for arquivo in arquivos_da_tabela(caminho))
+
+
+def _resumo_caminhos(caminhos: Iterable[Path]) -> dict[str, Any]:
+    # Bytes e linhas de cada caminho e o total. Linhas só são conhecidas para tabelas Parquet (ver contar_linhas).
+    arquivos = [
+        {"caminho": str(c), "bytes": tamanho_em_bytes(c), "linhas": contar_linhas(c)}
+        for c in caminhos
+    ]
+    linhas = [a["linhas"] for a in arquivos if a["linhas"] is not None]
+    return {
+        "bytes": sum(a["bytes"] for a in arquivos if a["bytes"] is not None),
+        "linhas": sum(linhas) if linhas else None,
+        "arquivos": arquivos,
+    }
+
+
+class MedicaoEtapa:
+    # Medições de uma etapa. Tempo, CPU, memória, bytes e linhas são preenchidos por RelatorioExecucao.medir; a etapa pode registrar descartes por motivo (rejeicoes) e outros contadores próprios.
+
+    def __init__(self, etapa: str):
+        self.etapa = etapa
+        self.situacao = "executada"
+        self.rejeicoes: dict[str, int] = {}
+        self.contadores: dict[str, Any] = {}
+        self.dados: dict[str, Any] = {}
+
+    def registrar_rejeicoes(self, rejeicoes: dict[str, int] | None) -> None:
+        for motivo, quantidade in (rejeicoes or {}).items():
+            self.rejeicoes[motivo] = self.rejeicoes.get(motivo, 0) + int(quantidade)
+
+    def como_dict(self) -> dict[str, Any]:
+        return {
+            "etapa": self.etapa,
+            "situacao": self.situacao,
+            **self.dados,
+            "rejeicoes": self.rejeicoes,
+            "contadores": self.contadores,
+        }
+
+
+class RelatorioExecucao:
+    # Relatório estruturado de uma execução da pipeline: uma entrada por etapa com tempo de parede, tempo de CPU (incluindo os processos filhos do pool de leitura), pico de RSS, linhas e bytes de entrada/saída e descartes por motivo. Gravado em <diretorio>/run_report.json e acrescentado a <diretorio>/run_reports.jsonl. Com diretorio_perfis, cada etapa executada também grava um dump do cProfile (<etapa>.prof, para abrir com pstats ou snakeviz).
+
+    def __init__(self, diretorio: Path, diretorio_perfis: Path | None = None, parametros: dict[str, Any] | None = None):
+        self.diretorio = diretorio
+        self.diretorio_perfis = diretorio_perfis
+        self.etapas: list[MedicaoEtapa] = []
+        self._inicio = time.perf_counter()
+        self._cabecalho = {
+            "inicio": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "parametros": parametros or {},
+            "ambiente": {
+                "python": platform.python_version(),
+                "plataforma": platform.platform(),
+                "cpus": os.cpu_count(),
+            },
+        }
+
+    def pular(self, etapa: str, motivo: str) -> None:
+        medicao = MedicaoEtapa(etapa)
+        medicao.situacao = "pulada"
+        medicao.contadores["motivo"] = motivo
+        self.etapas.append(medicao)
+
+    @contextmanager
+    def medir(
+        self,
+        etapa: str,
+        entradas: Iterable[Path] = (),
+        saidas: Iterable[Path] = (),
+    ) -> Iterator[MedicaoEtapa]:
+        # Mede o bloco como uma etapa. Linhas e bytes das entradas são lidos antes e os das saídas depois do bloco; se o bloco falhar, a etapa fica registrada como "falhou" e o erro segue adiante.
+        medicao = MedicaoEtapa(etapa)
+        self.etapas.append(medicao)
+        entradas = list(entradas)
+        saidas = list(saidas)
+
+        resumo_entradas = _resumo_caminhos(entradas)
+        pico_por_etapa = zerar_pico_memoria()
+        perfil = cProfile.Profile() if self.diretorio_perfis is not None else None
+
+        tempos_antes = os.times()
+        inicio = time.perf_counter()
+        if perfil is not None:
+            perfil.enable()
+        try:
+            yield medicao
+        except BaseException:
+            medicao.situacao = "falhou"
+            raise
+        finally:
+            if perfil is not None:
+                perfil.disable()
+            segundos = time.perf_counter() - inicio
+            tempos_depois = os.times()
+
+            cpu = sum(
+                getattr(tempos_depois, campo) - getattr(tempos_antes, campo)
+                for campo in ("user", "system", "children_user", "children_system")
+            )
+            resumo_saidas = _resumo_caminhos(saidas)
+            linhas_saida = resumo_saidas["linhas"]
+
+            medicao.dados = {
+                "segundos": round(segundos, 4),
+                "cpu_segundos": round(cpu, 4),
+                "pico_memoria_mb": round(pico_memoria_mb(), 1),
+                "pico_memoria_por_etapa": pico_por_etapa,
+                # Pico dos processos filhos (pool de leitura); acumulado desde o início da execução
+                "pico_memoria_filhos_mb": round(_maxrss_mb(resource.RUSAGE_CHILDREN), 1),
+                "entrada": resumo_entradas,
+                "saida": resumo_saidas,
+                "linhas_por_segundo": round(linhas_saida / segundos, 1) if linhas_saida and segundos > 0 else None,
+            }
+
+            if perfil is not None:
+                self.diretorio_perfis.mkdir(parents=True, exist_ok=True)
+                perfil.dump_stats(str(self.diretorio_perfis / f"{etapa}.prof"))
+                medicao.dados["perfil"] = str(self.diretorio_perfis / f"{etapa}.prof")
+
+    def como_dict(self) -> dict[str, Any]:
+        return {
+            **self._cabecalho,
+            "segundos_total": round(time.perf_counter() - self._inicio, 4),
+            "etapas": [m.como_dict() for m in self.etapas],
+        }
+
+    def salvar(self) -> Path:
+        # Grava run_report.json (trocado de uma vez, como o manifesto) e acrescenta a execução ao histórico.
+        self.diretorio.mkdir(parents=True, exist_ok=True)
+        relatorio = self.como_dict()
+
+        caminho = self.diretorio / NOME_RELATORIO
+        temporario = caminho.with_name(caminho.name + ".tmp")
+        with open(temporario, "w", encoding="utf-8") as f:
+            json.dump(relatorio, f, ensure_ascii=False, indent=2)
+        os.replace(temporario, caminho)
+
+        with open(self.diretorio / NOME_HISTORICO, "a", encoding="utf-8") as f:
+            f.write(json.dumps(relatorio, ensure_ascii=False) + "\n")
+        return caminho
@@ -1,88 +1,565 @@
 from __future__ import annotations
 
+import argparse
 from pathlib import Path
+from typing import Any, Callable, Iterable, NamedTuple
 
-from api_ans import baixar_arquivos_dos_ultimos_tres_trimestres
+import aggregation
+import armazenamento
+import carga_banco
+import cubo
+import enrichment
+import file_processing
+import motor_analitico
+import snapshot_api
+import validation
+from armazenamento import exportar_csv, ler_tabela, linhas_por_lote_para_memoria, salvar_tabela
+from api_ans import baixar_arquivos_dos_trimestres_novos, baixar_arquivos_dos_ultimos_tres_trimestres, descartar_validadores
+from carga_banco import LINHAS_POR_LOTE, SCHEMA_SQL, carregar_banco, conectar, descrever_url, linhas_no_banco
+from cubo import gerar_cubo
 from file_processing import (
-    extrair_arquivos_zip,
+    COLUNAS_DESPESAS,
+    listar_membros_zip,
     identificar_arquivos_despesas,
     ler_e_normalizar_arquivos,
     gerar_consolidado_despesas,
 )
-from enrichment import baixar_cadastro_operadoras, enriquecer_consolidado_com_cadastro
+from enrichment import (
+    baixar_cadastro_operadoras,
+    construir_indice_cadastro,
+    enriquecer_consolidado_com_cadastro,
+)
 from aggregation import agregar_despesas, gerar_zip_final
+from ingestao import (
+    TabelasIncrementais,
+    ingerir_trimestres,
+    motivo_para_reconstruir,
+    salvar_metadados,
+    trimestres_das_tabelas,
+    verificar_por_reconstrucao,
+)
+from instrumentacao import MedicaoEtapa, RelatorioExecucao
+from manifesto import ManifestoExecucao
+from motor_analitico import criar_banco_analitico
+from snapshot_api import gerar_snapshot_api
 from validation import validar_dados_consolidados
 
 
-def main() -> None:
+# Etapas na ordem de execução. "--force <etapa>" invalida a etapa e todas as seguintes.
+# Os downloads sempre rodam, mas são condicionais (só baixam o que mudou no servidor).
+ETAPAS = (
+    "download",
+    "consolidacao",
+    "cadastro",
+    "enriquecimento",
+    "validacao",
+    "agregacao",
+    "cubo",
+    "snapshot_api",
+    "analises",
+    "entregaveis",
+    "carga_banco",
+)
+
+
+def _parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Pipeline de dados da ANS (download, consolidação, enriquecimento e agregação).")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Processos usados na leitura dos arquivos de despesas (padrão: número de CPUs; 1 = serial) e no cubo, um por partição (padrão: serial).",
+    )
+    parser.add_argument(
+        "--linhas-por-lote",
+        type=int,
+        default=None,
+        help="Processa enriquecimento e validação em lotes desse número de linhas (memória limitada).",
+    )
+    parser.add_argument(
+        "--memoria-mb",
+        type=float,
+        default=None,
+        help="Orçamento de memória (MB) para enriquecimento e validação; define o tamanho dos lotes.",
+    )
+    parser.add_argument(
+        "--force",
+        choices=ETAPAS,
+        default=None,
+        metavar="ETAPA",
+        help=f"Reexecuta a etapa indicada e todas as seguintes, mesmo sem mudanças. Etapas: {', '.join(ETAPAS)}.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Processa só os trimestres novos da janela dos 3 últimos (retirando o que saiu dela) e refaz os agregados a partir da tabela validada. Sem tabelas de uma execução anterior, roda a pipeline completa.",
+    )
+    parser.add_argument(
+        "--verificar",
+        action="store_true",
+        help="Refaz a agregação inteira a partir da tabela validada e confere que os agregados são idênticos bit a bit.",
+    )
+    parser.add_argument(
+        "--banco-url",
+        default=None,
+        help="Carrega as tabelas do sql/schema.sql neste banco ao final (sqlite:///arquivo.sqlite, postgresql://... ou mysql://...).",
+    )
+    parser.add_argument(
+        "--perfil",
+        action="store_true",
+        help="Grava um dump do cProfile por etapa executada em data/perfis/<etapa>.prof.",
+    )
+    return parser.parse_args(argv)
+
+
+class CaminhosPipeline(NamedTuple):
+    # Pastas e arquivos da pipeline em data/.
+    raw: Path
+    processed: Path
+    final: Path
+    tabelas: TabelasIncrementais
+    cadastro_csv: Path
+    cadastro_indice: Path
+    agregado: Path
+    # Índice do cadastro e trimestres com que as tabelas incrementais foram geradas (ver ingestao.salvar_metadados)
+    metadados_ingestao: Path
+
+
+def _caminhos(data_dir: Path) -> CaminhosPipeline:
+    processed_dir = data_dir / "processed"
+    return CaminhosPipeline(
+        raw=data_dir / "raw",
+        processed=processed_dir,
+        final=data_dir / "final",
+        tabelas=TabelasIncrementais(
+            consolidado=processed_dir / "consolidado_despesas.parquet",
+            enriquecido=processed_dir / "consolidado_enriquecido.parquet",
+            validado=processed_dir / "consolidado_enriquecido_validado.parquet",
+            cubo=processed_dir / "cubo_despesas.parquet",
+        ),
+        cadastro_csv=processed_dir / "cadastro_operadoras.csv",
+        cadastro_indice=processed_dir / "cadastro_indice.parquet",
+        agregado=processed_dir / "despesas_agregadas.parquet",
+        metadados_ingestao=processed_dir / "estado_agregacao.json",
+    )
+
+
+def _codigo(*modulos: Any) -> list[Path]:
+    # Arquivos-fonte de uma etapa: mudanças no código também invalidam a etapa.
+    return [Path(m.__file__) for m in modulos]
+
+
+def _executar_etapa(
+    manifesto: ManifestoExecucao,
+    relatorio: RelatorioExecucao,
+    etapa: str,
+    entradas: Iterable[Path],
+    parametros: dict[str, Any],
+    saidas: Iterable[Path],
+    funcao: Callable[[MedicaoEtapa], Any],
+) -> Any:
+    # Executa a etapa só se entradas, parâmetros ou saídas mudaram desde a última execução registrada no manifesto, medindo-a no relatório da execução (funcao recebe a MedicaoEtapa para registrar descartes e contadores). Retorna o resultado de funcao(), ou None se a etapa foi pulada.
+    entradas = list(entradas)
+    saidas = list(saidas)
+
+    if not manifesto.precisa_executar(etapa, entradas, parametros, saidas):
+        print(f"[{etapa}] Sem mudanças desde a última execução, etapa pulada.")
+        relatorio.pular(etapa, "sem mudanças")
+        return None
+
+    # Arquivos-fonte (ver _codigo) invalidam a etapa, mas não são dados: ficam fora das linhas/bytes de entrada
+    dados_entrada = [p for p in entradas if p.suffix != ".py"]
+    with relatorio.medir(etapa, dados_entrada, saidas) as medicao:
+        resultado = funcao(medicao)
+    manifesto.registrar(etapa, entradas, parametros, saidas)
+    manifesto.salvar()
+    return resultado
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = _parse_args(argv)
+
     base_dir = Path(__file__).resolve().parent.parent
     data_dir = base_dir / "data"
-    raw_dir = data_dir / "raw"
-    processed_dir = data_dir / "processed"
-    final_dir = data_dir / "final"
 
-    raw_dir.mkdir(parents=True, exist_ok=True)
-    processed_dir.mkdir(parents=True, exist_ok=True)
-    final_dir.mkdir(parents=True, exist_ok=True)
+    for pasta in ("raw", "processed", "final"):
+        (data_dir / pasta).mkdir(parents=True, exist_ok=True)
+
+    linhas_por_lote = args.linhas_por_lote
+    if linhas_por_lote is None and args.memoria_mb is not None:
+        linhas_por_lote = linhas_por_lote_para_memoria(args.memoria_mb)
+
+    manifesto = ManifestoExecucao(data_dir / "manifesto_execucao.json")
+    if args.force:
+        manifesto.invalidar(ETAPAS[ETAPAS.index(args.force):])
+        manifesto.salvar()
+    if args.force == "download":
+        # Os downloads não passam pelo manifesto: forçá-los é descartar os validadores dos downloads condicionais
+        caminhos = _caminhos(data_dir)
+        descartar_validadores(caminhos.raw, caminhos.cadastro_csv)
+
+    # Relatório da execução (data/run_report.json), gravado mesmo se alguma etapa falhar
+    relatorio = RelatorioExecucao(
+        data_dir,
+        diretorio_perfis=data_dir / "perfis" if args.perfil else None,
+        parametros={
+            "workers": args.workers,
+            "linhas_por_lote": linhas_por_lote,
+            "force": args.force,
+            "incremental": args.incremental,
+        },
+    )
+    try:
+        _executar_pipeline(args, manifesto, relatorio, data_dir, linhas_por_lote)
+    finally:
+        print(f"Relatório da execução salvo em {relatorio.salvar()}.")
+
+
+def _preparar_cadastro(manifesto: ManifestoExecucao, relatorio: RelatorioExecucao, caminhos: CaminhosPipeline) -> str | None:
+    # Baixa o cadastro de operadoras (condicional, como os zips) e monta o índice compacto (RegistroANS inteiro -> CNPJ/RazaoSocial/Modalidade/UF), reaproveitado entre execuções e pela API. Roda uma vez por execução, antes da ingestão incremental ou da pipeline completa. Retorna o hash do índice (ver ingestao.salvar_metadados).
+    cadastro_csv = caminhos.cadastro_csv
+    cadastro_indice = caminhos.cadastro_indice
+    print("Baixando cadastro de operadoras ativas...")
+    with relatorio.medir("download_cadastro", saidas=[cadastro_csv]):
+        baixar_cadastro_operadoras(cadastro_csv)
 
-    # 1. Baixar zips dos 3 últimos trimestres
+    def _indexar_cadastro(medicao: MedicaoEtapa) -> None:
+        print("Montando índice do cadastro de operadoras...")
+        indice = construir_indice_cadastro(cadastro_csv, cadastro_indice)
+        print(f"{len(indice)} operadoras no índice do cadastro.")
+        medicao.contadores["operadoras"] = len(indice)
+
+    _executar_etapa(
+        manifesto,
+        relatorio,
+        "cadastro",
+        entradas=[cadastro_csv, *_codigo(enrichment, file_processing)],
+        parametros={},
+        saidas=[cadastro_indice],
+        funcao=_indexar_cadastro,
+    )
+    return manifesto.hash_caminho(cadastro_indice)
+
+
+def _reconstruir(
+    args: argparse.Namespace,
+    manifesto: ManifestoExecucao,
+    relatorio: RelatorioExecucao,
+    caminhos: CaminhosPipeline,
+    linhas_por_lote: int | None,
+    hash_cadastro: str | None,
+) -> bool:
+    # Pipeline completa até a agregação, a partir dos zips dos 3 últimos trimestres (cada etapa só roda se algo mudou, ver _executar_etapa). Retorna False se nenhuma linha foi lida dos zips.
+    raw_dir = caminhos.raw
+    processed_dir = caminhos.processed
+    cadastro_indice = caminhos.cadastro_indice
+
+    # 1. Baixar zips dos 3 últimos trimestres (condicional: arquivos inalterados não são baixados de novo)
     print("Baixando arquivos dos últimos 3 trimestres...")
-    zip_paths = baixar_arquivos_dos_ultimos_tres_trimestres(raw_dir)
+    with relatorio.medir("download") as medicao:
+        zip_paths = baixar_arquivos_dos_ultimos_tres_trimestres(raw_dir)
+        medicao.contadores["arquivos"] = len(zip_paths)
     print(f"{len(zip_paths)} arquivos .zip baixados.")
 
-    # 2. Extrair zips
-    print("Extraindo arquivos .zip...")
-    arquivos_extraidos = extrair_arquivos_zip(zip_paths, processed_dir)
-    print(f"{len(arquivos_extraidos)} arquivos extraídos.")
+    # 2-5. Listar arquivos dos zips, identificar despesas, ler/normalizar e salvar o consolidado
+    #      como tabela intermediária (Parquet particionado por Ano/Trimestre)
+    consolidado = caminhos.tabelas.consolidado
+    manifesto_zip = processed_dir / "manifesto_zip.json"
+
+    def _consolidar(medicao: MedicaoEtapa) -> int:
+        print("Listando arquivos dos .zip...")
+        membros_zip = listar_membros_zip(zip_paths, manifesto_zip)
+        print(f"{len(membros_zip)} arquivos de dados encontrados nos zips.")
 
-    # 3. Identificar arquivos de despesas/sinistros
-    print("Identificando arquivos de despesas/sinistros...")
-    arquivos_despesas = identificar_arquivos_despesas(processed_dir)
-    print(f"{len(arquivos_despesas)} arquivos de despesas identificados.")
+        print("Identificando arquivos de despesas/sinistros...")
+        arquivos_despesas = identificar_arquivos_despesas(membros_zip)
+        print(f"{len(arquivos_despesas)} arquivos de despesas identificados.")
+        medicao.contadores["arquivos_despesas"] = len(arquivos_despesas)
 
-    # 4. Ler e normalizar
-    print("Lendo e normalizando arquivos de despesas...")
-    df_normalizado = ler_e_normalizar_arquivos(arquivos_despesas)
-    print(f"{len(df_normalizado)} linhas normalizadas.")
+        print("Lendo e normalizando arquivos de despesas...")
+        df_normalizado = ler_e_normalizar_arquivos(arquivos_despesas, workers=args.workers)
+        print(f"{len(df_normalizado)} linhas normalizadas.")
 
-    if df_normalizado.empty:
+        print("Salvando consolidado de despesas...")
+        salvar_tabela(df_normalizado, consolidado)
+        return len(df_normalizado)
+
+    linhas = _executar_etapa(
+        manifesto,
+        relatorio,
+        "consolidacao",
+        entradas=[*zip_paths, *_codigo(file_processing, armazenamento)],
+        parametros={"zips": sorted(p.name for p in zip_paths), "colunas": COLUNAS_DESPESAS},
+        saidas=[consolidado, manifesto_zip],
+        funcao=_consolidar,
+    )
+
+    if linhas == 0:
         print("Nenhuma linha normalizada. Verifique os arquivos baixados e a lógica de mapeamento de colunas.")
+        return False
+
+    # 7. Enriquecer consolidado com cadastro (trazendo CNPJ, RazaoSocial, UF etc.)
+    enriquecido = caminhos.tabelas.enriquecido
+
+    def _enriquecer(medicao: MedicaoEtapa) -> None:
+        print("Enriquecendo consolidado com cadastro de operadoras...")
+        sem_cadastro = enriquecer_consolidado_com_cadastro(
+            consolidado, cadastro_indice, enriquecido, linhas_por_lote=linhas_por_lote
+        )
+        # LEFT join: as linhas sem cadastro seguem (e são descartadas na validação), aqui só contamos os RegistroANS
+        medicao.contadores["registros_ans_sem_cadastro"] = len(sem_cadastro)
+
+    _executar_etapa(
+        manifesto,
+        relatorio,
+        "enriquecimento",
+        entradas=[consolidado, cadastro_indice, *_codigo(enrichment, armazenamento)],
+        parametros={},
+        saidas=[enriquecido],
+        funcao=_enriquecer,
+    )
+
+    # 7.5. Validar dados enriquecidos (CNPJ, RazaoSocial, ValorDespesas)
+    enriquecido_validado = caminhos.tabelas.validado
+
+    def _validar(medicao: MedicaoEtapa) -> None:
+        print("Validando dados consolidados (CNPJ, RazaoSocial, ValorDespesas)...")
+        rejeicoes = validar_dados_consolidados(enriquecido, enriquecido_validado, linhas_por_lote=linhas_por_lote)
+        medicao.registrar_rejeicoes(rejeicoes)
+        print(f"{sum(rejeicoes.values())} linhas descartadas ({', '.join(f'{m}: {n}' for m, n in rejeicoes.items())}).")
+
+    _executar_etapa(
+        manifesto,
+        relatorio,
+        "validacao",
+        entradas=[enriquecido, *_codigo(validation, armazenamento)],
+        parametros={},
+        saidas=[enriquecido_validado],
+        funcao=_validar,
+    )
+
+    # 8. Agregar despesas por RazaoSocial/UF usando a tabela validada
+    despesas_agregadas = caminhos.agregado
+
+    def _agregar(medicao: MedicaoEtapa) -> None:
+        print("Gerando despesas agregadas...")
+        agregar_despesas(enriquecido_validado, despesas_agregadas)
+
+    _executar_etapa(
+        manifesto,
+        relatorio,
+        "agregacao",
+        entradas=[enriquecido_validado, *_codigo(aggregation, armazenamento)],
+        parametros={},
+        saidas=[despesas_agregadas],
+        funcao=_agregar,
+    )
+
+    # 8.1. Cubo UF x Modalidade x Ano x Trimestre (contagem/soma/M2 por célula) para o endpoint /api/cubo
+    cubo_despesas = caminhos.tabelas.cubo
+
+    def _gerar_cubo(medicao: MedicaoEtapa) -> None:
+        print("Gerando cubo de despesas (UF x Modalidade x Ano x Trimestre)...")
+        medicao.contadores["celulas"] = gerar_cubo(enriquecido_validado, cubo_despesas, workers=args.workers)
+
+    _executar_etapa(
+        manifesto,
+        relatorio,
+        "cubo",
+        entradas=[enriquecido_validado, *_codigo(cubo, aggregation, armazenamento)],
+        parametros={},
+        saidas=[cubo_despesas],
+        funcao=_gerar_cubo,
+    )
+
+    salvar_metadados(caminhos.metadados_ingestao, hash_cadastro, trimestres_das_tabelas(caminhos.tabelas) or [])
+    return True
+
+
+def _ingerir(
+    args: argparse.Namespace,
+    manifesto: ManifestoExecucao,
+    relatorio: RelatorioExecucao,
+    caminhos: CaminhosPipeline,
+    linhas_por_lote: int | None,
+    hash_cadastro: str | None,
+) -> bool:
+    # Modo --incremental: baixa e processa só os trimestres novos da janela dos 3 últimos, troca as partições deles nas tabelas, retira o trimestre que saiu da janela e refaz os agregados numa leitura em lotes da tabela validada. Retorna False (e a pipeline completa roda no lugar) se não há estado compatível de uma execução anterior.
+    motivo = motivo_para_reconstruir(caminhos.tabelas, caminhos.metadados_ingestao, hash_cadastro)
+    if motivo:
+        print(f"Ingestão incremental indisponível ({motivo}); executando a pipeline completa.")
+        return False
+    atuais = trimestres_das_tabelas(caminhos.tabelas)
+
+    print("Procurando trimestres novos entre os 3 últimos...")
+    with relatorio.medir("download") as medicao:
+        zips_por_trimestre = baixar_arquivos_dos_trimestres_novos(caminhos.raw, atuais)
+        medicao.contadores["arquivos"] = sum(len(zips) for zips in zips_por_trimestre.values())
+    if not zips_por_trimestre:
+        raise RuntimeError("Nenhum trimestre encontrado no repositório da ANS.")
+
+    novos = {trimestre: zips for trimestre, zips in zips_por_trimestre.items() if trimestre not in atuais}
+    retirar = [trimestre for trimestre in atuais if trimestre not in zips_por_trimestre]
+    if not novos and not retirar:
+        print("Nenhum trimestre novo desde a última execução.")
+        return True
+
+    print(
+        f"Ingerindo {', '.join(f'{a}/{t}' for a, t in novos) or 'nenhum trimestre'}"
+        f" e retirando {', '.join(f'{a}/{t}' for a, t in retirar) or 'nenhum'}..."
+    )
+    with relatorio.medir(
+        "ingestao",
+        entradas=[caminho for zips in novos.values() for caminho in zips],
+        saidas=[*caminhos.tabelas, caminhos.agregado],
+    ) as medicao:
+        rejeicoes = ingerir_trimestres(
+            novos,
+            retirar,
+            caminhos.tabelas,
+            caminhos.cadastro_indice,
+            caminhos.processed / "ingestao",
+            workers=args.workers,
+            linhas_por_lote=linhas_por_lote,
+        )
+        medicao.registrar_rejeicoes(rejeicoes)
+        medicao.contadores["trimestres_ingeridos"] = [f"{a}/{t}" for a, t in novos]
+        medicao.contadores["trimestres_retirados"] = [f"{a}/{t}" for a, t in retirar]
+
+        print("Refazendo despesas agregadas a partir da tabela validada...")
+        agregar_despesas(caminhos.tabelas.validado, caminhos.agregado)
+        salvar_metadados(caminhos.metadados_ingestao, hash_cadastro, trimestres_das_tabelas(caminhos.tabelas) or [])
+    return True
+
+
+def _executar_pipeline(
+    args: argparse.Namespace,
+    manifesto: ManifestoExecucao,
+    relatorio: RelatorioExecucao,
+    data_dir: Path,
+    linhas_por_lote: int | None,
+) -> None:
+    caminhos = _caminhos(data_dir)
+
+    # 0. Cadastro de operadoras, usado pelos dois caminhos (e pelo teste de compatibilidade da ingestão incremental)
+    hash_cadastro = _preparar_cadastro(manifesto, relatorio, caminhos)
+
+    ingerido = args.incremental and _ingerir(args, manifesto, relatorio, caminhos, linhas_por_lote, hash_cadastro)
+    if not ingerido and not _reconstruir(args, manifesto, relatorio, caminhos, linhas_por_lote, hash_cadastro):
         return
 
-    # 5. Gerar consolidado_despesas.csv + zip
+    processed_dir = caminhos.processed
+    final_dir = caminhos.final
+    consolidado = caminhos.tabelas.consolidado
+    cadastro_indice = caminhos.cadastro_indice
+    enriquecido_validado = caminhos.tabelas.validado
+    despesas_agregadas = caminhos.agregado
+
+    # 8.2. Conferência opcional: agregação refeita do zero a partir da tabela validada
+    if args.verificar:
+        print("Conferindo os agregados com uma reconstrução completa...")
+        with relatorio.medir("verificacao", entradas=[enriquecido_validado, despesas_agregadas]) as medicao:
+            grupos = verificar_por_reconstrucao(enriquecido_validado, despesas_agregadas)
+            medicao.contadores["grupos"] = grupos
+        print(f"{grupos} grupos idênticos aos da reconstrução.")
+
+    # 8.5. Snapshot binário da API (colunas .npy abertas com mmap por todos os workers do uvicorn)
+    snapshot_dir = processed_dir / "api_snapshot"
+
+    def _gerar_snapshot_api(medicao: MedicaoEtapa) -> None:
+        print("Gerando snapshot da API...")
+        gerar_snapshot_api(enriquecido_validado, despesas_agregadas, snapshot_dir)
+
+    _executar_etapa(
+        manifesto,
+        relatorio,
+        "snapshot_api",
+        entradas=[enriquecido_validado, despesas_agregadas, *_codigo(snapshot_api, armazenamento)],
+        parametros={},
+        saidas=[snapshot_dir],
+        funcao=_gerar_snapshot_api,
+    )
+
+    # 8.6. Banco analítico SQLite com as tabelas do sql/schema.sql, para rodar sql/analytics.sql sem servidor
+    banco_analitico = processed_dir / "analises.sqlite"
+
+    def _criar_banco_analitico(medicao: MedicaoEtapa) -> None:
+        print("Gerando banco analítico (SQLite)...")
+        linhas_por_tabela = criar_banco_analitico(consolidado, cadastro_indice, despesas_agregadas, banco_analitico)
+        medicao.contadores.update(linhas_por_tabela)
+
+    _executar_etapa(
+        manifesto,
+        relatorio,
+        "analises",
+        entradas=[consolidado, cadastro_indice, despesas_agregadas, SCHEMA_SQL, *_codigo(motor_analitico, carga_banco, armazenamento)],
+        parametros={},
+        saidas=[banco_analitico],
+        funcao=_criar_banco_analitico,
+    )
+
+    # 9. Gerar entregáveis (CSV/ZIP) a partir das tabelas intermediárias
     consolidado_csv = processed_dir / "consolidado_despesas.csv"
     consolidado_zip = final_dir / "consolidado_despesas.zip"
-    print("Gerando consolidado_despesas.csv e zip...")
-    gerar_consolidado_despesas(df_normalizado, consolidado_csv, consolidado_zip)
+    despesas_agregadas_csv = final_dir / "despesas_agregadas.csv"
+    zip_final = final_dir / "Teste_Carlos_Daniel.zip"
 
-    # 6. Baixar cadastro de operadoras
-    cadastro_csv = processed_dir / "cadastro_operadoras.csv"
-    print("Baixando cadastro de operadoras ativas...")
-    baixar_cadastro_operadoras(cadastro_csv)
+    def _gerar_entregaveis(medicao: MedicaoEtapa) -> None:
+        print("Gerando consolidado_despesas.csv e zip...")
+        gerar_consolidado_despesas(ler_tabela(consolidado), consolidado_csv, consolidado_zip)
 
-    # 7. Enriquecer consolidado com cadastro (trazendo CNPJ, RazaoSocial, UF etc.)
-    enriquecido_csv = processed_dir / "consolidado_enriquecido.csv"
-    print("Enriquecendo consolidado com cadastro de operadoras...")
-    enriquecer_consolidado_com_cadastro(
-        consolidado_csv,
-        cadastro_csv,
-        enriquecido_csv,
+        exportar_csv(despesas_agregadas, despesas_agregadas_csv)
+
+        print("Gerando ZIP final do teste...")
+        gerar_zip_final(final_dir, zip_final)
+
+    _executar_etapa(
+        manifesto,
+        relatorio,
+        "entregaveis",
+        entradas=[consolidado, despesas_agregadas, *_codigo(file_processing, aggregation, armazenamento)],
+        parametros={},
+        saidas=[consolidado_csv, consolidado_zip, despesas_agregadas_csv, zip_final],
+        funcao=_gerar_entregaveis,
     )
 
-    # 7.5. Validar dados enriquecidos (CNPJ, RazaoSocial, ValorDespesas)
-    enriquecido_validado_csv = processed_dir / "consolidado_enriquecido_validado.csv"
-    print("Validando dados consolidados (CNPJ, RazaoSocial, ValorDespesas)...")
-    validar_dados_consolidados(enriquecido_csv, enriquecido_validado_csv)
+    # 10. Carga opcional no banco do schema.sql (tabelas de carga + troca atômica)
+    if args.banco_url:
+        destino = conectar(args.banco_url)
+        try:
+            # As linhas no banco entram nos parâmetros da etapa: se o banco for esvaziado ou recriado, a carga repete
+            entradas_carga = [consolidado, cadastro_indice, despesas_agregadas, SCHEMA_SQL, *_codigo(carga_banco, armazenamento)]
+            parametros_carga = {
+                "banco": descrever_url(args.banco_url),
+                "linhas_por_lote": linhas_por_lote or LINHAS_POR_LOTE,
+                "linhas": linhas_no_banco(destino),
+            }
 
-    # 8. Agregar despesas por RazaoSocial/UF usando o arquivo validado
-    despesas_agregadas_csv = final_dir / "despesas_agregadas.csv"
-    print("Gerando despesas agregadas...")
-    agregar_despesas(enriquecido_validado_csv, despesas_agregadas_csv)
+            def _carregar_banco(medicao: MedicaoEtapa) -> dict[str, int]:
+                print(f"Carregando tabelas em {descrever_url(args.banco_url)}...")
+                resultado = carregar_banco(
+                    destino,
+                    {"cadastro": cadastro_indice, "consolidado": consolidado, "agregado": despesas_agregadas},
+                    linhas_por_lote=parametros_carga["linhas_por_lote"],
+                )
+                medicao.contadores.update(resultado)
+                return {tabela: medidas["linhas"] for tabela, medidas in resultado.items()}
 
-    # 9. Gerar ZIP final
-    zip_final = final_dir / "Teste_Carlos_Daniel.zip"
-    print("Gerando ZIP final do teste...")
-    gerar_zip_final(final_dir, zip_final)
+            linhas_carregadas = _executar_etapa(
+                manifesto,
+                relatorio,
+                "carga_banco",
+                entradas=entradas_carga,
+                parametros=parametros_carga,
+                saidas=[],
+                funcao=_carregar_banco,
+            )
+            if linhas_carregadas is not None:
+                # Registra a etapa com as linhas que ficaram no banco após a carga, para a próxima execução comparar
+                manifesto.registrar("carga_banco", entradas_carga, {**parametros_carga, "linhas": linhas_carregadas}, [])
+                manifesto.salvar()
+        finally:
+            destino.fechar()
 
     print("Pipeline concluído com sucesso.")
 
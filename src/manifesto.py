@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Iterable
+
+
+TAMANHO_BLOCO_HASH = 1024 * 1024
+
+
+class ManifestoExecucao:
+    # Manifesto das execuções da pipeline, salvo em JSON. Para cada etapa guarda o hash das entradas (arquivos) e dos parâmetros, e o hash das saídas que ela gerou. Uma etapa só precisa rodar de novo se alguma dessas coisas mudou ou se alguma saída sumiu/foi alterada. Os hashes de arquivos ficam em cache por (tamanho, mtime), então arquivos grandes que não mudaram não são relidos a cada execução.
+
+    def __init__(self, caminho: Path):
+        self.caminho = caminho
+        self.etapas: dict[str, dict[str, Any]] = {}
+        self._cache_hashes: dict[str, dict[str, Any]] = {}
+
+        if caminho.exists():
+            try:
+                with open(caminho, "r", encoding="utf-8") as f:
+                    dados = json.load(f)
+                self.etapas = dados.get("etapas", {})
+                self._cache_hashes = dados.get("hashes_arquivos", {})
+            except (OSError, ValueError):
+                # Manifesto corrompido: equivale a nunca ter executado
+                self.etapas = {}
+                self._cache_hashes = {}
+
+    def salvar(self) -> None:
+        self.caminho.parent.mkdir(parents=True, exist_ok=True)
+        temporario = self.caminho.with_name(self.caminho.name + ".tmp")
+        with open(temporario, "w", encoding="utf-8") as f:
+            json.dump(
+                {"etapas": self.etapas, "hashes_arquivos": self._cache_hashes},
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+        os.replace(temporario, self.caminho)
+
+    def _hash_arquivo(self, caminho: Path) -> str:
+        stat = caminho.stat()
+        chave = str(caminho.resolve())
+        em_cache = self._cache_hashes.get(chave)
+        if em_cache and em_cache["tamanho"] == stat.st_size and em_cache["mtime_ns"] == stat.st_mtime_ns:
+            return em_cache["hash"]
+
+        h = hashlib.blake2b(digest_size=16)
+        with open(caminho, "rb") as f:
+            for bloco in iter(lambda: f.read(TAMANHO_BLOCO_HASH), b""):
+                h.update(bloco)
+
+        self._cache_hashes[chave] = {"tamanho": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": h.hexdigest()}
+        return h.hexdigest()
+
+    def hash_caminho(self, caminho: Path) -> str | None:
+        # Hash do conteúdo de um arquivo, ou de todos os arquivos de um diretório (ex.: tabela Parquet particionada), combinados com seus caminhos relativos. Retorna None se o caminho não existir.
+        if caminho.is_file():
+            return self._hash_arquivo(caminho)
+        if not caminho.is_dir():
+            return None
+
+        h = hashlib.blake2b(digest_size=16)
+        for arquivo in sorted(p for p in caminho.rglob("*") if p.is_file()):
+            h.update(arquivo.relative_to(caminho).as_posix().encode("utf-8"))
+            h.update(self._hash_arquivo(arquivo).encode("ascii"))
+        return h.hexdigest()
+
+    def _hashes(self, caminhos: Iterable[Path]) -> dict[str, str | None]:
+        return {str(c): self.hash_caminho(Path(c)) for c in caminhos}
+
+    @staticmethod
+    def _hash_parametros(parametros: dict[str, Any]) -> str:
+        texto = json.dumps(parametros, sort_keys=True, default=str, ensure_ascii=False)
+        return hashlib.blake2b(texto.encode("utf-8"), digest_size=16).hexdigest()
+
+    def precisa_executar(
+        self,
+        etapa: str,
+        entradas: Iterable[Path],
+        parametros: dict[str, Any],
+        saidas: Iterable[Path],
+    ) -> bool:
+        registro = self.etapas.get(etapa)
+        if not registro:
+            return True
+
+        if registro.get("parametros") != self._hash_parametros(parametros):
+            return True
+
+        if registro.get("entradas") != self._hashes(entradas):
+            return True
+
+        saidas_atuais = self._hashes(saidas)
+        if any(h is None for h in saidas_atuais.values()):
+            return True
+
+        return registro.get("saidas") != saidas_atuais
+
+    def registrar(
+        self,
+        etapa: str,
+        entradas: Iterable[Path],
+        parametros: dict[str, Any],
+        saidas: Iterable[Path],
+    ) -> None:
+        self.etapas[etapa] = {
+            "entradas": self._hashes(entradas),
+            "parametros": self._hash_parametros(parametros),
+            "saidas": self._hashes(saidas),
+            "concluida_em": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+
+    def invalidar(self, etapas: Iterable[str]) -> None:
+        for etapa in etapas:
+            self.etapas.pop(etapa, None)
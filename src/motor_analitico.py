@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import argparse
+import math
+import os
+import sqlite3
+from pathlib import Path
+from typing import Any, Iterator
+
+import pandas as pd
+
+from armazenamento import remover_caminho
+from carga_banco import DestinoSQLite, carregar_banco, sem_comentarios
+
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+SQL_DIR = BASE_DIR / "sql"
+ANALYTICS_SQL = SQL_DIR / "analytics.sql"
+
+# Nomes das queries de sql/analytics.sql, na ordem do arquivo (usados nos endpoints da API)
+NOMES_ANALISES = ("crescimento", "despesas_por_uf", "acima_da_media")
+
+
+def carregar_analises(caminho: Path = ANALYTICS_SQL) -> dict[str, str]:
+    # Lê as queries de sql/analytics.sql (separadas por ";") e as associa a NOMES_ANALISES, na ordem.
+    comandos = [sem_comentarios(trecho) for trecho in caminho.read_text(encoding="utf-8").split(";")]
+    comandos = [c for c in comandos if c]
+    if len(comandos) != len(NOMES_ANALISES):
+        raise ValueError(f"{caminho} tem {len(comandos)} queries; esperadas {len(NOMES_ANALISES)} ({', '.join(NOMES_ANALISES)}).")
+    return dict(zip(NOMES_ANALISES, comandos))
+
+
+def criar_banco_analitico(
+    caminho_consolidado: Path,
+    caminho_cadastro: Path,
+    caminho_agregado: Path,
+    destino: Path,
+) -> dict[str, int]:
+    # Registra as saídas da pipeline num banco SQLite (arquivo único, sem servidor) com as tabelas do sql/schema.sql (operadoras, despesas_consolidadas e despesas_agregadas), carregadas por carga_banco. O banco é gravado num arquivo temporário e trocado de uma vez. Retorna as linhas inseridas por tabela.
+    temporario = destino.with_name(destino.name + ".tmp")
+    remover_caminho(temporario)
+    destino.parent.mkdir(parents=True, exist_ok=True)
+
+    banco = DestinoSQLite(sqlite3.connect(temporario))
+    try:
+        # Banco descartável (reconstruído a cada execução): sem journal nem fsync durante a carga
+        banco.executar("PRAGMA journal_mode = OFF")
+        banco.executar("PRAGMA synchronous = OFF")
+        resultado = carregar_banco(
+            banco,
+            {"cadastro": caminho_cadastro, "consolidado": caminho_consolidado, "agregado": caminho_agregado},
+        )
+        # Estatísticas para o planejador escolher os índices do schema
+        banco.executar("ANALYZE")
+    except BaseException:
+        banco.fechar()
+        remover_caminho(temporario)
+        raise
+    banco.fechar()
+
+    os.replace(temporario, destino)
+    linhas_por_tabela = {tabela: medidas["linhas"] for tabela, medidas in resultado.items()}
+    print(f"Banco analítico gerado em {destino} ({', '.join(f'{t}: {n}' for t, n in linhas_por_tabela.items())}).")
+    return linhas_por_tabela
+
+
+def _valor_json(valor: Any) -> Any:
+    if isinstance(valor, float) and not math.isfinite(valor):
+        return None
+    return valor
+
+
+def executar_analise(caminho_banco: Path, nome: str, analises: dict[str, str] | None = None) -> list[dict[str, Any]]:
+    # Roda uma das queries de sql/analytics.sql no banco analítico (aberto só para leitura) e devolve as linhas como dicionários.
+    analises = analises if analises is not None else carregar_analises()
+    if nome not in analises:
+        raise KeyError(nome)
+
+    conexao = sqlite3.connect(f"{caminho_banco.resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        cursor = conexao.execute(analises[nome])
+        colunas = [descricao[0] for descricao in cursor.description]
+        return [{col: _valor_json(v) for col, v in zip(colunas, linha)} for linha in cursor.fetchall()]
+    finally:
+        conexao.close()
+
+
+def executar_analises(caminho_banco: Path) -> Iterator[tuple[str, list[dict[str, Any]]]]:
+    analises = carregar_analises()
+    for nome in analises:
+        yield nome, executar_analise(caminho_banco, nome, analises)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Roda as queries de sql/analytics.sql no banco analítico gerado pela pipeline.")
+    parser.add_argument(
+        "--banco",
+        type=Path,
+        default=BASE_DIR / "data" / "processed" / "analises.sqlite",
+        help="Banco SQLite gerado pela etapa 'analises' do main.py.",
+    )
+    args = parser.parse_args(argv)
+
+    for nome, linhas in executar_analises(args.banco):
+        print(f"\n== {nome} ==")
+        print(pd.DataFrame(linhas).to_string(index=False) if linhas else "(sem linhas)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+from typing import Any, NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from armazenamento import ler_tabela, remover_caminho
+
+
+COLUNAS_OPERADORA = ["CNPJ", "RazaoSocial", "Modalidade", "UF"]
+COLUNAS_DESPESAS_API = [*COLUNAS_OPERADORA, "Ano", "Trimestre", "ValorDespesas"]
+
+# Snapshot binário da API: um diretório com uma coluna por arquivo .npy (abertos com mmap pela API)
+# e metadados.json, gravado por último e trocado de uma vez.
+VERSAO_FORMATO = 1
+NOME_METADADOS = "metadados.json"
+
+
+class DadosApi(NamedTuple):
+    # Modelo compacto dos dados servidos pela API (ver compactar_dados) + índices derivados por CNPJ.
+    operadoras: pd.DataFrame
+    despesas: pd.DataFrame
+    agregado: pd.DataFrame
+    # inicio_despesas[c]:inicio_despesas[c+1] = linhas de despesas do CNPJ de código c (idem para historico_*)
+    inicio_despesas: np.ndarray
+    inicio_historico: np.ndarray
+    historico: pd.DataFrame
+    total_despesas: float
+    media_despesas: float
+
+
+def _categoria_sem_espacos(serie: pd.Series) -> pd.Series:
+    # Coluna de texto como categórica (dicionário de valores + códigos inteiros), sem espaços nas pontas. O strip é feito nas categorias, não em cada linha.
+    categorica = serie.astype("category")
+    categorias = categorica.cat.categories.astype(str).str.strip()
+    if categorias.is_unique and categorias.is_monotonic_increasing:
+        return categorica.cat.rename_categories(categorias)
+
+    codigos = categorica.cat.codes.to_numpy()
+    valores = np.asarray(categorias, dtype=object)[codigos]
+    valores[codigos < 0] = None
+    return pd.Series(valores, index=serie.index).astype("category")
+
+
+def compactar_dados(df_enriquecido: pd.DataFrame, df_agregado: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    # Converte as tabelas da pipeline no modelo compacto da API: - operadoras: uma linha por combinação distinta de CNPJ/RazaoSocial/Modalidade/UF, ordenada por essas colunas, com atributos categóricos; a posição da linha é o IdOperadora. PrimeiraLinha guarda a primeira linha do consolidado com a combinação (para manter "primeira ocorrência" como critério de desempate). - despesas: IdOperadora (int32), Ano (Int16), Trimestre (Int8) e ValorDespesas, ordenada por IdOperadora/Ano/Trimestre, sem repetir textos por linha. - agregado: tabela agregada com RazaoSocial/UF categóricas.
+    atributos = pd.DataFrame(
+        {
+            col: _categoria_sem_espacos(df_enriquecido[col])
+            if col in df_enriquecido.columns
+            else pd.Series(None, index=df_enriquecido.index, dtype="category")
+            for col in COLUNAS_OPERADORA
+        }
+    )
+    ids = atributos.groupby(COLUNAS_OPERADORA, observed=True, sort=True, dropna=False).ngroup().to_numpy(dtype=np.int32)
+
+    _, primeiras_linhas = np.unique(ids, return_index=True)
+    operadoras = atributos.iloc[primeiras_linhas].reset_index(drop=True)
+    operadoras["PrimeiraLinha"] = primeiras_linhas.astype(np.int64)
+
+    despesas = pd.DataFrame(
+        {
+            "IdOperadora": ids,
+            "Ano": df_enriquecido["Ano"].astype("Int16").array,
+            "Trimestre": df_enriquecido["Trimestre"].astype("Int8").array,
+            "ValorDespesas": pd.to_numeric(df_enriquecido["ValorDespesas"], errors="coerce").to_numpy(dtype=np.float64),
+        }
+    )
+    despesas = despesas.sort_values(["IdOperadora", "Ano", "Trimestre"], kind="stable").reset_index(drop=True)
+
+    agregado = df_agregado.copy()
+    for col in ("RazaoSocial", "UF"):
+        if col in agregado.columns:
+            agregado[col] = _categoria_sem_espacos(agregado[col])
+
+    return operadoras, despesas, agregado
+
+
+def montar_dados_api(df_enriquecido: pd.DataFrame, df_agregado: pd.DataFrame) -> DadosApi:
+    # Compacta as tabelas e calcula os índices por CNPJ (faixas de linhas e histórico trimestral) e os totais.
+    operadoras, despesas, agregado = compactar_dados(df_enriquecido, df_agregado)
+
+    # Código do CNPJ de cada linha de despesas; não decrescente, porque operadoras está ordenada por CNPJ
+    codigos_cnpj = operadoras["CNPJ"].cat.codes.to_numpy()
+    cnpj_por_linha = codigos_cnpj[despesas["IdOperadora"].to_numpy()]
+    quantidade_cnpjs = len(operadoras["CNPJ"].cat.categories)
+    inicio_despesas = np.searchsorted(cnpj_por_linha, np.arange(quantidade_cnpjs + 1)).astype(np.int64)
+
+    historico = (
+        despesas[["Ano", "Trimestre", "ValorDespesas"]]
+        .assign(CodigoCNPJ=cnpj_por_linha)
+        .groupby(["CodigoCNPJ", "Ano", "Trimestre"], sort=True)["ValorDespesas"]
+        .sum()
+        .reset_index()
+    )
+    inicio_historico = np.searchsorted(historico["CodigoCNPJ"].to_numpy(), np.arange(quantidade_cnpjs + 1)).astype(np.int64)
+    historico = historico.drop(columns="CodigoCNPJ")
+
+    valores = despesas["ValorDespesas"].dropna()
+
+    return DadosApi(
+        operadoras=operadoras,
+        despesas=despesas,
+        agregado=agregado,
+        inicio_despesas=inicio_despesas,
+        inicio_historico=inicio_historico,
+        historico=historico,
+        total_despesas=float(valores.sum()),
+        media_despesas=float(valores.mean()) if not valores.empty else 0.0,
+    )
+
+
+def _salvar_tabela_npy(df: pd.DataFrame, pasta: Path, tabela: str) -> dict[str, Any]:
+    # Uma coluna por arquivo: categóricas viram códigos (.npy) + categorias (nos metadados), inteiros anuláveis viram valores + máscara.
+    colunas: dict[str, Any] = {}
+    for col in df.columns:
+        serie = df[col]
+        base = f"{tabela}.{col}"
+        if isinstance(serie.dtype, pd.CategoricalDtype):
+            np.save(pasta / f"{base}.npy", serie.cat.codes.to_numpy())
+            colunas[col] = {"tipo": "categoria", "categorias": serie.cat.categories.astype(str).tolist()}
+        elif isinstance(serie.dtype, pd.api.extensions.ExtensionDtype):
+            np.save(pasta / f"{base}.npy", serie.to_numpy(dtype=serie.dtype.numpy_dtype, na_value=0))
+            np.save(pasta / f"{base}.mascara.npy", serie.isna().to_numpy())
+            colunas[col] = {"tipo": "anulavel", "dtype": str(serie.dtype)}
+        else:
+            np.save(pasta / f"{base}.npy", serie.to_numpy())
+            colunas[col] = {"tipo": "numpy"}
+    return {"linhas": len(df), "colunas": colunas}
+
+
+def _carregar_tabela_npy(pasta: Path, tabela: str, meta: dict[str, Any]) -> pd.DataFrame:
+    # Abre as colunas com mmap: as colunas numéricas apontam direto para o page cache (compartilhado entre processos).
+    dados: dict[str, Any] = {}
+    for col, info in meta["colunas"].items():
+        base = pasta / f"{tabela}.{col}"
+        valores = np.load(f"{base}.npy", mmap_mode="r")
+        if info["tipo"] == "categoria":
+            dados[col] = pd.Categorical.from_codes(valores, categories=pd.Index(info["categorias"]))
+        elif info["tipo"] == "anulavel":
+            mascara = np.load(f"{base}.mascara.npy", mmap_mode="r")
+            dados[col] = pd.arrays.IntegerArray(valores, mascara, copy=False)
+        else:
+            dados[col] = valores
+    return pd.DataFrame(dados, copy=False) if dados else pd.DataFrame(index=pd.RangeIndex(meta["linhas"]))
+
+
+def salvar_dados_api(dados: DadosApi, destino: Path) -> None:
+    # Grava o snapshot num diretório temporário e troca pelo anterior de uma vez (como EscritorTabela), para que a API nunca abra um snapshot pela metade.
+    temporario = destino.with_name(destino.name + ".tmp")
+    remover_caminho(temporario)
+    temporario.mkdir(parents=True)
+
+    metadados: dict[str, Any] = {
+        "formato": VERSAO_FORMATO,
+        "total_despesas": dados.total_despesas,
+        "media_despesas": dados.media_despesas,
+        "tabelas": {},
+    }
+    for nome in ("operadoras", "despesas", "agregado", "historico"):
+        metadados["tabelas"][nome] = _salvar_tabela_npy(getattr(dados, nome), temporario, nome)
+    np.save(temporario / "inicio_despesas.npy", dados.inicio_despesas)
+    np.save(temporario / "inicio_historico.npy", dados.inicio_historico)
+
+    with open(temporario / NOME_METADADOS, "w", encoding="utf-8") as f:
+        json.dump(metadados, f, ensure_ascii=False)
+
+    antigo = destino.with_name(destino.name + ".old")
+    if destino.exists():
+        remover_caminho(antigo)
+        os.replace(destino, antigo)
+    os.replace(temporario, destino)
+    remover_caminho(antigo)
+
+
+def snapshot_disponivel(diretorio: Path) -> bool:
+    return (diretorio / NOME_METADADOS).is_file()
+
+
+def carregar_dados_api(diretorio: Path) -> DadosApi:
+    # Abre um snapshot gravado por salvar_dados_api. Custo proporcional ao número de operadoras (categorias), não ao de linhas de despesas.
+    with open(diretorio / NOME_METADADOS, "r", encoding="utf-8") as f:
+        metadados = json.load(f)
+    if metadados.get("formato") != VERSAO_FORMATO:
+        raise RuntimeError(f"Formato de snapshot não suportado: {metadados.get('formato')}")
+
+    tabelas = {nome: _carregar_tabela_npy(diretorio, nome, meta) for nome, meta in metadados["tabelas"].items()}
+
+    return DadosApi(
+        operadoras=tabelas["operadoras"],
+        despesas=tabelas["despesas"],
+        agregado=tabelas["agregado"],
+        inicio_despesas=np.load(diretorio / "inicio_despesas.npy", mmap_mode="r"),
+        inicio_historico=np.load(diretorio / "inicio_historico.npy", mmap_mode="r"),
+        historico=tabelas["historico"],
+        total_despesas=float(metadados["total_despesas"]),
+        media_despesas=float(metadados["media_despesas"]),
+    )
+
+
+def gerar_snapshot_api(caminho_enriquecido: Path, caminho_agregado: Path, destino: Path) -> None:
+    # Etapa da pipeline: monta o snapshot da API a partir das tabelas validada e agregada.
+    df_enriquecido = ler_tabela(caminho_enriquecido, colunas=COLUNAS_DESPESAS_API)
+    df_agregado = ler_tabela(caminho_agregado)
+    dados = montar_dados_api(df_enriquecido, df_agregado)
+    del df_enriquecido
+    salvar_dados_api(dados, destino)
+    print(f"Snapshot da API gerado em {destino} ({len(dados.despesas)} linhas, {len(dados.operadoras)} operadoras).")
@@ -3,8 +3,15 @@ from __future__ import annotations
 from pathlib import Path
 from typing import Any
 
+import numpy as np
 import pandas as pd
 
+from armazenamento import EscritorTabela, iterar_tabela, ler_tabela, salvar_tabela
+
+
+# Motivos de descarte na validação, na ordem em que as regras são aplicadas
+MOTIVOS_REJEICAO = ("cnpj_invalido", "razao_social_vazia", "valor_ausente", "valor_nao_positivo")
+
 
 def _somente_digitos(cnpj: Any) -> str:
     """
@@ -54,25 +61,65 @@ def validar_cnpj(cnpj: Any) -> bool:
     return cnpj_limpo == base + str(dv1) + str(dv2)
 
 
-def validar_dados_consolidados(
-    caminho_csv_entrada: Path,
-    caminho_csv_saida: Path,
-) -> None:
+PESOS_DV1 = np.array([5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2])
+PESOS_DV2 = np.array([6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2])
+
+
+def _digitos_verificadores(base: np.ndarray, pesos: np.ndarray) -> np.ndarray:
+    resto = (base @ pesos) % 11
+    return np.where(resto < 2, 0, 11 - resto)
+
+
+def validar_cnpjs(cnpjs: pd.Series) -> pd.Series:
     """
-    Lê o CSV consolidado enriquecido, aplica validações e salva um novo CSV 'limpo'.
+    Versão vetorizada de validar_cnpj para uma coluna inteira.
 
-    Regras:
-    - CNPJ válido
-    - RazaoSocial não vazia
-    - ValorDespesas numérico e > 0
+    Cada CNPJ distinto é validado uma única vez (há poucas operadoras e
+    milhões de linhas): os valores distintos viram uma matriz de dígitos
+    (n x 14) no NumPy e os dois dígitos verificadores e a regra de
+    "todos os dígitos iguais" são calculados com operações de array.
+    validar_cnpj continua sendo a referência escalar das mesmas regras.
+
+    Em colunas object os valores são agrupados pelo texto (como validar_cnpj
+    os lê): senão o factorize juntaria 11222333000181 e 11222333000181.0,
+    que são iguais como números mas não como CNPJ.
+    """
+    if cnpjs.dtype == object:
+        cnpjs = cnpjs.map(str, na_action="ignore")
+    codigos, distintos = pd.factorize(cnpjs, use_na_sentinel=True)
+    if len(distintos) == 0:
+        return pd.Series(np.zeros(len(cnpjs), dtype=bool), index=cnpjs.index)
+
+    digitos = pd.Series(distintos.astype(str)).str.replace(r"[^0-9]", "", regex=True)
+    com_14 = (digitos.str.len() == 14).to_numpy()
+
+    validos = np.zeros(len(distintos), dtype=bool)
+    if com_14.any():
+        texto = "".join(digitos[com_14]).encode("ascii")
+        matriz = (np.frombuffer(texto, dtype=np.uint8).reshape(-1, 14) - ord("0")).astype(np.int64)
+
+        dv1 = _digitos_verificadores(matriz[:, :12], PESOS_DV1)
+        dv2 = _digitos_verificadores(np.column_stack([matriz[:, :12], dv1]), PESOS_DV2)
+        todos_iguais = (matriz == matriz[:, :1]).all(axis=1)
+
+        validos[com_14] = (matriz[:, 12] == dv1) & (matriz[:, 13] == dv2) & ~todos_iguais
+
+    # Código -1 = valor nulo, que nunca é um CNPJ válido
+    resultado = np.where(codigos >= 0, validos[np.maximum(codigos, 0)], False)
+    return pd.Series(resultado, index=cnpjs.index)
+
+
+def _validar_lote(df: pd.DataFrame, rejeicoes: dict[str, int] | None = None) -> pd.DataFrame:
     """
-    df = pd.read_csv(caminho_csv_entrada)
+    Aplica as regras de validação a um lote (ou à tabela inteira)
+    e devolve só as linhas válidas.
 
-    # Se não houver linhas, só salva e sai
+    Se rejeicoes for informado, soma nele as linhas descartadas por motivo
+    (cada linha conta só no primeiro motivo, na ordem de MOTIVOS_REJEICAO).
+    """
+    # Se não houver linhas, não há o que validar
     if df.empty:
-        caminho_csv_saida.parent.mkdir(parents=True, exist_ok=True)
-        df.to_csv(caminho_csv_saida, index=False, encoding="utf-8")
-        return
+        return df
 
     # Garante que as colunas necessárias existem
     for col in ["CNPJ", "RazaoSocial", "ValorDespesas"]:
@@ -80,26 +127,63 @@ def validar_dados_consolidados(
             raise ValueError(f"Coluna obrigatória ausente: {col}")
 
     # Normaliza textos
-    df["CNPJ"] = df["CNPJ"].astype(str).str.strip()
-    df["RazaoSocial"] = df["RazaoSocial"].astype(str).str.strip()
+    df["CNPJ"] = df["CNPJ"].fillna("").astype(str).str.strip()
+    df["RazaoSocial"] = df["RazaoSocial"].fillna("").astype(str).str.strip()
 
     # Aplica validação de CNPJ
-    df["CNPJValido"] = df["CNPJ"].apply(validar_cnpj)
+    df["CNPJValido"] = validar_cnpjs(df["CNPJ"])
 
     # Converte valor para numérico
     df["ValorDespesas"] = pd.to_numeric(df["ValorDespesas"], errors="coerce")
 
-    # Filtro final
-    df_filtrado = df[
-        (df["CNPJValido"])
-        & (df["RazaoSocial"] != "")
-        & (df["ValorDespesas"].notna())
-        & (df["ValorDespesas"] > 0)
-    ].copy()
+    # Filtro final (para cada motivo de descarte, as linhas que passam na regra)
+    atende = {
+        "cnpj_invalido": df["CNPJValido"].to_numpy(dtype=bool),
+        "razao_social_vazia": (df["RazaoSocial"] != "").to_numpy(dtype=bool),
+        "valor_ausente": df["ValorDespesas"].notna().to_numpy(dtype=bool),
+        "valor_nao_positivo": (df["ValorDespesas"] > 0).to_numpy(dtype=bool, na_value=False),
+    }
+    validas = np.ones(len(df), dtype=bool)
+    for motivo in MOTIVOS_REJEICAO:
+        if rejeicoes is not None:
+            rejeicoes[motivo] = rejeicoes.get(motivo, 0) + int((validas & ~atende[motivo]).sum())
+        validas &= atende[motivo]
+
+    df_filtrado = df[validas].copy()
 
     # Remove coluna auxiliar antes de salvar
     if "CNPJValido" in df_filtrado.columns:
         df_filtrado.drop(columns=["CNPJValido"], inplace=True)
 
-    caminho_csv_saida.parent.mkdir(parents=True, exist_ok=True)
-    df_filtrado.to_csv(caminho_csv_saida, index=False, encoding="utf-8")
+    return df_filtrado
+
+
+def validar_dados_consolidados(
+    caminho_csv_entrada: Path,
+    caminho_csv_saida: Path,
+    linhas_por_lote: int | None = None,
+) -> dict[str, int]:
+    """
+    Lê a tabela consolidada enriquecida (Parquet ou CSV), aplica validações
+    e salva uma nova tabela 'limpa' no formato indicado por caminho_csv_saida.
+
+    Regras:
+    - CNPJ válido
+    - RazaoSocial não vazia
+    - ValorDespesas numérico e > 0
+
+    Com linhas_por_lote, a tabela é lida, validada e gravada em lotes desse
+    tamanho (memória limitada); o resultado é o mesmo do modo em memória.
+
+    Retorna o número de linhas descartadas por motivo (MOTIVOS_REJEICAO).
+    """
+    rejeicoes = dict.fromkeys(MOTIVOS_REJEICAO, 0)
+
+    if linhas_por_lote is None:
+        salvar_tabela(_validar_lote(ler_tabela(caminho_csv_entrada), rejeicoes), caminho_csv_saida)
+        return rejeicoes
+
+    with EscritorTabela(caminho_csv_saida) as escritor:
+        for lote in iterar_tabela(caminho_csv_entrada, linhas_por_lote):
+            escritor.escrever(_validar_lote(lote, rejeicoes))
+    return rejeicoes
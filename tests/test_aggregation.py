@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from aggregation import EstadoGrupos, calcular_estado_grupos
+from armazenamento import ler_tabela, salvar_tabela
+
+
+def _despesas(linhas: int, semente: int = 0) -> pd.DataFrame:
+    # Valores com centavos e ordens de grandeza bem diferentes (onde a ordem das somas muda o último dígito), estornos negativos, valores nulos e chaves nulas.
+    rng = np.random.default_rng(semente)
+    valores = np.round(rng.lognormal(8, 3, linhas), 2) * rng.choice([1, -1], linhas, p=[0.9, 0.1])
+    valores[rng.random(linhas) < 0.01] = np.nan
+    df = pd.DataFrame({
+        "RazaoSocial": pd.array([f"OPERADORA {i}" for i in rng.integers(0, 300, linhas)], dtype="string"),
+        "UF": pd.array(rng.choice(["SP", "RJ", "MG", "RS"], linhas), dtype="string"),
+        "Ano": 2024,
+        "Trimestre": rng.integers(1, 4, linhas),
+        "ValorDespesas": valores,
+    })
+    df.loc[rng.random(linhas) < 0.01, "UF"] = pd.NA
+    return df
+
+
+def _esperado(df: pd.DataFrame) -> pd.DataFrame:
+    # A agregação original: groupby sobre a tabela inteira.
+    agregados = df.groupby(["RazaoSocial", "UF"])["ValorDespesas"].agg(["sum", "mean", "std"]).reset_index()
+    return agregados.rename(columns={"sum": "TotalDespesas", "mean": "MediaDespesas", "std": "DesvioPadraoDespesas"})
+
+
+def _conferir_bit_a_bit(obtido: pd.DataFrame, esperado: pd.DataFrame) -> None:
+    assert obtido["RazaoSocial"].tolist() == esperado["RazaoSocial"].tolist()
+    assert obtido["UF"].tolist() == esperado["UF"].tolist()
+    for coluna in ("TotalDespesas", "MediaDespesas", "DesvioPadraoDespesas"):
+        bits_obtidos = obtido[coluna].to_numpy(dtype=np.float64).view(np.int64)
+        bits_esperados = esperado[coluna].to_numpy(dtype=np.float64).view(np.int64)
+        assert np.array_equal(bits_obtidos, bits_esperados), coluna
+
+
+@pytest.mark.parametrize("linhas_por_lote", [13, 1_000, 50_000])
+def test_lotes_identicos_ao_groupby(linhas_por_lote):
+    df = _despesas(20_000)
+    estado = EstadoGrupos()
+    for inicio in range(0, len(df), linhas_por_lote):
+        estado.acumular(df.iloc[inicio:inicio + linhas_por_lote])
+    _conferir_bit_a_bit(estado.como_dataframe(), _esperado(df))
+
+
+def test_tabela_particionada_identica_ao_groupby(tmp_path):
+    df = _despesas(30_000, semente=1)
+    caminho = tmp_path / "validado.parquet"
+    salvar_tabela(df, caminho)
+    # Na tabela as linhas ficam na ordem das partições, que é a ordem em que o groupby original as lia
+    esperado = _esperado(ler_tabela(caminho))
+    _conferir_bit_a_bit(calcular_estado_grupos(caminho, linhas_por_lote=4_000).como_dataframe(), esperado)
+
+
+def test_tabela_de_estado_sem_perda():
+    df = _despesas(5_000, semente=2)
+    estado = EstadoGrupos()
+    estado.acumular(df.iloc[:2_000])
+    copia = EstadoGrupos()
+    copia.combinar(EstadoGrupos.de_tabela_estado(estado.como_tabela_estado()))
+    for parte in (estado, copia):
+        parte.acumular(df.iloc[2_000:])
+    _conferir_bit_a_bit(copia.como_dataframe(), _esperado(df))
+    pd.testing.assert_frame_equal(copia.como_dataframe(), estado.como_dataframe(), check_exact=True)
+
+
+def test_combinar_partes_independentes():
+    # Combinar estados de partes independentes não é exato, mas fica no último dígito do float
+    df = _despesas(20_000, semente=3)
+    estado = EstadoGrupos()
+    for inicio in range(0, len(df), 6_000):
+        parte = EstadoGrupos()
+        parte.acumular(df.iloc[inicio:inicio + 6_000])
+        estado.combinar(parte)
+    obtido = estado.como_dataframe()
+    esperado = _esperado(df)
+    for coluna in ("TotalDespesas", "MediaDespesas", "DesvioPadraoDespesas"):
+        np.testing.assert_allclose(obtido[coluna], esperado[coluna], rtol=1e-12)
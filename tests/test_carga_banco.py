@@ -0,0 +1,98 @@
+import sqlite3
+
+import pandas as pd
+
+from armazenamento import salvar_tabela
+from carga_banco import COLUNAS_TABELAS, conectar, carregar_banco, ler_schema, linhas_no_banco
+
+
+def _salvar_origens(pasta, operadoras: int, trimestres: list[tuple[int, int]]) -> dict:
+    registros = [str(100_000 + i) for i in range(operadoras)]
+    cadastro = pd.DataFrame({
+        "RegistroANS": registros,
+        "CNPJ": [f"{i:014d}" for i in range(operadoras)],
+        "RazaoSocial": [f"OPERADORA {i}" for i in range(operadoras)],
+        "Modalidade": ["Medicina de Grupo"] * operadoras,
+        "UF": ["SP", "RJ"] * (operadoras // 2) + ["MG"] * (operadoras % 2),
+    })
+    consolidado = pd.DataFrame(
+        [(registro, ano, tri, 100.0 + i) for ano, tri in trimestres for i, registro in enumerate(registros)],
+        columns=["RegistroANS", "Ano", "Trimestre", "ValorDespesas"],
+    )
+    # Uma linha sem valor (NOT NULL no schema) é descartada na carga
+    consolidado.loc[0, "ValorDespesas"] = None
+    agregado = pd.DataFrame({
+        "RazaoSocial": cadastro["RazaoSocial"],
+        "UF": cadastro["UF"],
+        "TotalDespesas": 300.0,
+        "MediaDespesas": 100.0,
+        "DesvioPadraoDespesas": None,
+    })
+
+    origens = {
+        "cadastro": pasta / "cadastro_indice.parquet",
+        "consolidado": pasta / "consolidado_despesas.parquet",
+        "agregado": pasta / "despesas_agregadas.parquet",
+    }
+    salvar_tabela(cadastro, origens["cadastro"], particionar=False)
+    salvar_tabela(consolidado, origens["consolidado"])
+    salvar_tabela(agregado, origens["agregado"], particionar=False)
+    return origens
+
+
+def _objetos(caminho) -> dict[str, set[str]]:
+    conexao = sqlite3.connect(caminho)
+    try:
+        linhas = conexao.execute("SELECT type, name FROM sqlite_master WHERE name NOT LIKE 'sqlite_%'").fetchall()
+    finally:
+        conexao.close()
+    objetos: dict[str, set[str]] = {}
+    for tipo, nome in linhas:
+        objetos.setdefault(tipo, set()).add(nome)
+    return objetos
+
+
+def test_carga_sqlite_duas_vezes(tmp_path):
+    banco = tmp_path / "ans.sqlite"
+    url = f"sqlite:///{banco}"
+    schema = ler_schema()
+    indices_schema = {indice for tabela in schema.values() for indice, _ in tabela.indices}
+
+    primeira = _salvar_origens(tmp_path / "primeira", 10, [(2024, 3), (2024, 4)])
+    destino = conectar(url)
+    try:
+        assert linhas_no_banco(destino) == {tabela: None for tabela in COLUNAS_TABELAS}
+        resultado = carregar_banco(destino, primeira, linhas_por_lote=7)
+        assert resultado["despesas_consolidadas"]["descartadas"] == 1
+        assert linhas_no_banco(destino) == {
+            "operadoras": 10,
+            "despesas_consolidadas": 19,
+            "despesas_agregadas": 10,
+        }
+    finally:
+        destino.fechar()
+
+    # Segunda carga com outros dados: as tabelas são trocadas inteiras, sem sobrar tabelas de carga
+    segunda = _salvar_origens(tmp_path / "segunda", 4, [(2025, 1)])
+    destino = conectar(url)
+    try:
+        resultado = carregar_banco(destino, segunda)
+        assert {tabela: medidas["linhas"] for tabela, medidas in resultado.items()} == linhas_no_banco(destino)
+        assert linhas_no_banco(destino) == {"operadoras": 4, "despesas_consolidadas": 3, "despesas_agregadas": 4}
+    finally:
+        destino.fechar()
+
+    objetos = _objetos(banco)
+    assert objetos["table"] == set(COLUNAS_TABELAS)
+    assert objetos["index"] == indices_schema
+
+    conexao = sqlite3.connect(banco)
+    try:
+        assert conexao.execute("SELECT DISTINCT ano, trimestre FROM despesas_consolidadas").fetchall() == [(2025, 1)]
+        assert conexao.execute("SELECT typeof(registro_ans) FROM operadoras LIMIT 1").fetchone() == ("integer",)
+        plano = conexao.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM despesas_consolidadas WHERE ano = 2025 AND trimestre = 1"
+        ).fetchall()
+        assert any("idx_despesas_ano_tri" in linha[-1] for linha in plano)
+    finally:
+        conexao.close()
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from validation import validar_cnpj, validar_cnpjs
+
+
+def _cnpj_valido(base: str) -> str:
+    # Completa uma base de 12 dígitos com os dígitos verificadores.
+    for pesos in ([5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2], [6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2]):
+        resto = sum(int(d) * p for d, p in zip(base, pesos)) % 11
+        base += str(0 if resto < 2 else 11 - resto)
+    return base
+
+
+def _conferir(serie: pd.Series) -> None:
+    esperado = serie.map(validar_cnpj).astype(bool)
+    pd.testing.assert_series_equal(validar_cnpjs(serie), esperado, check_names=False)
+
+
+CASOS = [
+    "11.222.333/0001-81",
+    "11222333000181",
+    " 11222333000181 ",
+    "11.222.333/0001-82",
+    "1122233300018",
+    "112223330001811",
+    "11111111111111",
+    "00000000000000",
+    "99.999.999/9999-99",
+    "",
+    "abc",
+    None,
+    np.nan,
+    pd.NA,
+    11222333000181,
+    11222333000182,
+    11222333000181.0,
+    1122233300018.0,
+    0,
+]
+
+
+@pytest.mark.parametrize("caso", CASOS, ids=repr)
+def test_caso_isolado(caso):
+    _conferir(pd.Series([caso], dtype=object))
+
+
+def test_todos_os_casos_juntos():
+    _conferir(pd.Series(CASOS * 3, dtype=object))
+
+
+def test_inteiro_e_float_com_o_mesmo_valor():
+    # Iguais como números, mas validar_cnpj lê o float como "11222333000181.0" (15 dígitos)
+    for valores in ([11222333000181, 11222333000181.0], [11222333000181.0, 11222333000181]):
+        serie = pd.Series(valores, dtype=object)
+        _conferir(serie)
+        assert validar_cnpjs(serie).tolist() == [isinstance(v, int) for v in valores]
+
+
+def test_coluna_string_com_nulos():
+    _conferir(pd.Series(["11222333000181", None, "11222333000182", "11222333000181"], dtype="string"))
+
+
+def test_serie_vazia():
+    assert validar_cnpjs(pd.Series([], dtype="string")).tolist() == []
+
+
+def test_cnpjs_aleatorios():
+    rng = np.random.default_rng(2024)
+    aleatorios = ["".join(map(str, d)) for d in rng.integers(0, 10, size=(2000, 14))]
+    validos = [_cnpj_valido(c[:12]) for c in aleatorios[:500]]
+    mascarados = [f"{c[:2]}.{c[2:5]}.{c[5:8]}/{c[8:12]}-{c[12:]}" for c in validos[:100]]
+    serie = pd.Series(aleatorios + validos + mascarados, dtype="string").sample(frac=1, random_state=7)
+
+    _conferir(serie)
+    assert validar_cnpjs(serie).sum() >= len(validos) + len(mascarados)